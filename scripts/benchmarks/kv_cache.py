@@ -0,0 +1,62 @@
+import time
+from logging import Logger
+from typing import Any
+
+import moral_machine
+from agent import Agent
+from experiment import ex
+from model.transformers import TransformersModel
+
+
+# noinspection PyUnusedLocal
+@ex.config
+def kv_cache_benchmark_config():
+    # small Hugging Face model with a chat template that can be run on CPU
+    hf_model_id = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+    # number of sessions to play with and without key/value cache
+    num_benchmark_sessions = 5
+
+    # every session has to be run through the model
+    response_cache = False
+
+
+def _make_model(hf_model_id: str, kv_cache: bool) -> TransformersModel:
+    class BenchmarkModel(TransformersModel):
+        _model_config = {hf_model_id: hf_model_id}
+
+    return BenchmarkModel(hf_model_id, kv_cache=kv_cache)
+
+
+def _play(model: TransformersModel, sessions: list[moral_machine.Session]) -> tuple[list[list[str]], list[float]]:
+    answers = []
+    durations = []
+    for session in sessions:
+        start = time.perf_counter()
+        model.reset()
+        # noinspection PyProtectedMember
+        answers.append([model.prompt(Agent._make_prompt(scenario)) for scenario in session.scenarios])
+        durations.append(time.perf_counter() - start)
+    return answers, durations
+
+
+@ex.automain
+def main(hf_model_id: str, num_benchmark_sessions: int, _log: Logger) -> Any:
+    sessions = moral_machine.load_sessions()[:num_benchmark_sessions]
+    answers_full, durations_full = _play(_make_model(hf_model_id, kv_cache=False), sessions)
+    answers_cached, durations_cached = _play(_make_model(hf_model_id, kv_cache=True), sessions)
+
+    mean_full = sum(durations_full) / len(durations_full)
+    mean_cached = sum(durations_cached) / len(durations_cached)
+    identical = answers_full == answers_cached
+    _log.info(f"seconds per session: {mean_full:.2f} without cache, {mean_cached:.2f} with cache "
+              f"(speedup {mean_full / mean_cached:.2f}x); answers identical: {identical}")
+    if not identical:
+        _log.warning(f"answers differ: {answers_full} vs. {answers_cached}")
+
+    return dict(
+        durations_full=durations_full,
+        durations_cached=durations_cached,
+        speedup=mean_full / mean_cached,
+        answers_identical=identical,
+    )
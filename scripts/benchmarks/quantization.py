@@ -0,0 +1,69 @@
+import multiprocessing
+import resource
+import time
+from logging import Logger
+from typing import Any
+
+import moral_machine
+from agent import Agent
+from experiment import ex
+from model.transformers import TransformersModel
+
+
+# noinspection PyUnusedLocal
+@ex.config
+def quantization_benchmark_config():
+    # number of sessions to play with the bf16 and the quantized model
+    num_benchmark_sessions = 5
+
+    # every session has to be run through both models
+    response_cache = False
+
+
+def _benchmark(model_name: str, num_benchmark_sessions: int) -> dict[str, Any]:
+    # runs in a fresh process such that the peak RSS is the one of this model only
+    start = time.perf_counter()
+    agent = Agent(model_name)
+    load_time = time.perf_counter() - start
+    answers = []
+    durations = []
+    for session in moral_machine.load_sessions()[:num_benchmark_sessions]:
+        start = time.perf_counter()
+        answers.append(agent.play(session))
+        durations.append(time.perf_counter() - start)
+    return dict(
+        load_time=load_time,
+        durations=durations,
+        answers=answers,
+        peak_rss_mib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+
+
+@ex.automain
+def main(model_name: str, num_benchmark_sessions: int, _log: Logger) -> Any:
+    assert model_name in TransformersModel.SUPPORTED_MODELS, f"model '{model_name}' is not a Transformers model"
+
+    results = {}
+    # fork such that the child processes share the experiment's configuration
+    context = multiprocessing.get_context("fork")
+    for name in (model_name, f"{model_name}{TransformersModel.QUANTIZED_SUFFIX}"):
+        with context.Pool(1) as pool:
+            result = pool.apply(_benchmark, (name, num_benchmark_sessions))
+        results[name] = result
+        _log.info(f"{name}: {result['load_time']:.1f}s to load, "
+                  f"{sum(result['durations']) / len(result['durations']):.2f}s per session, "
+                  f"peak RSS {result['peak_rss_mib']:.0f} MiB")
+
+    answers, quantized_answers = (result["answers"] for result in results.values())
+    num_answers = sum(len(session_answers) for session_answers in answers)
+    num_agreeing_answers = sum(
+        answer == quantized_answer
+        for session_answers, quantized_session_answers in zip(answers, quantized_answers)
+        for answer, quantized_answer in zip(session_answers, quantized_session_answers)
+    )
+    _log.info(f"{num_agreeing_answers}/{num_answers} answers agree")
+
+    return dict(
+        results=results,
+        answer_agreement=num_agreeing_answers / num_answers,
+    )
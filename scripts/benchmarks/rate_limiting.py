@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+from logging import Logger
+from typing import Any
+
+import numpy as np
+
+from experiment import ex
+from rate_limit import RateLimit, TokenBucket
+
+
+# noinspection PyUnusedLocal
+@ex.config
+def rate_limit_benchmark_config():
+    # calls per minute that are allowed, and number of calls that are made at that rate
+    benchmark_calls_per_minute = 10_000
+    num_benchmark_calls = 2_000
+
+    # number of threads (or tasks) that make the calls concurrently
+    num_benchmark_workers = 16
+
+
+def _measure_reserve_overhead(num_calls: int) -> float:
+    # the limits are never reached, so the calls return right away
+    rate_limit = RateLimit(10 ** 9, 10 ** 12)
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        rate_limit.wait(1000)
+    return (time.perf_counter() - start) / num_calls
+
+
+def _summarize(mode: str, lateness: list[float], duration: float, num_calls: int, _log: Logger) -> dict[str, float]:
+    result = dict(
+        calls_per_minute=num_calls / duration * 60,
+        lateness_p50=float(np.percentile(lateness, 50)),
+        lateness_p99=float(np.percentile(lateness, 99)),
+    )
+    _log.info(f"{mode}: {result['calls_per_minute']:.0f} calls per minute, calls return "
+              f"{result['lateness_p50'] * 1000:.2f} ms (p50) / {result['lateness_p99'] * 1000:.2f} ms (p99) late")
+    return result
+
+
+def _benchmark_threads(calls_per_minute: int, num_calls: int, num_workers: int, _log: Logger) -> dict[str, float]:
+    # a bucket without burst, such that every call has to wait for its turn
+    bucket = TokenBucket(1, calls_per_minute / 60)
+    lateness = []
+    remaining_calls = iter(range(num_calls))
+
+    def work() -> None:
+        for _ in remaining_calls:
+            call_start = time.monotonic()
+            delay = bucket.reserve(1)
+            time.sleep(delay)
+            lateness.append(time.monotonic() - call_start - delay)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=work) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return _summarize("threads", lateness, time.perf_counter() - start, num_calls, _log)
+
+
+def _benchmark_asyncio(calls_per_minute: int, num_calls: int, num_workers: int, _log: Logger) -> dict[str, float]:
+    bucket = TokenBucket(1, calls_per_minute / 60)
+    lateness = []
+    remaining_calls = iter(range(num_calls))
+
+    async def work() -> None:
+        for _ in remaining_calls:
+            call_start = time.monotonic()
+            delay = bucket.reserve(1)
+            await asyncio.sleep(delay)
+            lateness.append(time.monotonic() - call_start - delay)
+
+    async def work_all() -> None:
+        await asyncio.gather(*(work() for _ in range(num_workers)))
+
+    start = time.perf_counter()
+    asyncio.run(work_all())
+    return _summarize("asyncio", lateness, time.perf_counter() - start, num_calls, _log)
+
+
+@ex.automain
+def main(benchmark_calls_per_minute: int, num_benchmark_calls: int, num_benchmark_workers: int, _log: Logger) -> Any:
+    reserve_overhead = _measure_reserve_overhead(100_000)
+    _log.info(f"overhead of RateLimit.wait: {reserve_overhead * 1e6:.2f} µs per call")
+    return dict(
+        reserve_overhead=reserve_overhead,
+        threads=_benchmark_threads(benchmark_calls_per_minute, num_benchmark_calls, num_benchmark_workers, _log),
+        asyncio=_benchmark_asyncio(benchmark_calls_per_minute, num_benchmark_calls, num_benchmark_workers, _log),
+    )
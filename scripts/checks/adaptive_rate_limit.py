@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+from agent import Agent
+from experiment import ex
+from fake_openai import FakeOpenAIServer
+from moral_machine import load_sessions
+
+# set once the quota went through all phases, to stop playing sessions
+_phases_over = threading.Event()
+
+
+@ex.command(unobserved=True)
+def check_adaptive_rate_limit(model_name: str, language: str, to_session_id: int, max_concurrent_sessions: int) -> int:
+    """Plays the sessions over and over (concurrently) until the phases are over. Returns the number of sessions played."""
+    sessions = load_sessions(language, 0, to_session_id)
+    agent = Agent(model_name)
+    num_played = 0
+
+    async def play(player_idx: int) -> None:
+        nonlocal num_played
+        session_idx = player_idx
+        while not _phases_over.is_set():
+            await agent.play_async(sessions[session_idx % len(sessions)], [])
+            session_idx += max_concurrent_sessions
+            num_played += 1
+
+    async def play_all() -> None:
+        await asyncio.gather(*map(play, range(max_concurrent_sessions)))
+
+    asyncio.run(play_all())
+    return num_played
+
+
+def run_phases(server: FakeOpenAIServer, quotas: list[int], phase_duration: float, rates: list[float]) -> None:
+    """Changes the quota of the server at the start of each phase, and measures the rate of accepted requests in the
+    second half of each phase (when the client had time to adapt)."""
+    for max_requests_per_minute in quotas:
+        server.set_quota(max_requests_per_minute, None)
+        time.sleep(phase_duration / 2)
+        num_requests, start_time = server.num_accepted_requests, time.perf_counter()
+        time.sleep(phase_duration / 2)
+        rates.append((server.num_accepted_requests - num_requests) / (time.perf_counter() - start_time) * 60)
+    _phases_over.set()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-l", "--language", default="en")
+    parser.add_argument("-m", "--model-name", default="gpt-3.5-turbo-0125")
+    parser.add_argument("-n", "--num-sessions", type=int, default=100)
+    parser.add_argument("-c", "--max-concurrent-sessions", type=int, default=16)
+    # the configured limit is far off, like after an upgrade of the account; the first response should correct it
+    parser.add_argument("--max-requests-per-minute", type=int, default=10_000)
+    parser.add_argument("-q", "--quotas", type=int, nargs="+", default=[600, 1200, 300],
+                        help="quotas of the phases, in requests per minute")
+    parser.add_argument("-d", "--phase-duration", type=float, default=20., help="duration of each phase (seconds)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server = FakeOpenAIServer("127.0.0.1", 0, logging.getLogger("fake_openai"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rates = []
+    phases = threading.Thread(target=run_phases, args=(server, args.quotas, args.phase_duration, rates), daemon=True)
+    os.environ["NO_DRY_RUN"] = "1"  # the requests are served locally
+    os.environ.setdefault("OPENAI_API_KEY", "none")
+    try:
+        phases.start()
+        ex.run("check_adaptive_rate_limit", config_updates=dict(
+            model_name=args.model_name,
+            language=args.language,
+            to_session_id=args.num_sessions,
+            max_concurrent_sessions=args.max_concurrent_sessions,
+            openai_base_url=server.url,
+            openai_max_requests_per_minute=args.max_requests_per_minute,
+            rate_limit_scope="process",  # the limits of the fake server must not affect other runs
+        ))
+        phases.join()
+    finally:
+        server.shutdown()
+
+    num_mismatches = 0
+    for max_requests_per_minute, rate in zip(args.quotas, rates):
+        # the quota has to be used, but not exceeded (apart from the requests that finish late)
+        matches = .9 * max_requests_per_minute <= rate <= 1.05 * max_requests_per_minute
+        print(f"quota {max_requests_per_minute:5d} requests per minute: {rate:7.1f} requests per minute"
+              f"{'' if matches else ' (mismatch)'}")
+        num_mismatches += not matches
+    # only requests that were sent before a lower quota was reported may be rejected
+    num_requests = server.num_accepted_requests + server.num_rejected_requests
+    print(f"{server.num_rejected_requests} of {num_requests} requests were rejected")
+    if server.num_rejected_requests > args.max_concurrent_sessions * len(args.quotas):
+        num_mismatches += 1
+    print(f"model {args.model_name}, quotas {args.quotas}: {num_mismatches} mismatches")
+    sys.exit(1 if num_mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Any
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+from google.generativeai.types import GenerateContentResponse
+
+import path_util
+from agent import Agent
+from experiment import ex
+from model.google import GoogleModel
+from moral_machine import get_available_languages, load_sessions
+
+
+class _RecordingModel(genai.GenerativeModel):
+    """Records the contents of all requests and replies with recorded responses instead of calling the API."""
+
+    def __init__(self, model_name: str, replies: list[str]):
+        super().__init__(model_name)
+        self.requests: list[list[dict]] = []
+        self._replies = iter(replies)
+
+    def generate_content(self, contents: Any, **kwargs: Any) -> GenerateContentResponse:
+        self.requests.append([type(content).to_dict(content) for content in contents])
+        return GenerateContentResponse.from_response(glm.GenerateContentResponse(candidates=[dict(
+            content=dict(role="model", parts=[dict(text=next(self._replies))]),
+            finish_reason=glm.Candidate.FinishReason.STOP,
+        )]))
+
+
+def _make_google_model(model_name: str, replies: list[str]) -> tuple[GoogleModel, _RecordingModel]:
+    """A GoogleModel whose chats are started with a recording model and whose requests are sent without rate limit or
+    retries."""
+    google_model = GoogleModel(model_name)
+    recording_model = _RecordingModel(model_name, replies)
+    google_model._model = recording_model
+    google_model._fetch = lambda chat, prompt: google_model._parse_response(chat.send_message(prompt))
+    return google_model, recording_model
+
+
+@ex.command(unobserved=True)
+def check_gemini_priming(model_name: str, language: str, num_sessions: int) -> int:
+    num_mismatches = 0
+    priming_reply = "Understood."
+    sessions = load_sessions(language, 0, num_sessions)
+    num_rounds = len(sessions[0].scenarios)
+    answers = ["1" if round_idx % 2 == 0 else "2" for round_idx in range(num_rounds)]
+
+    # the reply to the system prompt is fetched with the first session, the other sessions start from the stored one
+    google_model, primed_model = _make_google_model(model_name, [priming_reply] + answers * len(sessions))
+    for session_idx, session in enumerate(sessions):
+        # noinspection PyProtectedMember
+        prompts = [Agent._make_prompt(scenario) for scenario in session.scenarios]
+
+        # reference: the system prompt is sent as the first message of the session
+        sent_model = _RecordingModel(model_name, [priming_reply] + answers)
+        sent_chat = sent_model.start_chat()
+        sent_chat.send_message(google_model.system_prompt)
+        google_model.reset()
+        for prompt in prompts:
+            sent_chat.send_message(prompt)
+            google_model.prompt(prompt)
+
+        # the priming request itself is only sent with the first session
+        sent_requests = sent_model.requests if session_idx == 0 else sent_model.requests[1:]
+        primed_requests = primed_model.requests[:len(sent_requests)]
+        primed_model.requests = primed_model.requests[len(sent_requests):]
+        for round_idx, (sent_request, primed_request) in enumerate(zip(sent_requests, primed_requests)):
+            if sent_request != primed_request:
+                print(f"model {model_name}, language {language}, session {session_idx:3d}, request {round_idx:2d}: "
+                      f"contexts differ")
+                num_mismatches += 1
+        if len(sent_requests) != len(primed_requests):
+            print(f"model {model_name}, language {language}, session {session_idx:3d}: {len(primed_requests)} requests "
+                  f"sent instead of {len(sent_requests)}")
+            num_mismatches += 1
+
+    # another model (e.g., of a later run) starts from the stored reply without fetching it again
+    stored_google_model, stored_primed_model = _make_google_model(model_name, answers)
+    stored_google_model.reset()
+    with open(path_util.gemini_priming_replies_path) as f:
+        stored_priming_reply = json.load(f).get(model_name, {}).get(language)
+    if stored_primed_model.requests or stored_priming_reply != priming_reply:
+        print(f"model {model_name}, language {language}: the stored priming reply {stored_priming_reply!r} is not reused")
+        num_mismatches += 1
+    return num_mismatches
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--models", default="all")
+    parser.add_argument("-l", "--languages", default="all")
+    parser.add_argument("-n", "--num-sessions", type=int, default=10)
+    args = parser.parse_args()
+
+    models = sorted(GoogleModel.SUPPORTED_MODELS) if args.models == "all" else args.models.split(",")
+    languages = get_available_languages() if args.languages == "all" else args.languages.split(",")
+
+    os.environ["NO_DRY_RUN"] = "1"  # no requests are sent, but the chats have to be started
+    total_num_mismatches = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the replies of the checks must not end up with those of real runs
+        path_util.gemini_priming_replies_path = Path(tmp_dir) / "gemini_priming_replies.json"
+        for model_name in models:
+            for language in languages:
+                if not (path_util.data_dir / "preprocessed" / f"dataset_{language.split('-')[0]}.csv").exists():
+                    continue
+                run = ex.run("check_gemini_priming", config_updates=dict(
+                    model_name=model_name,
+                    language=language,
+                    num_sessions=args.num_sessions,
+                    rate_limit_scope="process",
+                    response_cache=False,  # every session has to be sent
+                ))
+                print(f"model {model_name}, language {language}: {run.result} mismatches")
+                total_num_mismatches += run.result
+    sys.exit(1 if total_num_mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
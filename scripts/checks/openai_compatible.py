@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+from argparse import ArgumentParser
+
+from agent import Agent
+from api_usage import APIUsage
+from experiment import ex
+from fake_openai import FakeOpenAIServer
+from model.openai_compatible import OpenAICompatibleModel
+from moral_machine import load_sessions
+from util import VALID_ANSWERS
+
+
+@ex.command(unobserved=True)
+def check_openai_compatible(language: str, to_session_id: int, max_concurrent_sessions: int) -> int:
+    sessions = load_sessions(language, 0, to_session_id)
+
+    # reference: the sessions are played one after another
+    serial_agent = Agent(OpenAICompatibleModel.NAME)
+    serial_answers = [serial_agent.play(session) for session in sessions]
+    serial_api_usage = serial_agent.report_api_usage()
+
+    concurrent_agent = Agent(OpenAICompatibleModel.NAME)
+    concurrent_api_usage = []
+    semaphore = asyncio.Semaphore(max_concurrent_sessions)
+
+    async def play(session) -> list[int]:
+        async with semaphore:
+            answers, _ = await concurrent_agent.play_async(session, concurrent_api_usage)
+            return answers
+
+    async def play_all() -> list[list[int]]:
+        return await asyncio.gather(*map(play, sessions))
+
+    concurrent_answers = asyncio.run(play_all())
+
+    num_mismatches = 0
+    for session_idx, (serial_session_answers, concurrent_session_answers) in enumerate(zip(serial_answers, concurrent_answers)):
+        if any(str(answer) not in VALID_ANSWERS for answer in serial_session_answers):
+            print(f"session {session_idx:3d}: unexpected answers {serial_session_answers}")
+            num_mismatches += 1
+        if serial_session_answers != concurrent_session_answers:
+            print(f"session {session_idx:3d}: serial answers {serial_session_answers} differ from concurrent answers "
+                  f"{concurrent_session_answers}")
+            num_mismatches += 1
+    concurrent_api_usage = APIUsage.merge(*concurrent_api_usage)
+    if (serial_api_usage.num_input_tokens, serial_api_usage.num_output_tokens) != \
+            (concurrent_api_usage.num_input_tokens, concurrent_api_usage.num_output_tokens):
+        print(f"serial API usage ({serial_api_usage}) differs from concurrent API usage ({concurrent_api_usage})")
+        num_mismatches += 1
+    if serial_api_usage.num_input_tokens <= 0 or serial_api_usage.cost != 0.:
+        print(f"unexpected API usage: {serial_api_usage}")
+        num_mismatches += 1
+    return num_mismatches
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-l", "--language", default="en")
+    parser.add_argument("-n", "--num-sessions", type=int, default=10)
+    parser.add_argument("-c", "--max-concurrent-sessions", type=int, default=4)
+    # an id that is unknown to OpenAIModel (and tiktoken), like those of most served models
+    parser.add_argument("-m", "--model-id", default="local/llama-2-7b-chat")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server = FakeOpenAIServer("127.0.0.1", 0, logging.getLogger("fake_openai"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["NO_DRY_RUN"] = "1"  # the requests are served locally
+    try:
+        run = ex.run("check_openai_compatible", config_updates=dict(
+            language=args.language,
+            to_session_id=args.num_sessions,
+            max_concurrent_sessions=args.max_concurrent_sessions,
+            openai_compatible_base_url=server.url,
+            openai_compatible_model_id=args.model_id,
+            response_cache=False,  # the serial sessions have to be sent, like the concurrent ones
+        ))
+    finally:
+        server.shutdown()
+    print(f"model {args.model_id}, language {args.language}: {run.result} mismatches")
+    sys.exit(1 if run.result > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
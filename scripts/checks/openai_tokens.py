@@ -0,0 +1,64 @@
+import json
+import sys
+from argparse import ArgumentParser
+
+import tiktoken
+
+import path_util
+from agent import Agent
+from model.openai import OpenAIModel, OpenAIRole, OpenAISession
+from moral_machine import get_available_languages, load_sessions
+
+
+def _estimate_num_input_tokens(model_name: str, history: list[dict[str, str]]) -> int:
+    # reference: re-encodes the whole history, as OpenAIModel did before counting the tokens incrementally
+    encoding = tiktoken.encoding_for_model(model_name)
+    num_tokens = 0
+    for message in history:
+        num_tokens += 3
+        for value in message.values():
+            num_tokens += len(encoding.encode(value))
+    return num_tokens + 3
+
+
+def _check(model_name: str, language: str, system_prompt: str, num_sessions: int) -> int:
+    num_mismatches = 0
+    for session_idx, session in enumerate(load_sessions(language, 0, num_sessions)):
+        openai_session = OpenAISession(model_name)
+        openai_session.add(OpenAIRole.SYSTEM, system_prompt)
+        for round_idx, scenario in enumerate(session.scenarios):
+            # noinspection PyProtectedMember
+            openai_session.add(OpenAIRole.USER, Agent._make_prompt(scenario))
+            expected_num_input_tokens = _estimate_num_input_tokens(model_name, openai_session.history)
+            num_input_tokens, _ = openai_session.estimate_tokens()
+            if num_input_tokens != expected_num_input_tokens:
+                print(f"model {model_name}, language {language}, session {session_idx:3d}, round {round_idx:2d}: "
+                      f"expected {expected_num_input_tokens} input tokens, got {num_input_tokens}")
+                num_mismatches += 1
+            openai_session.add(OpenAIRole.ASSISTANT, "1" if round_idx % 2 == 0 else "2")
+    return num_mismatches
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--models", default="all")
+    parser.add_argument("-l", "--languages", default="en")
+    parser.add_argument("-n", "--num-sessions", type=int, default=500)
+    args = parser.parse_args()
+
+    models = sorted(OpenAIModel.SUPPORTED_MODELS) if args.models == "all" else args.models.split(",")
+    languages = get_available_languages() if args.languages == "all" else args.languages.split(",")
+    with open(path_util.data_dir / "system_prompts.json") as f:
+        system_prompts = json.load(f)
+
+    total_num_mismatches = 0
+    for model_name in models:
+        for language in languages:
+            num_mismatches = _check(model_name, language, system_prompts[language], args.num_sessions)
+            print(f"model {model_name}, language {language}: {num_mismatches} mismatches")
+            total_num_mismatches += num_mismatches
+    sys.exit(1 if total_num_mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
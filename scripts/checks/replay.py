@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+
+from agent import Agent
+from experiment import ex
+from model.replay import ReplayModel, load_recorded_sessions
+from moral_machine import load_sessions
+
+
+@ex.command(unobserved=True)
+def check_replay(
+        replay_model_name: str,
+        replay_source: str,
+        language: str,
+        to_session_id: int,
+        batch_size: int,
+        max_concurrent_sessions: int,
+) -> int:
+    sessions = load_sessions(language, 0, to_session_id)
+    recorded_sessions = load_recorded_sessions(replay_model_name, language, replay_source)[:to_session_id]
+
+    # sessions without recorded answers fail in every mode, so only the recorded ones are compared
+    recorded_session_indices = [
+        session_idx for session_idx, recorded_session in enumerate(recorded_sessions) if isinstance(recorded_session, list)
+    ]
+    recorded_sessions = [recorded_sessions[session_idx] for session_idx in recorded_session_indices]
+    sessions = [sessions[session_idx] for session_idx in recorded_session_indices]
+
+    serial_agent = Agent(ReplayModel.NAME)
+    serial_answers = [serial_agent.play(session) for session in sessions]
+
+    batch_agent = Agent(ReplayModel.NAME)
+    batch_answers = []
+    for batch_start in range(0, len(sessions), batch_size):
+        batch_answers += batch_agent.play_batch(sessions[batch_start:batch_start + batch_size])
+
+    concurrent_agent = Agent(ReplayModel.NAME)
+    semaphore = asyncio.Semaphore(max_concurrent_sessions)
+
+    async def play(session) -> list[int]:
+        async with semaphore:
+            answers, _ = await concurrent_agent.play_async(session, [])
+            return answers
+
+    async def play_all() -> list[list[int]]:
+        return await asyncio.gather(*map(play, sessions))
+
+    concurrent_answers = asyncio.run(play_all())
+
+    num_mismatches = 0
+    for session_idx, recorded_session, *mode_answers in zip(
+            recorded_session_indices, recorded_sessions, serial_answers, batch_answers, concurrent_answers
+    ):
+        for mode, answers in zip(("serial", "batched", "concurrent"), mode_answers):
+            if answers != recorded_session:
+                print(f"session {session_idx:3d}: {mode} answers {answers} differ from recorded answers {recorded_session}")
+                num_mismatches += 1
+    return num_mismatches
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--model-name", default="gpt-3.5-turbo-0125")
+    parser.add_argument("-s", "--source", default="cleansed", choices=["cleansed", "raw"])
+    parser.add_argument("-l", "--language", default="en")
+    parser.add_argument("-n", "--num-sessions", type=int, default=500)
+    parser.add_argument("-b", "--batch-size", type=int, default=10)
+    parser.add_argument("-c", "--max-concurrent-sessions", type=int, default=16)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ["NO_DRY_RUN"] = "1"  # replaying does not cost anything
+    run = ex.run("check_replay", config_updates=dict(
+        replay_model_name=args.model_name,
+        replay_source=args.source,
+        language=args.language,
+        to_session_id=args.num_sessions,
+        batch_size=args.batch_size,
+        max_concurrent_sessions=args.max_concurrent_sessions,
+    ))
+    print(f"model {args.model_name}, language {args.language}: {run.result} mismatches")
+    sys.exit(1 if run.result > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
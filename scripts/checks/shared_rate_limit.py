@@ -0,0 +1,83 @@
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+from rate_limit import SharedTokenBucket
+
+
+def _work(ledger_path: Path, calls_per_minute: int, num_threads: int, start: float, duration: float, results) -> None:
+    """Reserves calls from the shared bucket with the given number of threads until the duration is over. Reports the
+    times at which the calls were granted, and how long the reservations took."""
+    # a bucket without burst, such that the calls are paced from the start
+    bucket = SharedTokenBucket(ledger_path, 1, calls_per_minute / 60)
+    grant_times = []
+    reserve_latencies = []
+
+    def work() -> None:
+        while time.monotonic() < start + duration:
+            reserve_start = time.perf_counter()
+            delay = bucket.reserve(1)
+            reserve_latencies.append(time.perf_counter() - reserve_start)
+            grant_times.append(time.monotonic() + delay)
+            time.sleep(delay)
+
+    threads = [threading.Thread(target=work) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((num_threads, grant_times, reserve_latencies))
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-r", "--calls-per-minute", type=int, default=6000)
+    # the processes differ in their concurrency, but should get the same share nonetheless
+    parser.add_argument("-t", "--num-threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("-d", "--duration", type=float, default=20., help="duration of the check (seconds)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as ledger_dir:
+        ledger_path = Path(ledger_dir) / "ledger"
+        results = multiprocessing.Queue()
+        start = time.monotonic() + 1  # such that all processes are started
+        processes = [
+            multiprocessing.Process(target=_work, args=(ledger_path, args.calls_per_minute, num_threads, start, args.duration,
+                                                        results))
+            for num_threads in args.num_threads
+        ]
+        for process in processes:
+            process.start()
+        process_results = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    # the calls are counted in the middle of the check, when all processes are active and paced
+    window_start, window_end = start + args.duration / 4, start + args.duration * 3 / 4
+    expected_rate = args.calls_per_minute / len(processes)
+    num_mismatches = 0
+    total_rate = 0.
+    for num_threads, grant_times, reserve_latencies in sorted(process_results):
+        rate = sum(window_start <= grant_time < window_end for grant_time in grant_times) / (window_end - window_start) * 60
+        total_rate += rate
+        latency_p99 = float(np.percentile(reserve_latencies, 99))
+        matches = .9 * expected_rate <= rate <= 1.1 * expected_rate and latency_p99 < .001
+        print(f"process with {num_threads:2d} threads: {rate:7.1f} calls per minute (fair share {expected_rate:.1f}), "
+              f"reservations take {np.percentile(reserve_latencies, 50) * 1e6:.1f} µs (p50) / {latency_p99 * 1e6:.1f} µs "
+              f"(p99){'' if matches else ' (mismatch)'}")
+        num_mismatches += not matches
+    matches = .95 * args.calls_per_minute <= total_rate <= 1.05 * args.calls_per_minute
+    print(f"all processes: {total_rate:.1f} calls per minute (limit {args.calls_per_minute}){'' if matches else ' (mismatch)'}")
+    num_mismatches += not matches
+    print(f"{len(processes)} processes: {num_mismatches} mismatches")
+    sys.exit(1 if num_mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
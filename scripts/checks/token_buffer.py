@@ -0,0 +1,58 @@
+import json
+import sys
+from argparse import ArgumentParser
+
+import path_util
+from agent import Agent
+from model.local import ChatMessage, ChatRole, ChatTemplate, LocalModel, LocalSession, TokenBuffer
+from model.mpt import MptModel
+from model.transformers import TransformersModel
+from moral_machine import get_available_languages, load_sessions
+
+
+def _check(model_class: type[LocalModel], model_name: str, language: str, system_prompt: str, num_sessions: int) -> int:
+    """Compare the token IDs of the incrementally templated and tokenized sessions with those of the whole rendered
+    sessions."""
+    tokenizer = model_class.load_tokenizer(model_name)
+    chat_template = ChatTemplate(tokenizer)
+    num_mismatches = 0
+    for session_idx, session in enumerate(load_sessions(language, 0, num_sessions)):
+        local_session = LocalSession(language, [ChatMessage(ChatRole.SYSTEM, system_prompt)], TokenBuffer(tokenizer))
+        for round_idx, scenario in enumerate(session.scenarios):
+            # noinspection PyProtectedMember
+            local_session.history.append(ChatMessage(ChatRole.USER, Agent._make_prompt(scenario)))
+            prompt = chat_template.render(local_session.history)
+            expected_input_ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
+            if local_session.update_input_ids(chat_template) != expected_input_ids:
+                print(f"model {model_name}, language {language}, session {session_idx:3d}, round {round_idx:2d}: token IDs differ")
+                num_mismatches += 1
+            local_session.history.append(ChatMessage(ChatRole.ASSISTANT, "1" if round_idx % 2 == 0 else "2"))
+    return num_mismatches
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--models", default="all")
+    parser.add_argument("-l", "--languages", default="all")
+    parser.add_argument("-n", "--num-sessions", type=int, default=10)
+    args = parser.parse_args()
+
+    model_classes: dict[str, type[LocalModel]] = {}
+    for model_class in (MptModel, TransformersModel):
+        model_classes.update((model_name, model_class) for model_name in model_class.SUPPORTED_MODELS)
+    models = sorted(model_classes.keys()) if args.models == "all" else args.models.split(",")
+    languages = get_available_languages() if args.languages == "all" else args.languages.split(",")
+    with open(path_util.data_dir / "system_prompts.json") as f:
+        system_prompts = json.load(f)
+
+    total_num_mismatches = 0
+    for model_name in models:
+        for language in languages:
+            num_mismatches = _check(model_classes[model_name], model_name, language, system_prompts[language], args.num_sessions)
+            print(f"model {model_name}, language {language}: {num_mismatches} mismatches")
+            total_num_mismatches += num_mismatches
+    sys.exit(1 if total_num_mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
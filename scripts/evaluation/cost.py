@@ -27,18 +27,25 @@ def main() -> None:
 
     df_data = []
     for experiment_id, (config, run) in ((e, _load_run(e)) for e in experiments):
+        api_usage_total = run["result"]["api_usage_total"]
         df_data.append(dict(
             experiment_id=experiment_id,
             model_name=config["model_name"],
             language=config["language"],
-            cost=run["result"]["api_usage_total"]["cost"],
+            num_input_tokens=api_usage_total["num_input_tokens"],
+            # older runs do not record cached input tokens and the list price, which was the cost then
+            num_cached_input_tokens=api_usage_total.get("num_cached_input_tokens", 0),
+            list_cost=api_usage_total.get("list_cost", api_usage_total["cost"]),
+            cost=api_usage_total["cost"],
         ))
     df = pd.DataFrame.from_records(df_data, index="experiment_id")
 
     for key, item in df.groupby("model_name"):
         print(f"\n\n### Model '{key}' ###")
-        print(item[["language", "cost"]])
-        print(f"Total: {item['cost'].sum():.2f}")
+        print(item[["language", "num_input_tokens", "num_cached_input_tokens", "list_cost", "cost"]])
+        total_cost, total_list_cost = item["cost"].sum(), item["list_cost"].sum()
+        savings = f", {1 - total_cost / total_list_cost:.1%} saved" if total_list_cost > 0 else ""
+        print(f"Total: {total_cost:.2f} (list price {total_list_cost:.2f}{savings})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+import json
+from argparse import ArgumentParser
+from typing import Callable, Optional
+
+import numpy as np
+
+import path_util
+from agent import Agent
+from model import get_available_models
+from model.local import ChatMessage, ChatRole, LocalModel
+from model.model import load_system_prompt
+from model.mpt import MptModel
+from model.openai import OpenAIModel
+from model.transformers import TransformersModel
+from moral_machine import Session, get_available_languages, load_sessions
+
+# number of tokens that are generated per answer
+_NUM_ANSWER_TOKENS = 1
+
+# counts the tokens of a chat, i.e., a list of (role, content) tuples, including the generation prompt
+TokenCounter = Callable[[list[tuple[str, str]]], int]
+
+
+def _make_local_token_counter(model_class: type[LocalModel], model_name: str) -> TokenCounter:
+    tokenizer = model_class.load_tokenizer(model_name)
+
+    def count_tokens(chat: list[tuple[str, str]]) -> int:
+        prompt = tokenizer.apply_chat_template(
+            [ChatMessage(ChatRole(role), content).to_dict() for role, content in chat],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        return len(tokenizer(prompt, add_special_tokens=False)["input_ids"])
+
+    return count_tokens
+
+
+def _make_openai_token_counter(model_name: str) -> TokenCounter:
+    def count_tokens(chat: list[tuple[str, str]]) -> int:
+        return OpenAIModel.estimate_num_input_tokens(model_name, [dict(role=role, content=content) for role, content in chat])
+
+    return count_tokens
+
+
+def _make_backend(model_name: str) -> Optional[tuple[TokenCounter, int]]:
+    """Returns the token counter and the context window of the model, or None if the model cannot be planned."""
+    if model_name in MptModel.SUPPORTED_MODELS:
+        return _make_local_token_counter(MptModel, model_name), MptModel.context_window(model_name)
+    if model_name in TransformersModel.SUPPORTED_MODELS | TransformersModel.SUPPORTED_QUANTIZED_MODELS:
+        return _make_local_token_counter(TransformersModel, model_name), TransformersModel.context_window(model_name)
+    if model_name in OpenAIModel.SUPPORTED_MODELS:
+        return _make_openai_token_counter(model_name), OpenAIModel.CONTEXT_WINDOWS[model_name]
+    return None
+
+
+def _count_session_tokens(count_tokens: TokenCounter, system_prompt: str, session: Session) -> int:
+    # the last prompt of a session is the longest one; all previous answers are assumed to be a single token long
+    chat = [(ChatRole.SYSTEM.value, system_prompt)]
+    for scenario in session.scenarios:
+        # noinspection PyProtectedMember
+        chat.append((ChatRole.USER.value, Agent._make_prompt(scenario)))
+        chat.append((ChatRole.ASSISTANT.value, "1"))
+    return count_tokens(chat[:-1]) + _NUM_ANSWER_TOKENS
+
+
+def _plan_language(count_tokens: TokenCounter, context_window: int, language: str) -> dict:
+    system_prompt = load_system_prompt(language)
+    num_tokens = np.array([
+        _count_session_tokens(count_tokens, system_prompt, session) for session in load_sessions(language, 0, None)
+    ])
+    return dict(
+        num_tokens_max=int(num_tokens.max()),
+        num_tokens_p50=float(np.percentile(num_tokens, 50)),
+        num_tokens_p90=float(np.percentile(num_tokens, 90)),
+        num_tokens_p99=float(np.percentile(num_tokens, 99)),
+        overflowing_sessions=[int(session_idx) for session_idx in np.flatnonzero(num_tokens > context_window)],
+    )
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--models", default="all")
+    parser.add_argument("-l", "--languages", default="all")
+    args = parser.parse_args()
+    models = get_available_models() if args.models == "all" else args.models.split(",")
+    languages = get_available_languages() if args.languages == "all" else args.languages.split(",")
+
+    if path_util.context_plan_path.exists():
+        with open(path_util.context_plan_path) as f:
+            plan = json.load(f)
+    else:
+        plan = {}
+    for model_name in models:
+        backend = _make_backend(model_name)
+        if backend is None:
+            print(f"model {model_name}: no local tokenizer available; skipping")
+            continue
+        count_tokens, context_window = backend
+        language_plans = plan.get(model_name, {}).get("languages", {})
+        for language in languages:
+            if not (path_util.data_dir / "preprocessed" / f"dataset_{language.split('-')[0]}.csv").exists():
+                print(f"model {model_name}, language {language}: no dataset; skipping")
+                continue
+            language_plans[language] = language_plan = _plan_language(count_tokens, context_window, language)
+            print(
+                f"model {model_name}, language {language}: "
+                f"max {language_plan['num_tokens_max']}, p50 {language_plan['num_tokens_p50']:.0f}, "
+                f"p90 {language_plan['num_tokens_p90']:.0f}, p99 {language_plan['num_tokens_p99']:.0f} tokens "
+                f"(context window {context_window})"
+            )
+            if language_plan["overflowing_sessions"]:
+                print(f"model {model_name}, language {language}: sessions {language_plan['overflowing_sessions']} "
+                      f"exceed the context window")
+        if not language_plans:
+            print(f"model {model_name}: no language planned; skipping")
+            continue
+        plan[model_name] = dict(context_window=context_window, languages=language_plans)
+
+    path_util.context_plan_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path_util.context_plan_path, "w") as f:
+        json.dump(plan, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,100 @@
+import asyncio
+import itertools
 import traceback
 from logging import Logger
 from typing import Any, Optional
 
+from sacred.run import Run
 from tqdm import tqdm
 
+import context_plan
 import model
 import moral_machine
 from agent import Agent
 from api_usage import APIUsage
 from experiment import ex
+from response_cache import ResponseCache
 
 
-def _run_session(agent: Agent, session: moral_machine.Session) -> tuple[list[int], APIUsage]:
+SessionResult = tuple[list[int], APIUsage, Optional[list[Optional[dict[str, float]]]]]
+
+
+def _run_session(agent: Agent, session: moral_machine.Session) -> SessionResult:
     try:
         result = agent.play(session)
+        answer_probabilities = agent.report_answer_probabilities()[0]
     except Exception:
         result = traceback.format_exc()
+        answer_probabilities = None
+        traceback.print_exc()
+    return result, agent.report_api_usage(), answer_probabilities
+
+
+def _run_batch(agent: Agent, sessions: list[moral_machine.Session]) -> list[SessionResult]:
+    try:
+        batch_answers = agent.play_batch(sessions)
+        batch_answer_probabilities = agent.report_answer_probabilities()
+    except Exception:
         traceback.print_exc()
-    return result, agent.report_api_usage()
+        batch_answers = [None for _ in sessions]
+        batch_answer_probabilities = [None for _ in sessions]
+    # sessions that failed in the batch are replayed one by one, including the retries of Agent.play
+    return [
+        _run_session(agent, session) if session_answers is None
+        else (session_answers, agent.report_api_usage(), session_answer_probabilities)
+        for session, session_answers, session_answer_probabilities in zip(sessions, batch_answers, batch_answer_probabilities)
+    ]
+
+
+async def _run_sessions_concurrently(
+        agent: Agent,
+        sessions: list[moral_machine.Session],
+        max_concurrent_sessions: int,
+        model_name: str,
+        pbar: tqdm,
+) -> list[SessionResult]:
+    semaphore = asyncio.Semaphore(max_concurrent_sessions)
+
+    async def run_session(session: moral_machine.Session) -> SessionResult:
+        api_usage = []
+        async with semaphore:
+            try:
+                result, answer_probabilities = await agent.play_async(session, api_usage)
+            except Exception:
+                result = traceback.format_exc()
+                answer_probabilities = None
+                traceback.print_exc()
+        pbar.update()
+        return result, APIUsage.merge(*api_usage) if api_usage else APIUsage(model_name, 0, 0, 0.), answer_probabilities
+
+    session_results = await asyncio.gather(*(run_session(session) for session in sessions))
+    # like when playing the sessions one after another, report the API usage of all sessions played so far
+    cumulative_api_usage = itertools.accumulate((api_usage for _, api_usage, _ in session_results), _accumulate_api_usage)
+    return [
+        (result, api_usage, answer_probabilities)
+        for (result, _, answer_probabilities), api_usage in zip(session_results, cumulative_api_usage)
+    ]
+
+
+def _accumulate_api_usage(total: APIUsage, api_usage: APIUsage) -> APIUsage:
+    # models that do not track their usage report the same placeholder (-1 tokens) for every session, which does not add
+    # up, just like the usage they report when the sessions are played one after another
+    if total.num_input_tokens < 0 or api_usage.num_input_tokens < 0:
+        return APIUsage(api_usage.name, -1, -1, 0.)
+    return APIUsage.merge(total, api_usage)
 
 
 @ex.automain
-def main(model_name: str, language: str, session_indices: Optional[int | list[int]], _log: Logger) -> Any:
+def main(
+        model_name: str,
+        language: str,
+        from_session_id: int,
+        session_indices: Optional[int | list[int]],
+        batch_size: int,
+        max_concurrent_sessions: int,
+        _log: Logger,
+        _run: Run,
+) -> Any:
     assert model_name in model.get_available_models(), \
         f"model '{model_name}' not available; available models: {model.get_available_models()}"
     assert language in moral_machine.get_available_languages(), \
@@ -34,25 +107,66 @@ def main(model_name: str, language: str, session_indices: Optional[int | list[in
 
     answers: list[list[int]] = []
     api_usage: list[APIUsage] = []
+    answer_probabilities: list[Optional[list[Optional[dict[str, float]]]]] = []
     sessions = moral_machine.load_sessions(language)
     agent = Agent(model_name)
-    total = len(session_indices) if session_indices is not None else len(sessions)
-    with tqdm(total=total) as pbar:
-        for session_idx, session in enumerate(sessions):
-            if session_indices is None or session_idx in session_indices:
-                session_answers, session_api_usage = _run_session(agent, session)
-                pbar.update()
-            else:
-                session_answers, session_api_usage = (
-                    f"skipped; only playing sessions {session_indices}",
-                    APIUsage(model_name, 0, 0, 0),
-                )
-            answers.append(session_answers)
-            api_usage.append(session_api_usage)
-        api_usage_total = APIUsage.merge(*api_usage)
-
-    return dict(
+    # the context plan refers to the sessions of the whole dataset
+    overflowing_session_indices = [
+        session_idx - from_session_id for session_idx in context_plan.get_overflowing_sessions(model_name, language)
+    ]
+    if any(0 <= session_idx < len(sessions) for session_idx in overflowing_session_indices):
+        _log.warning(f"skipping sessions {overflowing_session_indices} that exceed the context window of the model")
+    played_session_indices = [
+        session_idx for session_idx in range(len(sessions))
+        if (session_indices is None or session_idx in session_indices) and session_idx not in overflowing_session_indices
+    ]
+    results: dict[int, SessionResult] = {}
+    with tqdm(total=len(played_session_indices)) as pbar:
+        if max_concurrent_sessions > 1:
+            assert batch_size == 1, "sessions can either be played in batches or concurrently, not both"
+            results.update(zip(played_session_indices, asyncio.run(_run_sessions_concurrently(
+                agent, [sessions[session_idx] for session_idx in played_session_indices], max_concurrent_sessions, model_name,
+                pbar,
+            ))))
+        else:
+            for batch_start in range(0, len(played_session_indices), batch_size):
+                batch_session_indices = played_session_indices[batch_start:batch_start + batch_size]
+                if batch_size == 1:
+                    batch_results = [_run_session(agent, sessions[batch_session_indices[0]])]
+                else:
+                    batch_results = _run_batch(agent, [sessions[session_idx] for session_idx in batch_session_indices])
+                results.update(zip(batch_session_indices, batch_results))
+                pbar.update(len(batch_session_indices))
+    for session_idx in range(len(sessions)):
+        if session_idx in overflowing_session_indices:
+            skip_reason = "skipped; session exceeds the context window of the model"
+        else:
+            skip_reason = f"skipped; only playing sessions {session_indices}"
+        session_answers, session_api_usage, session_answer_probabilities = results.get(session_idx, (
+            skip_reason,
+            APIUsage(model_name, 0, 0, 0),
+            None,
+        ))
+        answers.append(session_answers)
+        api_usage.append(session_api_usage)
+        answer_probabilities.append(session_answer_probabilities)
+    api_usage_total = APIUsage.merge(*api_usage)
+
+    for metric_name, metric_value in agent.report_metrics().items():
+        _log.info(f"{metric_name}: {metric_value}")
+        _run.log_scalar(metric_name, metric_value)
+
+    result = dict(
         answers=answers,
         api_usage=api_usage,
         api_usage_total=api_usage_total,
     )
+    if any(session_answer_probabilities is not None for session_answer_probabilities in answer_probabilities):
+        result["answer_probabilities"] = answer_probabilities
+    if response_cache_metrics := ResponseCache.report_metrics():
+        # replies read from the cache do not show up in the API usage
+        result["response_cache"] = dict(
+            hits=response_cache_metrics["response_cache_hits"],
+            misses=response_cache_metrics["response_cache_misses"],
+        )
+    return result
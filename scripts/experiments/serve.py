@@ -0,0 +1,31 @@
+from logging import Logger
+from urllib.parse import urlsplit
+
+from experiment import ex
+from model import make_model
+from model.local import LocalModel
+from model_server import ModelServer
+
+
+# noinspection PyUnusedLocal
+@ex.config
+def serve_config():
+    # maximum number of concurrent sessions whose prompts are processed in a single call to the model
+    max_served_batch_size = 16
+
+    # the configured language is only the default of the sessions
+    any_session_language = True
+
+
+@ex.automain
+def main(model_name: str, model_server_url: str, max_served_batch_size: int, _log: Logger) -> None:
+    model = make_model(model_name)
+    assert isinstance(model, LocalModel), f"model '{model_name}' is not a local model"
+    url = urlsplit(model_server_url)
+    server = ModelServer(model, model_name, url.hostname, url.port, max_served_batch_size, _log)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        _log.info("shutting down")
+    for metric_name, metric_value in model.report_metrics().items():
+        _log.info(f"{metric_name}: {metric_value}")
@@ -0,0 +1,34 @@
+import logging
+from argparse import ArgumentParser
+
+from fake_openai import FakeOpenAIServer
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--slow-request-rate", type=float, default=0., help="share of chat completions that are delayed")
+    parser.add_argument("--slow-request-latency", type=float, default=0., help="delay of slow chat completions (seconds)")
+    parser.add_argument("--max-requests-per-minute", type=int, help="quota of chat completions (unlimited by default)")
+    parser.add_argument("--max-tokens-per-minute", type=int, help="quota of chat completion tokens (unlimited by default)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeOpenAIServer(
+        args.host,
+        args.port,
+        logging.getLogger("fake_openai"),
+        args.slow_request_rate,
+        args.slow_request_latency,
+        args.max_requests_per_minute,
+        args.max_tokens_per_minute,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,152 @@
 import logging
-
-from tenacity import after_log, before_sleep_log, retry, retry_if_exception_type, stop_after_attempt
+from typing import Final, Optional
 
 from api_usage import APIUsage
 from model import make_model
-from moral_machine import Scenario, Session
-from util import LogSessionStateDetailsException, UnexpectedAnswerException
+from moral_machine import Scenario, Session, make_prompt
+from response_cache import ResponseCache
+from retry_policy import RetryBudget, RetryPolicy
+from util import LogSessionStateDetailsException, UnexpectedAnswerException, VALID_ANSWERS
+
+# a session that received an unexpected answer is played again from the start
+_SESSION_RETRY_POLICY: Final[RetryPolicy] = RetryPolicy("session", RetryBudget(UnexpectedAnswerException, max_attempts=10))
 
 
 class Agent:
     def __init__(self, model_name: str) -> None:
         self._model = make_model(model_name)
+        self._answer_probabilities: list[list[Optional[dict[str, float]]]] = []
+        # attempts to play a session that ended with an unexpected answer, and the tokens spent on them in vain
+        self._num_failed_attempts = 0
+        self._num_wasted_input_tokens = 0
+        self._num_wasted_output_tokens = 0
 
-    @retry(
-        after=after_log(logging.root, logging.WARNING),
-        before_sleep=before_sleep_log(logging.root, logging.INFO),
-        retry=retry_if_exception_type(UnexpectedAnswerException),
-        stop=stop_after_attempt(10),
-    )
+    @_SESSION_RETRY_POLICY
     def play(self, session: Session) -> list[int]:
         self._model.reset()
+        api_usage_before = self._model.report_api_usage()
         answers = []
+        self._answer_probabilities = [[]]
         for scenario_idx, scenario in enumerate(session.scenarios):
             try:
                 answer = self._prompt(self._make_prompt(scenario))
-                if scenario.left_right_swapped:
-                    answer = 1 if answer == 2 else 2
-                answers.append(answer)
+                answers.append(self._unswap(scenario, answer))
+                self._answer_probabilities[0].append(
+                    self._unswap_probabilities(scenario, self._model.answer_probabilities[0])
+                )
+            except UnexpectedAnswerException:
+                api_usage_after = self._model.report_api_usage()
+                self._count_failed_attempt(
+                    api_usage_after.num_input_tokens - api_usage_before.num_input_tokens,
+                    api_usage_after.num_output_tokens - api_usage_before.num_output_tokens,
+                )
+                raise
             except LogSessionStateDetailsException as exc:
                 raise Exception(f"failed to prompt for scenario {scenario_idx}; answers so for: {answers}") from exc
         return answers
 
+    def play_batch(self, sessions: list[Session]) -> list[Optional[list[int]]]:
+        """Play the sessions in lockstep, prompting turn k of all sessions at once. Sessions that received an
+        unexpected answer are not retried but returned as None and have to be replayed with play()."""
+
+        self._model.reset_batch(len(sessions))
+        answers = [[] for _ in sessions]
+        failed = [False for _ in sessions]
+        self._answer_probabilities = [[] for _ in sessions]
+        for scenarios in zip(*(session.scenarios for session in sessions)):
+            results = self._model.prompt_batch([self._make_prompt(scenario) for scenario in scenarios])
+            for session_idx, (scenario, result) in enumerate(zip(scenarios, results)):
+                self._answer_probabilities[session_idx].append(
+                    self._unswap_probabilities(scenario, self._model.answer_probabilities[session_idx])
+                )
+                try:
+                    answers[session_idx].append(self._unswap(scenario, self._parse_answer(result)))
+                except UnexpectedAnswerException as exc:
+                    logging.warning(f"unexpected answer in batched session, will be replayed: {exc}")
+                    failed[session_idx] = True
+        return [None if session_failed else session_answers for session_answers, session_failed in zip(answers, failed)]
+
+    @_SESSION_RETRY_POLICY
+    async def play_async(
+            self,
+            session: Session,
+            api_usage: list[APIUsage],
+    ) -> tuple[list[int], Optional[list[Optional[dict[str, float]]]]]:
+        """Play the session independently of all other sessions, such that many sessions can be played concurrently.
+        Returns the answers and their probabilities (see report_answer_probabilities). The API usage of each attempt is
+        appended to api_usage, also if the session fails eventually."""
+
+        model_session = await self._model.new_session_async()
+        try:
+            answers = []
+            answer_probabilities = []
+            for scenario_idx, scenario in enumerate(session.scenarios):
+                try:
+                    result = await self._model.prompt_session_async(model_session, self._make_prompt(scenario))
+                    answers.append(self._unswap(scenario, self._parse_answer(result)))
+                    answer_probabilities.append(
+                        self._unswap_probabilities(scenario, self._model.session_answer_probabilities(model_session))
+                    )
+                except UnexpectedAnswerException:
+                    session_api_usage = self._model.report_session_api_usage(model_session)
+                    self._count_failed_attempt(session_api_usage.num_input_tokens, session_api_usage.num_output_tokens)
+                    raise
+                except LogSessionStateDetailsException as exc:
+                    raise Exception(f"failed to prompt for scenario {scenario_idx}; answers so for: {answers}") from exc
+        finally:
+            api_usage.append(self._model.report_session_api_usage(model_session))
+        if all(probabilities is None for probabilities in answer_probabilities):
+            answer_probabilities = None
+        return answers, answer_probabilities
+
     def report_api_usage(self) -> APIUsage:
         return self._model.report_api_usage()
 
+    def report_answer_probabilities(self) -> list[Optional[list[Optional[dict[str, float]]]]]:
+        """Report the per-turn answer probabilities of the sessions of the last call to play() or play_batch(), or None
+        for sessions where the model does not provide them."""
+        return [
+            None if all(probabilities is None for probabilities in session_probabilities) else session_probabilities
+            for session_probabilities in self._answer_probabilities
+        ]
+
+    def report_metrics(self) -> dict[str, float]:
+        return dict(
+            num_failed_attempts=self._num_failed_attempts,
+            num_wasted_input_tokens=self._num_wasted_input_tokens,
+            num_wasted_output_tokens=self._num_wasted_output_tokens,
+            **self._model.report_metrics(),
+            **RetryPolicy.report_metrics(),
+            **ResponseCache.report_metrics(),
+        )
+
+    def _count_failed_attempt(self, num_wasted_input_tokens: int, num_wasted_output_tokens: int) -> None:
+        self._num_failed_attempts += 1
+        self._num_wasted_input_tokens += num_wasted_input_tokens
+        self._num_wasted_output_tokens += num_wasted_output_tokens
+
     def _prompt(self, prompt: str) -> int:
-        result = self._model.prompt(prompt)
-        if result not in {"1", "2"}:
+        return self._parse_answer(self._model.prompt(prompt))
+
+    @staticmethod
+    def _parse_answer(result: str) -> int:
+        if result not in VALID_ANSWERS:
             raise UnexpectedAnswerException(f"expected 1 or 2, got {result}")
         return int(result)
 
+    @staticmethod
+    def _unswap(scenario: Scenario, answer: int) -> int:
+        if scenario.left_right_swapped:
+            return 1 if answer == 2 else 2
+        return answer
+
+    @staticmethod
+    def _unswap_probabilities(scenario: Scenario, probabilities: Optional[dict[str, float]]) -> Optional[dict[str, float]]:
+        if probabilities is None or not scenario.left_right_swapped:
+            return probabilities
+        swapped_answers = {"1": "2", "2": "1"}
+        return {swapped_answers.get(answer, answer): p for answer, p in probabilities.items()}
+
     @staticmethod
     def _make_prompt(scenario: Scenario) -> str:
-        return f"1:\n{scenario.profile_left}\n\n\n\n\n2:\n{scenario.profile_right}"
+        return make_prompt(scenario)
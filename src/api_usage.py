@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass(frozen=True)
@@ -7,9 +8,18 @@ class APIUsage:
     num_input_tokens: int
     num_output_tokens: int
     cost: float
+    # input tokens (included in num_input_tokens) that were read from the prompt cache of the API at a discount
+    num_cached_input_tokens: int = 0
+    # cost at the list price, i.e., without discounts for cached input tokens and the Batch API; defaults to cost
+    list_cost: Optional[float] = None
+
+    def __post_init__(self):
+        if self.list_cost is None:
+            object.__setattr__(self, "list_cost", self.cost)
 
     def __str__(self):
-        return f"{self.name} used {self.num_input_tokens} input tokens and {self.num_output_tokens} output tokens (${self.cost:.2f})"
+        return (f"{self.name} used {self.num_input_tokens} input tokens ({self.num_cached_input_tokens} cached) and "
+                f"{self.num_output_tokens} output tokens (${self.cost:.2f}, list price ${self.list_cost:.2f})")
 
     @classmethod
     def merge(cls, *api_usage_reports: "APIUsage") -> "APIUsage":
@@ -17,9 +27,15 @@ class APIUsage:
         total_num_input_tokens = 0
         total_num_output_tokens = 0
         total_cost = 0.
+        total_num_cached_input_tokens = 0
+        total_list_cost = 0.
         for api_usage_report in api_usage_reports:
             assert api_usage_report.name == name, "can only merge API usages from same API"
             total_num_input_tokens += api_usage_report.num_input_tokens
             total_num_output_tokens += api_usage_report.num_output_tokens
             total_cost += api_usage_report.cost
-        return APIUsage(name, total_num_input_tokens, total_num_output_tokens, total_cost)
+            total_num_cached_input_tokens += api_usage_report.num_cached_input_tokens
+            total_list_cost += api_usage_report.list_cost
+        return APIUsage(
+            name, total_num_input_tokens, total_num_output_tokens, total_cost, total_num_cached_input_tokens, total_list_cost
+        )
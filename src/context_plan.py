@@ -0,0 +1,30 @@
+import json
+from typing import Optional
+
+import path_util
+
+
+def load_context_plan() -> dict[str, dict]:
+    """Load the context plan created by scripts/experiments/plan_context.py; empty if it has not been created yet."""
+    if not path_util.context_plan_path.exists():
+        return {}
+    with open(path_util.context_plan_path) as f:
+        return json.load(f)
+
+
+def get_max_seq_len(model_name: str, languages: Optional[list[str]] = None) -> Optional[int]:
+    """Number of tokens of the longest session of the model in any of the languages (defaults to all planned ones), at
+    most its context window, or None if any of the languages (or none at all) is not planned for the model."""
+    model_plan = load_context_plan().get(model_name, {})
+    language_plans = model_plan.get("languages", {})
+    if languages is None:
+        languages = list(language_plans)
+    if not languages or any(language not in language_plans for language in languages):
+        return None
+    return min(max(language_plans[language]["num_tokens_max"] for language in languages), model_plan["context_window"])
+
+
+def get_overflowing_sessions(model_name: str, language: str) -> list[int]:
+    """Indices of the sessions that do not fit into the model's context window."""
+    language_plan = load_context_plan().get(model_name, {}).get("languages", {}).get(language)
+    return [] if language_plan is None else language_plan["overflowing_sessions"]
@@ -22,3 +22,87 @@ def default_config():
 
     # play only the listed session indices; defaults to None (all)
     session_indices = None
+
+    # local models only: keep the key/value cache of previous turns instead of re-encoding the whole history every turn
+    kv_cache = False
+
+    # local models only: sessions can be started in any language, not only in the configured one (like those of
+    # scripts/experiments/serve.py); e.g., MPT then sizes its attention buffers for the longest session of any language
+    any_session_language = False
+
+    # local models only (requires kv_cache): compute the key/value cache of the system prompt once and share it across
+    # sessions
+    system_prompt_cache = True
+
+    # look up the replies to sessions that were played before (with the same model, generation parameters and history) in
+    # a persistent cache, such that playing them again does not cost any API calls or forward passes; only sessions
+    # played one after another are cached (not batched or concurrent ones), and not those of sampled answers or of served
+    # models; the least recently used of more than response_cache_max_entries replies are evicted
+    response_cache = True
+    response_cache_max_entries = 1_000_000
+
+    # number of sessions that are played in lockstep; turn k of all sessions is processed in a single forward pass by
+    # local models and in a single batch of the Batch API by OpenAI models
+    batch_size = 1
+
+    # OpenAI and Google models only: number of sessions that are played concurrently (and thus of requests in flight); 1
+    # plays the sessions one after another
+    max_concurrent_sessions = 1
+
+    # how the answers are obtained; can be one of
+    #  - "generate": generate a single token and expect it to be one of the answers
+    #  - "score": (local and OpenAI models only) pick the answer with the highest next-token probability; the
+    #    probabilities of all answers are stored with the results
+    answer_mode = "generate"
+
+    # base URL of the OpenAI API; None uses the official one, scripts/experiments/serve_fake_openai.py serves a local
+    # stand-in at "http://127.0.0.1:8001/v1"
+    openai_base_url = None
+
+    # OpenAI (and OpenAI-compatible) models only: connection pool of the HTTP client that is shared by all sessions of the
+    # process; idle connections are kept alive for openai_keepalive_expiry seconds, requests time out after openai_timeout
+    # seconds
+    openai_max_connections = 100
+    openai_max_keepalive_connections = 20
+    openai_keepalive_expiry = 60.
+    openai_timeout = 60.
+
+    # OpenAI and Google models only: requests and (estimated) tokens that are sent per minute at most, shared by all
+    # sessions that use the same model; None does not limit the tokens. These are only the initial limits,
+    # which adapt to the quota reported by the API (OpenAI) or to the requests it rejects (Google)
+    openai_max_requests_per_minute = 500
+    openai_max_tokens_per_minute = None
+    google_max_requests_per_minute = 60
+    # whether the limits are shared by the sessions of the "process" only, or by all processes of the "host" (e.g.,
+    # experiments that are run in parallel with the same API key), which get an equal share of them while they are active;
+    # the OpenAI limits of another openai_base_url (e.g., of the fake server) are separate from those of the official API
+    rate_limit_scope = "host"
+
+    # server of the "openai-compatible" model, which can be any inference server with an OpenAI-compatible API (e.g.,
+    # vLLM, llama.cpp server or TGI), and the id of the model it serves; sessions are best played concurrently (see
+    # max_concurrent_sessions), such that the server can batch them; the API key is read from OPENAI_COMPATIBLE_API_KEY
+    openai_compatible_base_url = "http://127.0.0.1:8080/v1"
+    openai_compatible_model_id = None
+
+    # "replay" model only: model whose recorded answers are replayed, read from its "cleansed" results or from its "raw"
+    # run.json files; each reply is delayed by replay_latency seconds plus up to replay_latency_jitter seconds (drawn
+    # uniformly), to measure the throughput of the harness under a given API latency without calling any model
+    replay_model_name = "gpt-3.5-turbo-0125"
+    replay_source = "cleansed"
+    replay_latency = 0.
+    replay_latency_jitter = 0.
+
+    # number of answers that are sampled per turn in a single request (at sampling_temperature instead of greedily);
+    # their frequencies are stored with the results as answer probabilities, and the session continues with the answer
+    # chosen by sample_policy, which can be "majority" (the most frequent valid answer) or "first" (the first sample);
+    # requires answer_mode "generate" and is not supported by Google models
+    num_samples = 1
+    sample_policy = "majority"
+    sampling_temperature = 1.
+
+    # OpenAI and Google models only: percentile of the recently observed request latencies after which a duplicate of a
+    # request is sent, and the first reply is used (the duplicate is billed as well); None disables hedging
+    hedge_percentile = None
+
+    # URL of the server started with scripts/experiments/serve.py; used by the "<model name>@server" models
+    model_server_url = "http://127.0.0.1:8000"
@@ -0,0 +1,392 @@
+import email.parser
+import email.policy
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Any, Optional
+
+from model.openai import OpenAIModel
+from util import VALID_ANSWERS
+
+
+class FakeOpenAIServer:
+    """Local stand-in for the parts of the OpenAI API that are used by OpenAIModel, to run experiments offline.
+
+    Endpoints (under /v1, all bodies are JSON unless noted):
+     - POST /chat/completions: answers with one of the valid answers, chosen deterministically from the messages; the
+       log probabilities of the answers are made up.
+     - POST /files: uploads a file (multipart form data).
+     - GET /files/<file_id>/content: returns the content of a file.
+     - POST /batches: creates a batch from an uploaded JSONL file of chat completion requests; batches are processed
+       right away.
+     - GET /batches/<batch_id>: returns the state of a batch.
+
+    Token counts are those estimated by OpenAIModel, such that they match exactly; for other models (see
+    OpenAICompatibleModel), words are counted instead. Like the prompt cache of the API, prefixes of earlier requests of
+    at least 1024 tokens are reported as cached input tokens, in increments of 128. To reproduce the latency tail of the
+    real API, a share of the chat completions (slow_request_rate) can be delayed by slow_request_latency seconds.
+
+    Chat completions can be limited to a quota of requests and tokens per minute, which can be changed while serving
+    (see set_quota()); like the API, each response reports the quota in its rate limit headers, and requests beyond it
+    are rejected with status 429. A request takes its input tokens plus max_tokens for each choice from the quota.
+    """
+
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            log: Logger,
+            slow_request_rate: float = 0.,
+            slow_request_latency: float = 0.,
+            max_requests_per_minute: Optional[int] = None,
+            max_tokens_per_minute: Optional[int] = None,
+    ):
+        self._log = log
+        self._slow_request_rate = slow_request_rate
+        self._slow_request_latency = slow_request_latency
+        self._requests_quota = None if max_requests_per_minute is None else _Quota(max_requests_per_minute)
+        self._tokens_quota = None if max_tokens_per_minute is None else _Quota(max_tokens_per_minute)
+        self._num_accepted_requests = 0
+        self._num_rejected_requests = 0
+        self._files: dict[str, tuple[dict[str, Any], bytes]] = {}
+        self._batches: dict[str, dict[str, Any]] = {}
+        # digests of the message prefixes of all requests so far
+        self._cached_prefixes: set[str] = set()
+        self._lock = threading.Lock()
+        self._http_server = ThreadingHTTPServer((host, port), _make_request_handler(self))
+        self._http_server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._http_server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve_forever(self) -> None:
+        self._log.info(f"serving fake OpenAI API on {self.url}")
+        try:
+            self._http_server.serve_forever()
+        finally:
+            self._http_server.server_close()
+
+    def shutdown(self) -> None:
+        self._http_server.shutdown()
+
+    @property
+    def num_accepted_requests(self) -> int:
+        return self._num_accepted_requests
+
+    @property
+    def num_rejected_requests(self) -> int:
+        return self._num_rejected_requests
+
+    def set_quota(self, max_requests_per_minute: Optional[int], max_tokens_per_minute: Optional[int]) -> None:
+        """Change the quota, like an upgrade (or downgrade) of the account would. What remains of the quota is kept."""
+        with self._lock:
+            self._requests_quota = self._update_quota(self._requests_quota, max_requests_per_minute)
+            self._tokens_quota = self._update_quota(self._tokens_quota, max_tokens_per_minute)
+        self._log.info(f"quota changed to {max_requests_per_minute} requests and {max_tokens_per_minute} tokens per minute")
+
+    def take_quota(self, body: dict[str, Any]) -> tuple[bool, dict[str, str]]:
+        """Take a chat completion request from the quota. Returns whether it is within the quota, and the rate limit
+        headers of the response."""
+        num_tokens = _count_input_tokens(body["model"], body["messages"]) + (body.get("max_tokens") or 0) * body.get("n", 1)
+        with self._lock:
+            quotas = [(unit, quota, amount) for unit, quota, amount in
+                      (("requests", self._requests_quota, 1), ("tokens", self._tokens_quota, num_tokens)) if quota is not None]
+            accepted = all(quota.has(amount) for _, quota, amount in quotas)
+            if accepted:
+                for _, quota, amount in quotas:
+                    quota.take(amount)
+                self._num_accepted_requests += 1
+            else:
+                self._num_rejected_requests += 1
+            headers = {}
+            for unit, quota, _ in quotas:
+                headers |= {
+                    f"x-ratelimit-limit-{unit}": str(quota.max_per_minute),
+                    f"x-ratelimit-remaining-{unit}": str(int(quota.level)),
+                    f"x-ratelimit-reset-{unit}": _format_duration(quota.reset),
+                }
+        return accepted, headers
+
+    def delay_chat(self) -> None:
+        if random.random() < self._slow_request_rate:
+            time.sleep(self._slow_request_latency)
+
+    def complete_chat(self, body: dict[str, Any]) -> dict[str, Any]:
+        messages = body["messages"]
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).digest()
+        answer = VALID_ANSWERS[digest[0] % len(VALID_ANSWERS)]
+        num_input_tokens = _count_input_tokens(body["model"], messages)
+        num_cached_input_tokens = self._read_prompt_cache(body["model"], messages)
+        logprobs = None
+        if body.get("logprobs"):
+            # the given answer is the most likely one, the others share the remaining probability
+            answer_probability = .5 + digest[1] / 512
+            top_logprobs = [
+                dict(
+                    token=top_answer,
+                    logprob=math.log(answer_probability if top_answer == answer else
+                                     (1 - answer_probability) / (len(VALID_ANSWERS) - 1)),
+                    bytes=list(top_answer.encode()),
+                )
+                for top_answer in VALID_ANSWERS
+            ][:body.get("top_logprobs", 0)]
+            logprobs = dict(content=[dict(
+                token=answer,
+                logprob=math.log(answer_probability),
+                bytes=list(answer.encode()),
+                top_logprobs=top_logprobs,
+            )])
+        num_choices = body.get("n", 1)
+        # sampled choices differ from each other, but are deterministic as well
+        answers = [answer] + [
+            VALID_ANSWERS[digest[2 + choice_idx % 30] % len(VALID_ANSWERS)] if body.get("temperature", 1) > 0 else answer
+            for choice_idx in range(num_choices - 1)
+        ]
+        return dict(
+            id=f"chatcmpl-{uuid.uuid4().hex}",
+            object="chat.completion",
+            created=int(time.time()),
+            model=body["model"],
+            choices=[
+                dict(index=choice_idx, message=dict(role="assistant", content=choice_answer), finish_reason="length",
+                     logprobs=logprobs)
+                for choice_idx, choice_answer in enumerate(answers)
+            ],
+            usage=dict(
+                prompt_tokens=num_input_tokens,
+                completion_tokens=num_choices,
+                total_tokens=num_input_tokens + num_choices,
+                prompt_tokens_details=dict(cached_tokens=num_cached_input_tokens),
+            ),
+        )
+
+    def create_file(self, filename: str, purpose: str, content: bytes) -> dict[str, Any]:
+        file = dict(
+            id=f"file-{uuid.uuid4().hex}",
+            object="file",
+            bytes=len(content),
+            created_at=int(time.time()),
+            filename=filename,
+            purpose=purpose,
+            status="processed",
+        )
+        with self._lock:
+            self._files[file["id"]] = (file, content)
+        return file
+
+    def get_file_content(self, file_id: str) -> bytes:
+        with self._lock:
+            if file_id not in self._files:
+                raise KeyError(f"unknown file '{file_id}'")
+            return self._files[file_id][1]
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> dict[str, Any]:
+        assert endpoint == "/v1/chat/completions", f"unsupported batch endpoint {endpoint}"
+        outputs = []
+        for line in self.get_file_content(input_file_id).decode().splitlines():
+            request = json.loads(line)
+            outputs.append(dict(
+                id=f"batch_req_{uuid.uuid4().hex}",
+                custom_id=request["custom_id"],
+                response=dict(status_code=HTTPStatus.OK, request_id=uuid.uuid4().hex, body=self.complete_chat(request["body"])),
+                error=None,
+            ))
+        output_file = self.create_file("batch_output.jsonl", "batch_output", "\n".join(map(json.dumps, outputs)).encode())
+        now = int(time.time())
+        batch = dict(
+            id=f"batch_{uuid.uuid4().hex}",
+            object="batch",
+            endpoint=endpoint,
+            input_file_id=input_file_id,
+            completion_window=completion_window,
+            status="completed",
+            output_file_id=output_file["id"],
+            created_at=now,
+            completed_at=now,
+            request_counts=dict(total=len(outputs), completed=len(outputs), failed=0),
+        )
+        with self._lock:
+            self._batches[batch["id"]] = batch
+        return batch
+
+    def get_batch(self, batch_id: str) -> dict[str, Any]:
+        with self._lock:
+            if batch_id not in self._batches:
+                raise KeyError(f"unknown batch '{batch_id}'")
+            return self._batches[batch_id]
+
+    @staticmethod
+    def _update_quota(quota: Optional["_Quota"], max_per_minute: Optional[int]) -> Optional["_Quota"]:
+        if max_per_minute is None:
+            return None
+        if quota is None:
+            return _Quota(max_per_minute)
+        quota.set_max_per_minute(max_per_minute)
+        return quota
+
+    def _read_prompt_cache(self, model_name: str, messages: list[dict[str, Any]]) -> int:
+        """Returns the number of cached tokens of the longest prefix of the messages that was sent before, and caches
+        all prefixes."""
+        prefix_digests = [
+            hashlib.sha256(json.dumps([model_name, messages[:num_messages]], sort_keys=True).encode()).hexdigest()
+            for num_messages in range(1, len(messages) + 1)
+        ]
+        with self._lock:
+            num_cached_messages = max(
+                (num_messages for num_messages, prefix_digest in enumerate(prefix_digests, 1)
+                 if prefix_digest in self._cached_prefixes),
+                default=0,
+            )
+            self._cached_prefixes.update(prefix_digests)
+        num_prefix_tokens = _count_input_tokens(model_name, messages[:num_cached_messages])
+        if num_cached_messages == 0 or num_prefix_tokens < 1024:
+            return 0
+        return 1024 + (num_prefix_tokens - 1024) // 128 * 128
+
+
+class _Quota:
+    """Amount per minute that is refilled continuously, like the quotas of the API. Not thread-safe."""
+
+    def __init__(self, max_per_minute: int):
+        self.max_per_minute = max_per_minute
+        self._level = float(max_per_minute)
+        self._last_refill = time.monotonic()
+
+    @property
+    def level(self) -> float:
+        self._refill()
+        return self._level
+
+    @property
+    def reset(self) -> float:
+        """Seconds until the quota is fully replenished."""
+        return (self.max_per_minute - self.level) / self.max_per_minute * 60
+
+    def has(self, amount: float) -> bool:
+        return self.level >= amount
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self._level -= amount
+
+    def set_max_per_minute(self, max_per_minute: int) -> None:
+        self._refill()
+        self.max_per_minute = max_per_minute
+        self._level = min(self._level, max_per_minute)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.max_per_minute, self._level + (now - self._last_refill) * self.max_per_minute / 60)
+        self._last_refill = now
+
+
+def _format_duration(seconds: float) -> str:
+    # like the API, e.g. "6m0s", "1.5s" or "20ms"
+    if seconds < 1:
+        return f"{round(seconds * 1000)}ms"
+    if seconds < 60:
+        return f"{seconds:.3g}s"
+    return f"{int(seconds // 60)}m{seconds % 60:.3g}s"
+
+
+def _count_input_tokens(model_name: str, messages: list[dict[str, Any]]) -> int:
+    if model_name in OpenAIModel.PRICES:
+        return OpenAIModel.estimate_num_input_tokens(model_name, messages)
+    return sum(3 + sum(len(value.split()) for value in message.values()) for message in messages) + 3
+
+
+def _make_request_handler(server: FakeOpenAIServer) -> type[BaseHTTPRequestHandler]:
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep connections alive
+
+        def do_GET(self) -> None:
+            path = self._split_path()
+            try:
+                if len(path) == 3 and path[0] == "files" and path[2] == "content":
+                    self._respond_bytes(HTTPStatus.OK, server.get_file_content(path[1]), "application/octet-stream")
+                elif len(path) == 2 and path[0] == "batches":
+                    self._respond(HTTPStatus.OK, server.get_batch(path[1]))
+                else:
+                    self._respond(HTTPStatus.NOT_FOUND, dict(error=dict(message=f"unknown path {self.path}")))
+            except KeyError as exc:
+                self._respond(HTTPStatus.NOT_FOUND, dict(error=dict(message=str(exc))))
+
+        def do_POST(self) -> None:
+            path = self._split_path()
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+            try:
+                if path == ["chat", "completions"]:
+                    body = json.loads(data)
+                    accepted, headers = server.take_quota(body)
+                    if not accepted:
+                        self._respond(HTTPStatus.TOO_MANY_REQUESTS, dict(error=dict(
+                            message=f"Rate limit reached for {body['model']}",
+                            type="requests",
+                            param=None,
+                            code="rate_limit_exceeded",
+                        )), headers)
+                        return
+                    server.delay_chat()
+                    self._respond(HTTPStatus.OK, server.complete_chat(body), headers)
+                elif path == ["files"]:
+                    form = self._parse_form(data)
+                    filename, content = form["file"]
+                    self._respond(HTTPStatus.OK, server.create_file(filename, form["purpose"][1].decode(), content))
+                elif path == ["batches"]:
+                    body = json.loads(data)
+                    self._respond(HTTPStatus.OK, server.create_batch(
+                        body["input_file_id"], body["endpoint"], body["completion_window"]
+                    ))
+                else:
+                    self._respond(HTTPStatus.NOT_FOUND, dict(error=dict(message=f"unknown path {self.path}")))
+            except KeyError as exc:
+                self._respond(HTTPStatus.NOT_FOUND, dict(error=dict(message=str(exc))))
+            except Exception as exc:
+                self._respond(HTTPStatus.BAD_REQUEST, dict(error=dict(message=repr(exc))))
+
+        # noinspection PyShadowingBuiltins
+        def log_message(self, format: str, *args: Any) -> None:
+            pass  # requests are far too frequent to be logged
+
+        def _split_path(self) -> list[str]:
+            return self.path.split("?")[0].strip("/").removeprefix("v1").strip("/").split("/")
+
+        def _parse_form(self, data: bytes) -> dict[str, tuple[str, bytes]]:
+            # multipart form data is a MIME message, which only lacks its content type header
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + data
+            )
+            return {
+                part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+                for part in message.iter_parts()
+            }
+
+        def _respond(self, status: HTTPStatus, body: dict, headers: Optional[dict[str, str]] = None) -> None:
+            self._respond_bytes(status, json.dumps(body).encode(), "application/json", headers)
+
+        def _respond_bytes(
+                self,
+                status: HTTPStatus,
+                data: bytes,
+                content_type: str,
+                headers: Optional[dict[str, str]] = None,
+        ) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return RequestHandler
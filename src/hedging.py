@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import numpy as np
+
+T = TypeVar("T")
+
+
+class Hedger:
+    """Sends a duplicate of a request that has not been answered within the given percentile of the recently observed
+    latencies; the first successful reply wins. Both requests are sent (and billed), so callers have to account for the
+    returned number of requests."""
+
+    # number of most recent latencies the hedge delay is computed from, and how many are needed before hedging at all
+    _WINDOW: int = 100
+    _MIN_OBSERVATIONS: int = 10
+
+    def __init__(self, percentile: float):
+        assert 0 < percentile < 100, f"hedge percentile must be between 0 and 100, got {percentile}"
+        self._percentile = percentile
+        self._latencies: deque[float] = deque(maxlen=self._WINDOW)
+        # requests that lost the race keep running in the background, so there are more workers than two per request
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedging")
+        self._num_requests = 0
+        self._num_hedges = 0
+        self._num_hedge_wins = 0
+
+    def call(self, request: Callable[[], T], before_hedge: Callable[[], None]) -> tuple[T, int]:
+        """Send the request, and a duplicate if needed (after calling before_hedge, e.g., to wait for the rate limit).
+        Returns the first successful reply and the number of requests sent."""
+        self._num_requests += 1
+        primary = self._executor.submit(self._timed, request)
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None or wait([primary], timeout=hedge_delay).done:
+            return primary.result(), 1
+
+        before_hedge()
+        if primary.done():
+            # answered while waiting in before_hedge, so the duplicate would only be billed
+            return primary.result(), 1
+        self._num_hedges += 1
+        hedge = self._executor.submit(self._timed, request)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._num_hedge_wins += future is hedge
+                    return future.result(), 2
+        return primary.result(), 2  # both failed, raise the exception of the original request
+
+    async def call_async(self, request: Callable[[], Awaitable[T]], before_hedge: Callable[[], Awaitable[None]]) -> tuple[T, int]:
+        """Like call(), but for requests of an event loop; the request that loses the race is cancelled."""
+        self._num_requests += 1
+        primary = asyncio.ensure_future(self._timed_async(request))
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None:
+            return await primary, 1
+        done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result(), 1
+
+        await before_hedge()
+        if primary.done():
+            # answered while waiting in before_hedge, so the duplicate would only be billed
+            return primary.result(), 1
+        self._num_hedges += 1
+        hedge = asyncio.ensure_future(self._timed_async(request))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._num_hedge_wins += task is hedge
+                        return task.result(), 2
+            return primary.result(), 2  # both failed, raise the exception of the original request
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def report_metrics(self) -> dict[str, float]:
+        return dict(
+            num_hedged_requests=self._num_hedges,
+            hedge_rate=self._num_hedges / max(self._num_requests, 1),
+            hedge_win_rate=self._num_hedge_wins / max(self._num_hedges, 1),
+        )
+
+    def _hedge_delay(self) -> Optional[float]:
+        if len(self._latencies) < self._MIN_OBSERVATIONS:
+            return None
+        return float(np.percentile(self._latencies, self._percentile))
+
+    def _timed(self, request: Callable[[], T]) -> T:
+        start_time = time.perf_counter()
+        result = request()
+        self._latencies.append(time.perf_counter() - start_time)
+        return result
+
+    async def _timed_async(self, request: Callable[[], Awaitable[T]]) -> T:
+        start_time = time.perf_counter()
+        result = await request()
+        self._latencies.append(time.perf_counter() - start_time)
+        return result
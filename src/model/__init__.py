@@ -7,6 +7,9 @@ from .mock import MockModel
 from .model import Model
 from .mpt import MptModel
 from .openai import OpenAIModel
+from .openai_compatible import OpenAICompatibleModel
+from .replay import ReplayModel
+from .served import ServedModel
 from .transformers import TransformersModel
 
 _model_maker_registry: dict[str, Callable[[], Model]] = {}
@@ -73,6 +76,32 @@ for _model_name in OpenAIModel.SUPPORTED_MODELS:
     _register_openai_model(_model_name)
 
 
+@model_maker(OpenAICompatibleModel.NAME)
+@ex.capture
+def _make_openai_compatible_model(openai_compatible_model_id: str, _log: Logger) -> OpenAICompatibleModel:
+    _log.debug(f"creating OpenAI-compatible model '{openai_compatible_model_id}'")
+    return OpenAICompatibleModel()
+
+
+@model_maker(ReplayModel.NAME)
+@ex.capture
+def _make_replay_model(replay_model_name: str, _log: Logger) -> ReplayModel:
+    _log.debug(f"creating replay model of '{replay_model_name}'")
+    return ReplayModel()
+
+
+def _register_served_model(model_name: str) -> None:
+    @model_maker(model_name)
+    @ex.capture
+    def make_served_model(_log: Logger) -> ServedModel:
+        _log.debug(f"creating served model '{model_name}'")
+        return ServedModel(model_name)
+
+
+for _model_name in MptModel.SUPPORTED_MODELS | TransformersModel.SUPPORTED_MODELS | TransformersModel.SUPPORTED_QUANTIZED_MODELS:
+    _register_served_model(f"{_model_name}{ServedModel.SUFFIX}")
+
+
 def _register_transformers_model(model_name: str) -> None:
     @model_maker(model_name)
     @ex.capture
@@ -81,7 +110,7 @@ def _register_transformers_model(model_name: str) -> None:
         return TransformersModel(model_name)
 
 
-for _model_name in TransformersModel.SUPPORTED_MODELS:
+for _model_name in TransformersModel.SUPPORTED_MODELS | TransformersModel.SUPPORTED_QUANTIZED_MODELS:
     _register_transformers_model(_model_name)
 
 __all__ = [
@@ -1,21 +1,42 @@
+import asyncio
+import fcntl
+import json
 import logging
 import os
+import tempfile
+import threading
 from logging import Logger
-from typing import Final
+from typing import Any, Final, Optional
 
 import google.generativeai as genai
-from google.api_core.exceptions import InternalServerError
+from google.api_core.exceptions import InternalServerError, ResourceExhausted, ServiceUnavailable
 from google.generativeai.types import BlockedPromptException, HarmBlockThreshold, HarmCategory
-from tenacity import retry, after_log, before_sleep_log, retry_if_exception_type, stop_after_attempt
 
+import path_util
 from api_usage import APIUsage
 from experiment import ex
+from hedging import Hedger
 from noop import NoOp
 from rate_limit import RateLimit
+from retry_policy import RetryBudget, RetryPolicy
 from util import LogSessionStateDetailsException, UnexpectedAnswerException
 from .model import Model
 
 
+# like for OpenAI, requests are retried until they are within the rate limit, but errors of the API only a few times
+_RETRY_POLICY: Final[RetryPolicy] = RetryPolicy(
+    "google",
+    RetryBudget(ResourceExhausted, max_attempts=None, min_wait=1, max_wait=60, trips_circuit=True),
+    RetryBudget((InternalServerError, ServiceUnavailable), max_attempts=10, min_wait=1, max_wait=60, trips_circuit=True),
+)
+
+_GENERATION_CONFIG: Final[dict[str, Any]] = dict(
+    candidate_count=1,  # generate a single completion
+    max_output_tokens=2,  # generate at most one token (we just want a single number, 1 or 2)
+    temperature=0,
+)
+
+
 class GoogleModel(Model):
     SUPPORTED_MODELS: Final[set[str]] = {
         # https://ai.google.dev/models/gemini
@@ -23,66 +44,203 @@ class GoogleModel(Model):
     }
 
     _model_name: str
+    _hedger: Optional[Hedger]
+    _rate_limit: RateLimit
 
+    _model: Optional[genai.GenerativeModel] = None
+    _priming_reply: Optional[str] = None
     _chat: genai.ChatSession
 
-    def __init__(self, model_name: str):
+    @ex.capture
+    def __init__(
+            self,
+            model_name: str,
+            num_samples: int,
+            hedge_percentile: Optional[float],
+            google_max_requests_per_minute: int,
+            rate_limit_scope: str,
+    ):
         super().__init__()
+        # gemini-1.0-pro only returns a single candidate per request
+        assert num_samples == 1, "Google models do not support sampling several answers per request"
         self._model_name = model_name
+        self._hedger = None if hedge_percentile is None else Hedger(hedge_percentile)
+        # without a local tokenizer, the tokens of a request are not known in advance, so only requests are limited; the
+        # SDK does not expose the rate limit headers either, so the rate is adapted to the requests that are rejected
+        self._rate_limit = RateLimit.get("google", model_name, google_max_requests_per_minute, scope=rate_limit_scope)
+        # sessions that are started concurrently wait for the first one to build the model and fetch the priming reply
+        self._start_chat_lock = threading.Lock()
         logging.getLogger("httpx").setLevel(logging.WARNING)  # reduce logging verbosity
 
-    def prompt(self, prompt: str) -> str:
-        return self._fetch(prompt)
+    def _prompt(self, prompt: str) -> str:
+        return self._fetch(self._chat, prompt)
 
-    @ex.capture
-    def reset(self, language: str, _log: Logger) -> None:
+    def _reset(self) -> None:
+        self._chat = self._start_chat()
+
+    def _cache_scope(self) -> Optional[dict[str, Any]]:
+        # every chat continues from the stored reply to the system prompt, which the replies depend on as well
+        return dict(model_name=self._model_name, priming_reply=self._priming_reply, **_GENERATION_CONFIG)
+
+    def _replay(self, prompt: str, reply: str) -> None:
+        self._chat.history = [*self._chat.history, dict(role="user", parts=[prompt]), dict(role="model", parts=[reply])]
+
+    def new_session(self) -> genai.ChatSession:
+        return self._start_chat()
+
+    async def new_session_async(self) -> genai.ChatSession:
+        if self._priming_reply is None and not self.dry_run:
+            # the priming reply might have to be fetched, which is a blocking call
+            return await asyncio.to_thread(self._start_chat)
+        return self._start_chat()
+
+    async def prompt_session_async(self, session: genai.ChatSession, prompt: str) -> str:
+        return await self._fetch_async(session, prompt)
+
+    def report_session_api_usage(self, session: genai.ChatSession) -> APIUsage:
+        return self.report_api_usage()
+
+    def report_api_usage(self) -> APIUsage:
+        return APIUsage(self._model_name, -1, -1, 0.)
+
+    def report_metrics(self) -> dict[str, float]:
+        metrics = {f"google_{name}": value for name, value in self._rate_limit.report_metrics().items()}
+        if self._hedger is not None:
+            metrics.update({f"google_{name}": value for name, value in self._hedger.report_metrics().items()})
+        return metrics
+
+    def _start_chat(self) -> genai.ChatSession:
         if self.dry_run:
             # make sure no real API calls are made in dry run
             # noinspection PyTypeChecker
-            self._chat = NoOp()
-        else:
-            api_key = os.getenv("GOOGLE_API_KEY")
-            assert api_key, "GOOGLE_API_KEY environment variable not set or empty"
-            genai.configure(api_key=api_key)
-            self._chat = genai.GenerativeModel(
-                self._model_name,
-                safety_settings={
-                    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                },
-                generation_config=genai.GenerationConfig(
-                    candidate_count=1,  # generate a single completion
-                    max_output_tokens=2,  # generate at most one token (we just want a single number, 1 or 2)
-                    temperature=0,
-                ),
-            ).start_chat()
-        system_prompt_response = self._fetch(self.system_prompt)
-        _log.debug(f"system prompt response: {system_prompt_response}")
+            return NoOp()
+        with self._start_chat_lock:
+            if self._model is None:
+                # the configured model is built once; each session only starts a new chat with it
+                api_key = os.getenv("GOOGLE_API_KEY")
+                assert api_key, "GOOGLE_API_KEY environment variable not set or empty"
+                genai.configure(api_key=api_key)
+                self._model = genai.GenerativeModel(
+                    self._model_name,
+                    safety_settings={
+                        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+                        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+                        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+                        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+                    },
+                    generation_config=genai.GenerationConfig(**_GENERATION_CONFIG),
+                )
+            # the chat starts with the system prompt and the model's reply to it, as if the system prompt had just been
+            # sent
+            priming_history = make_priming_history(self.system_prompt, self._get_priming_reply())
+        return self._model.start_chat(history=priming_history)
 
-    def report_api_usage(self) -> APIUsage:
-        return APIUsage(self._model_name, -1, -1, 0.)
+    @ex.capture
+    def _get_priming_reply(self, _log: Logger) -> str:
+        """The reply of the model to the system prompt. It is fetched only once per model and language and then stored
+        for all runs of the host, which saves an API call per session."""
+        if self._priming_reply is None:
+            priming_reply = _load_priming_replies().get(self._model_name, {}).get(self.language)
+            if priming_reply is None:
+                priming_reply = self._fetch(self._model.start_chat(), self.system_prompt)
+                _log.info(f"system prompt response: {priming_reply}")
+                priming_reply = _store_priming_reply(self._model_name, self.language, priming_reply)
+            self._priming_reply = priming_reply
+        return self._priming_reply
 
-    @retry(
-        after=after_log(logging.root, logging.WARNING),
-        before_sleep=before_sleep_log(logging.root, logging.INFO),
-        retry=retry_if_exception_type(InternalServerError),
-        stop=stop_after_attempt(10),
-    )
+    @_RETRY_POLICY
     @ex.capture
-    def _fetch(self, prompt: str, _log: Logger) -> str:
+    def _fetch(self, chat: genai.ChatSession, prompt: str, _log: Logger) -> str:
         if not self.dry_run:
-            RateLimit.wait(60, 60)
+            self._rate_limit.wait()
         if self.dry_run:
             return "?"  # dry run, return a placeholder
         try:
-            response = self._chat.send_message(prompt)
+            response = self._send(chat, prompt)
+        except ResourceExhausted:
+            self._rate_limit.throttle()
+            raise
         except BlockedPromptException as exc:
             _log.warning(f"blocked prompt {prompt}: {exc}")
             raise LogSessionStateDetailsException() from exc
+        self._rate_limit.recover()
+        return self._parse_response(response)
+
+    @_RETRY_POLICY
+    @ex.capture
+    async def _fetch_async(self, chat: genai.ChatSession, prompt: str, _log: Logger) -> str:
+        if not self.dry_run:
+            await self._rate_limit.wait_async()
+        if self.dry_run:
+            return "?"  # dry run, return a placeholder
+        try:
+            response = await self._send_async(chat, prompt)
+        except ResourceExhausted:
+            self._rate_limit.throttle()
+            raise
+        except BlockedPromptException as exc:
+            _log.warning(f"blocked prompt {prompt}: {exc}")
+            raise LogSessionStateDetailsException() from exc
+        self._rate_limit.recover()
+        return self._parse_response(response)
+
+    def _send(self, chat: genai.ChatSession, prompt: str) -> genai.types.GenerateContentResponse:
+        if self._hedger is None:
+            return chat.send_message(prompt)
+
+        def send() -> tuple[genai.types.GenerateContentResponse, genai.ChatSession]:
+            # each request continues its own copy of the chat, and the chat is continued like the one that won the race
+            chat_copy = self._model.start_chat(history=chat.history)
+            return chat_copy.send_message(prompt), chat_copy
+
+        (response, chat_copy), _ = self._hedger.call(send, self._rate_limit.wait)
+        chat.history = chat_copy.history
+        return response
+
+    async def _send_async(self, chat: genai.ChatSession, prompt: str) -> genai.types.GenerateContentResponse:
+        if self._hedger is None:
+            return await chat.send_message_async(prompt)
+
+        async def send() -> tuple[genai.types.GenerateContentResponse, genai.ChatSession]:
+            chat_copy = self._model.start_chat(history=chat.history)
+            return await chat_copy.send_message_async(prompt), chat_copy
+
+        (response, chat_copy), _ = await self._hedger.call_async(send, self._rate_limit.wait_async)
+        chat.history = chat_copy.history
+        return response
+
+    @ex.capture
+    def _parse_response(self, response: genai.types.GenerateContentResponse, _log: Logger) -> str:
         if response.parts:
             return response.text
         else:
             _log.warning(f"unexpected response: {response}")
             raise UnexpectedAnswerException()
+
+
+def _load_priming_replies() -> dict[str, dict[str, str]]:
+    if not path_util.gemini_priming_replies_path.exists():
+        return {}
+    with open(path_util.gemini_priming_replies_path) as f:
+        return json.load(f)
+
+
+def _store_priming_reply(model_name: str, language: str, priming_reply: str) -> str:
+    """Stores the priming reply and returns it, or the one that a concurrent run has stored in the meantime, such that all
+    runs use the same one. The file is updated under a lock and replaced atomically, so no reply is lost and readers
+    never see a partially written file."""
+    path = path_util.gemini_priming_replies_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+        priming_replies = _load_priming_replies()
+        priming_reply = priming_replies.setdefault(model_name, {}).setdefault(language, priming_reply)
+        with tempfile.NamedTemporaryFile("w", dir=path.parent, suffix=".tmp", delete=False) as f:
+            json.dump(priming_replies, f, indent=2, ensure_ascii=False)
+        os.replace(f.name, path)
+    return priming_reply
+
+
+def make_priming_history(system_prompt: str, priming_reply: str) -> list[dict]:
+    """Chat history of a session after sending the system prompt and receiving the given reply."""
+    return [dict(role="user", parts=[system_prompt]), dict(role="model", parts=[priming_reply])]
@@ -0,0 +1,438 @@
+import copy
+import re
+from abc import abstractmethod
+from dataclasses import dataclass, field
+from enum import StrEnum
+from logging import Logger
+from typing import Any, Optional
+
+import torch
+import transformers
+from transformers import PreTrainedTokenizerBase
+
+from api_usage import APIUsage
+from experiment import ex
+from util import SAMPLE_POLICIES, VALID_ANSWERS, choose_sample
+from .model import Model, load_system_prompt
+
+
+class ChatRole(StrEnum):
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+
+
+@dataclass
+class ChatMessage:
+    role: ChatRole
+    content: str
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+class TokenBuffer:
+    """Token IDs of a templated chat that grows with the chat. Instead of tokenizing the whole chat, only the text after
+    the last special token is (re-)tokenized. As tokenizers split off special tokens before tokenizing the text in between,
+    the token IDs up to the last special token never change when text is appended."""
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase):
+        self._tokenizer = tokenizer
+        self._clear()
+
+        added_tokens = tokenizer.added_tokens_decoder
+        self._special_token_ids = set(added_tokens.keys())
+        # match longer tokens first, and include whitespace that is stripped by the tokens
+        self._special_tokens_pattern = re.compile("|".join(
+            (r"\s*" if token.lstrip else "") + re.escape(token.content) + (r"\s*" if token.rstrip else "")
+            for token in sorted(added_tokens.values(), key=lambda token: len(token.content), reverse=True)
+        ) or r"(?!)")
+
+    @property
+    def input_ids(self) -> list[int]:
+        return self._input_ids
+
+    def update(self, text: str) -> list[int]:
+        """Update the buffer to the given text and return its token IDs. If the previous text is a prefix of the text (which
+        is the case for chat templates when messages are appended), only the appended text is tokenized."""
+
+        if not text.startswith(self._text):
+            self._clear()
+        return self.append(text[len(self._text):])
+
+    def append(self, text: str) -> list[int]:
+        """Append the given text to the buffer and return the token IDs of the whole text; only the appended text (and the
+        text after the last special token before it) is tokenized."""
+        self._tokenize_tail(self._tail + text)
+        self._text += text
+        return self._input_ids
+
+    def _clear(self) -> None:
+        self._text = ""
+        self._input_ids: list[int] = []
+
+        # number of token IDs up to (and including) the last special token, the special token itself, and the text after it
+        self._num_stable_input_ids = 0
+        self._anchor = ""
+        self._tail = ""
+
+    def _tokenize_tail(self, tail: str) -> None:
+        # the tail is tokenized after its preceding special token such that it is tokenized as in the whole text (e.g., no
+        # prefix space is added by sentencepiece tokenizers that only add it at the beginning of the text)
+        anchor_input_ids = self._tokenize(self._anchor)
+        tail_input_ids = self._tokenize(self._anchor + tail)[len(anchor_input_ids):]
+        del self._input_ids[self._num_stable_input_ids:]
+        self._input_ids.extend(tail_input_ids)
+
+        special_token_matches = list(self._special_tokens_pattern.finditer(tail))
+        special_token_positions = [i for i, input_id in enumerate(tail_input_ids) if input_id in self._special_token_ids]
+        if special_token_matches and len(special_token_matches) == len(special_token_positions):
+            self._num_stable_input_ids += special_token_positions[-1] + 1
+            self._anchor = special_token_matches[-1].group()
+            self._tail = tail[special_token_matches[-1].end():]
+        else:
+            self._tail = tail
+
+    def _tokenize(self, text: str) -> list[int]:
+        if not text:
+            return []
+        # the text-generation pipeline does not add special tokens either, the chat template takes care of them
+        return self._tokenizer(text, add_special_tokens=False)["input_ids"]
+
+
+class ChatTemplate:
+    """Renders the chat template of a tokenizer incrementally. The messages that are appended to a chat are rendered after
+    a short reference chat that ends like every rendered chat (with a user message and the generation prompt), and the
+    text they add to it is appended to the chat, instead of rendering the whole chat again every turn. Templates that
+    render the appended messages differently (i.e., the reference is no prefix) are rendered whole."""
+
+    # a whole exchange precedes the appended messages, such that they are rendered like later turns (e.g., Llama 2 merges
+    # the system prompt into the first user message)
+    _REFERENCE: list[ChatMessage] = [
+        ChatMessage(ChatRole.SYSTEM, "system"),
+        ChatMessage(ChatRole.USER, "user"),
+        ChatMessage(ChatRole.ASSISTANT, "assistant"),
+        ChatMessage(ChatRole.USER, "user"),
+    ]
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase):
+        self._tokenizer = tokenizer
+        self._reference_text = self.render(self._REFERENCE)
+
+    def render(self, messages: list[ChatMessage]) -> str:
+        """The whole chat, followed by the generation prompt."""
+        return self._tokenizer.apply_chat_template(
+            [msg.to_dict() for msg in messages],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+
+    def render_continuation(self, messages: list[ChatMessage]) -> Optional[str]:
+        """The text that the given messages (starting with the assistant's reply) and the generation prompt append to a
+        rendered chat, or None if the template does not render them independently of the chat before."""
+        text = self.render(self._REFERENCE + messages)
+        if not text.startswith(self._reference_text):
+            return None
+        return text[len(self._reference_text):]
+
+
+@dataclass
+class LocalSession:
+    language: str
+    history: list[ChatMessage]
+    token_buffer: TokenBuffer
+
+    # number of messages of the history whose token IDs are in token_buffer
+    num_templated_messages: int = 0
+    # token IDs whose keys/values are stored in past_key_values (only used with kv_cache)
+    cached_input_ids: list[int] = field(default_factory=list)
+    past_key_values: Optional[Any] = None
+
+    def update_input_ids(self, chat_template: ChatTemplate) -> list[int]:
+        """Template and tokenize only the messages that were added to the history since the last call, and return the
+        token IDs of the whole session, followed by the generation prompt."""
+        continuation = None
+        if self.num_templated_messages > 0:
+            continuation = chat_template.render_continuation(self.history[self.num_templated_messages:])
+        if continuation is None:
+            # the first turn, or a template that cannot be rendered incrementally
+            self.token_buffer.update(chat_template.render(self.history))
+        else:
+            self.token_buffer.append(continuation)
+        self.num_templated_messages = len(self.history)
+        return self.token_buffer.input_ids
+
+
+@dataclass
+class SystemPromptCache:
+    # token IDs of the templated system prompt (the part that is identical across all sessions)
+    input_ids: list[int]
+    past_key_values: Optional[Any]
+    num_bytes: int
+    num_hits: int = 0
+    num_misses: int = 1  # the cache is built on the first miss
+    num_invalidations: int = 0
+
+
+class LocalModel(Model):
+    """Base class for models that are run locally using Hugging Face transformers."""
+
+    # number of trailing prompt tokens to decode alongside a generated token (see _decode_continuation)
+    _DECODE_CONTEXT = 8
+
+    _model_config: dict[str, str]
+
+    # shared across all instances of the process, keyed by (model name, language)
+    _system_prompt_caches: dict[tuple[str, str], SystemPromptCache] = {}
+
+    _model_name: str
+    _kv_cache: bool
+    _system_prompt_cache: bool
+    _answer_mode: str
+    _num_samples: int
+    _sample_policy: str
+    _sampling_temperature: float
+
+    _pipe: transformers.Pipeline
+    _sessions: list[LocalSession]
+
+    @ex.capture
+    def __init__(
+            self,
+            model_name: str,
+            kv_cache: bool,
+            system_prompt_cache: bool,
+            answer_mode: str,
+            num_samples: int,
+            sample_policy: str,
+            sampling_temperature: float,
+    ):
+        super().__init__()
+        assert answer_mode in {"generate", "score"}, f"unsupported answer mode '{answer_mode}'"
+        assert sample_policy in SAMPLE_POLICIES, f"unsupported sample policy '{sample_policy}'"
+        assert num_samples == 1 or answer_mode == "generate", "answers can only be sampled in answer mode 'generate'"
+        self._model_name = model_name
+        self._kv_cache = kv_cache
+        self._system_prompt_cache = system_prompt_cache
+        self._answer_mode = answer_mode
+        self._num_samples = num_samples
+        self._sample_policy = sample_policy
+        self._sampling_temperature = sampling_temperature
+        self._init_model()
+
+        # batched sessions are left-padded such that the next token of all sessions is predicted at the last position
+        tokenizer = self._pipe.tokenizer
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        self._answer_token_ids = [tokenizer.convert_tokens_to_ids(answer) for answer in VALID_ANSWERS]
+        assert tokenizer.unk_token_id not in self._answer_token_ids, f"answers {VALID_ANSWERS} are not single tokens"
+        self._chat_template = ChatTemplate(tokenizer)
+
+    @classmethod
+    @abstractmethod
+    def load_tokenizer(cls, model_name: str) -> PreTrainedTokenizerBase:
+        """Load the tokenizer (including the chat template) of the model with the given name."""
+
+    @classmethod
+    @abstractmethod
+    def context_window(cls, model_name: str) -> int:
+        """Maximum number of tokens (prompt and generation) the model with the given name supports."""
+
+    @abstractmethod
+    def _init_model(self) -> None:
+        """Load the model and tokenizer into self._pipe."""
+
+    def _prompt(self, prompt: str) -> str:
+        return self.prompt_batch([prompt])[0]
+
+    def _reset(self) -> None:
+        self.reset_batch(1)
+
+    def _cache_scope(self) -> Optional[dict[str, Any]]:
+        if self._num_samples > 1:
+            return None
+        return dict(model_name=self._model_name, answer_mode=self._answer_mode)
+
+    def _replay(self, prompt: str, reply: str) -> None:
+        # with kv_cache, the tokens of the replayed turn are run through the model along with the next prompt
+        self._sessions[0].history += [ChatMessage(ChatRole.USER, prompt), ChatMessage(ChatRole.ASSISTANT, reply)]
+
+    def prompt_batch(self, prompts: list[str]) -> list[str]:
+        assert len(prompts) == len(self._sessions), f"expected {len(self._sessions)} prompts, got {len(prompts)}"
+        return self.prompt_sessions(self._sessions, prompts)
+
+    def reset_batch(self, batch_size: int) -> None:
+        self._sessions = [self.new_session() for _ in range(batch_size)]
+
+    def new_session(self, language: Optional[str] = None) -> LocalSession:
+        """Create a session in the given language (defaults to the model's language) that is independent of the model's
+        own sessions. To be played with prompt_sessions()."""
+
+        language = language or self.language
+        system_prompt = self.system_prompt if language == self.language else load_system_prompt(language)
+        session = LocalSession(language, [ChatMessage(ChatRole.SYSTEM, system_prompt)], TokenBuffer(self._pipe.tokenizer))
+        if self._kv_cache and self._system_prompt_cache:
+            cache = self._get_system_prompt_cache(language, system_prompt)
+            # start from a copy so that the cache is never modified by the session
+            session.cached_input_ids = list(cache.input_ids)
+            session.past_key_values = copy.deepcopy(cache.past_key_values)
+        return session
+
+    def prompt_sessions(self, sessions: list[LocalSession], prompts: list[str]) -> list[str]:
+        """Prompt each of the given sessions with the respective prompt, processing all sessions at once."""
+
+        for session, prompt in zip(sessions, prompts):
+            session.history.append(ChatMessage(ChatRole.USER, prompt))
+        messages = self._complete(sessions)
+        for session, message in zip(sessions, messages):
+            session.history.append(ChatMessage(ChatRole.ASSISTANT, message))
+        return messages
+
+    def report_api_usage(self) -> APIUsage:
+        return APIUsage(self._model_name, -1, -1, 0.)
+
+    def report_metrics(self) -> dict[str, float]:
+        # the caches are shared by all instances, but only those that use them report them
+        if not (self._kv_cache and self._system_prompt_cache):
+            return {}
+        caches = [cache for (model_name, _), cache in self._system_prompt_caches.items() if model_name == self._model_name]
+        if not caches:
+            return {}
+        num_hits = sum(cache.num_hits for cache in caches)
+        num_misses = sum(cache.num_misses for cache in caches)
+        return {
+            "system_prompt_cache.hits": num_hits,
+            "system_prompt_cache.misses": num_misses,
+            "system_prompt_cache.invalidations": sum(cache.num_invalidations for cache in caches),
+            "system_prompt_cache.hit_rate": num_hits / (num_hits + num_misses),
+            "system_prompt_cache.num_tokens": sum(len(cache.input_ids) for cache in caches),
+            "system_prompt_cache.num_bytes": sum(cache.num_bytes for cache in caches),
+        }
+
+    def _complete(self, sessions: list[LocalSession]) -> list[str]:
+        self._answer_probabilities = [None for _ in sessions]
+        input_ids = [session.update_input_ids(self._chat_template) for session in sessions]
+        logits = self._next_token_logits(sessions, input_ids)
+        if self._answer_mode == "score":
+            # one forward pass is enough to decide between the answers, and off-format answers are impossible; the
+            # probabilities are normalized over the answers (like for OpenAI models), not over the whole vocabulary
+            answer_probabilities = logits.float()[:, self._answer_token_ids].softmax(dim=-1).tolist()
+            self._answer_probabilities = [dict(zip(VALID_ANSWERS, probabilities)) for probabilities in answer_probabilities]
+            return [max(probabilities, key=probabilities.get) for probabilities in self._answer_probabilities]
+        if self._num_samples > 1:
+            # the answer is a single token, so sampling it from the logits is equivalent to sampling whole sequences
+            probabilities = (logits.float() / self._sampling_temperature).softmax(dim=-1)
+            sampled_token_ids = torch.multinomial(probabilities, self._num_samples, replacement=True).tolist()
+            answers = []
+            for session_idx, (session_input_ids, session_token_ids) in enumerate(zip(input_ids, sampled_token_ids)):
+                answer, self._answer_probabilities[session_idx] = choose_sample(
+                    [self._decode_continuation(session_input_ids, token_id) for token_id in session_token_ids],
+                    self._sample_policy,
+                )
+                answers.append(answer)
+            return answers
+        return [
+            self._decode_continuation(session_input_ids, int(session_logits.argmax()))
+            for session_input_ids, session_logits in zip(input_ids, logits)
+        ]
+
+    def _next_token_logits(self, sessions: list[LocalSession], input_ids: list[list[int]]) -> torch.Tensor:
+        """Compute the logits of the token following each session's input_ids. Greedily picking the maximum is
+        equivalent to generating a single token with the text-generation pipeline."""
+
+        if self._kv_cache:
+            return torch.stack([
+                self._forward_incremental(session, session_input_ids)
+                for session, session_input_ids in zip(sessions, input_ids)
+            ])
+        return self._forward_padded(input_ids)
+
+    def _forward_incremental(self, session: LocalSession, input_ids: list[int]) -> torch.Tensor:
+        # only run the tokens that are not yet in the session's key/value cache through the model, making the prefill
+        # linear in the session length
+        num_cached_input_ids = len(session.cached_input_ids)
+        if input_ids[:num_cached_input_ids] != session.cached_input_ids:
+            # tokens merged across the boundary of the previous prompt, so the cache is no longer valid
+            if len(session.history) == 2 and self._system_prompt_cache:
+                self._system_prompt_caches[(self._model_name, session.language)].num_invalidations += 1
+            session.past_key_values = None
+            num_cached_input_ids = 0
+        assert num_cached_input_ids < len(input_ids), "no new tokens to process"
+
+        model = self._pipe.model
+        with torch.inference_mode():
+            outputs = model(
+                input_ids=torch.tensor([input_ids[num_cached_input_ids:]], device=model.device),
+                attention_mask=torch.ones((1, len(input_ids)), dtype=torch.long, device=model.device),
+                past_key_values=session.past_key_values,
+                use_cache=True,
+            )
+        session.past_key_values = outputs.past_key_values
+        session.cached_input_ids = list(input_ids)
+        return outputs.logits[0, -1]
+
+    def _forward_padded(self, input_ids: list[list[int]]) -> torch.Tensor:
+        # all sequences are processed in a single, left-padded forward pass
+        model = self._pipe.model
+        inputs = self._pipe.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(model.device)
+        with torch.inference_mode():
+            outputs = model(**inputs, use_cache=False)
+        return outputs.logits[:, -1]
+
+    @ex.capture
+    def _get_system_prompt_cache(self, language: str, system_prompt: str, _log: Logger) -> SystemPromptCache:
+        key = (self._model_name, language)
+        if (cache := self._system_prompt_caches.get(key)) is not None:
+            cache.num_hits += 1
+            return cache
+
+        # Some templates (e.g., Llama 2) merge the system prompt into the first user message, so the templated system
+        # prompt is determined as the common prefix of two sessions that differ in their first user message. The last
+        # common token is dropped as it might merge with the actual user message.
+        input_ids_a, input_ids_b = (
+            self._pipe.tokenizer.apply_chat_template(
+                [ChatMessage(ChatRole.SYSTEM, system_prompt).to_dict(), ChatMessage(ChatRole.USER, content).to_dict()],
+                add_generation_prompt=True,
+            )
+            for content in ("a", "b")
+        )
+        num_common_input_ids = 0
+        for input_id_a, input_id_b in zip(input_ids_a, input_ids_b):
+            if input_id_a != input_id_b:
+                break
+            num_common_input_ids += 1
+        input_ids = input_ids_a[:max(num_common_input_ids - 1, 0)]
+
+        past_key_values = None
+        if input_ids:
+            model = self._pipe.model
+            with torch.inference_mode():
+                past_key_values = model(
+                    input_ids=torch.tensor([input_ids], device=model.device),
+                    use_cache=True,
+                ).past_key_values
+        cache = SystemPromptCache(input_ids, past_key_values, _num_bytes(past_key_values))
+        _log.info(f"cached {len(input_ids)} system prompt tokens for {key} ({cache.num_bytes / 2 ** 20:.1f} MiB)")
+        self._system_prompt_caches[key] = cache
+        return cache
+
+    def _decode_continuation(self, input_ids: list[int], token_id: int) -> str:
+        # The pipeline decodes prompt and prompt+generation and strips the former from the latter. Decoding only the
+        # tail of the prompt gives the same result (decoding only differs at the very start) in constant time.
+        tokenizer = self._pipe.tokenizer
+        context = input_ids[-self._DECODE_CONTEXT:]
+        prompt_text = tokenizer.decode(context, skip_special_tokens=True)
+        text = tokenizer.decode(context + [token_id], skip_special_tokens=True)
+        return text[len(prompt_text):]
+
+
+def _num_bytes(past_key_values: Any) -> int:
+    if past_key_values is None:
+        return 0
+    if isinstance(past_key_values, torch.Tensor):
+        return past_key_values.numel() * past_key_values.element_size()
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return sum(_num_bytes(item) for item in past_key_values)
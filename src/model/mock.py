@@ -10,10 +10,10 @@ class MockModel(Model):
         self._generator = np.random.default_rng(seed=0)
 
     # noinspection PyUnusedLocal,PyMethodMayBeStatic
-    def prompt(self, prompt: str) -> str:
+    def _prompt(self, prompt: str) -> str:
         return self._generator.choice(["1", "2"])
 
-    def reset(self) -> None:
+    def _reset(self) -> None:
         pass
 
     def report_api_usage(self) -> APIUsage:
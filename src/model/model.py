@@ -3,17 +3,20 @@ import logging
 import os
 import warnings
 from abc import ABC, abstractmethod
+from typing import Any, Optional
 
 import path_util
 from api_usage import APIUsage
 from experiment import ex
+from response_cache import ResponseCache
+from util import VALID_ANSWERS
 
 
 class Model(ABC):
     """Abstract base class for LLMs."""
 
     @ex.capture
-    def __init__(self, language: str, _log: logging.Logger) -> None:
+    def __init__(self, language: str, response_cache: bool, response_cache_max_entries: int, _log: logging.Logger) -> None:
         self._dry_run = not bool(os.getenv("NO_DRY_RUN", False))
         if not self.dry_run:
             warnings.warn(
@@ -21,32 +24,128 @@ class Model(ABC):
                 f"FIRST TO GET AN ESTIMATE!"
             )
 
-        with open(path_util.data_dir / "system_prompts.json") as f:
-            system_prompts = json.load(f)
-        system_prompt = system_prompts.get(language)
-        assert system_prompt, f"no system prompt for language '{language}'"
-        self._system_prompt = system_prompt
+        self._system_prompt = load_system_prompt(language)
+        self._language = language
+
+        self._answer_probabilities: list[Optional[dict[str, float]]] = [None]
 
         self._num_input_tokens = 0
         self._num_output_tokens = 0
         self._calls = []
 
-    @abstractmethod
+        # placeholder replies of a dry run are not cached; the cache is only opened (and created) by the first prompt that
+        # can be cached, such that backends that never use it do not touch it
+        self._use_response_cache = response_cache and not self.dry_run
+        self._response_cache_max_entries = response_cache_max_entries
+        self._response_cache: Optional[ResponseCache] = None
+        # prompts and replies of the current session, which (with the system prompt) determine the next reply
+        self._transcript: list[str] = []
+
     def prompt(self, prompt: str) -> str:
-        """Prompts the model."""
+        """Prompts the model. If the model supports it (see _cache_scope), the reply is looked up in the response cache
+        first, such that the same session is never prompted twice."""
+        scope = self._cache_scope() if self._use_response_cache else None
+        if scope is None:
+            return self._prompt(prompt)
+        if self._response_cache is None:
+            self._response_cache = ResponseCache.get(path_util.response_cache_path, self._response_cache_max_entries)
+        history = self._transcript + [prompt]
+        key = ResponseCache.key(scope | dict(backend=type(self).__name__, system_prompt=self.system_prompt), history)
+        cached = self._response_cache.lookup(key)
+        if cached is not None:
+            reply, answer_probabilities = cached
+            self._replay(prompt, reply)
+            self._answer_probabilities = [answer_probabilities]
+        else:
+            reply = self._prompt(prompt)
+            # unexpected replies are not cached, such that a retry of the session asks the model again
+            if reply in VALID_ANSWERS:
+                self._response_cache.store(key, reply, self._answer_probabilities[0])
+        self._transcript = history + [reply]
+        return reply
 
-    @abstractmethod
     def reset(self) -> None:
         """Reset the model (e.g., to start a new session)."""
+        self._transcript = []
+        self._reset()
+
+    @abstractmethod
+    def _prompt(self, prompt: str) -> str:
+        """Prompts the model, bypassing the response cache."""
+
+    @abstractmethod
+    def _reset(self) -> None:
+        """See reset()."""
+
+    def _cache_scope(self) -> Optional[dict[str, Any]]:
+        """The backend-specific part of the response cache key: the model and its generation parameters. None if the
+        replies cannot be cached, because they are sampled or the history of the session is not kept locally."""
+        return None
+
+    def _replay(self, prompt: str, reply: str) -> None:
+        """Continue the session with the given prompt and (cached) reply as if the model had been prompted."""
+        raise NotImplementedError(f"{type(self).__name__} does not support the response cache")
+
+    def prompt_batch(self, prompts: list[str]) -> list[str]:
+        """Prompts each of the sessions started with reset_batch() with the respective prompt."""
+        raise NotImplementedError(f"{type(self).__name__} does not support batched sessions")
+
+    def reset_batch(self, batch_size: int) -> None:
+        """Reset the model to play batch_size sessions in lockstep."""
+        raise NotImplementedError(f"{type(self).__name__} does not support batched sessions")
+
+    def new_session(self) -> Any:
+        """Start a session that is independent of all others, to be prompted with prompt_session_async()."""
+        raise NotImplementedError(f"{type(self).__name__} does not support concurrent sessions")
+
+    async def new_session_async(self) -> Any:
+        """Like new_session(), but for sessions that are started while others are prompted concurrently, such that
+        backends whose sessions cannot be started without blocking calls can keep them off the event loop."""
+        return self.new_session()
+
+    async def prompt_session_async(self, session: Any, prompt: str) -> str:
+        """Prompts the given session; many sessions can be prompted concurrently."""
+        raise NotImplementedError(f"{type(self).__name__} does not support concurrent sessions")
+
+    def session_answer_probabilities(self, session: Any) -> Optional[dict[str, float]]:
+        """Probabilities of the possible answers to the last prompt of the given session, or None if the model does not
+        provide them."""
+        return None
+
+    def report_session_api_usage(self, session: Any) -> APIUsage:
+        """Report the API usage of the given session alone."""
+        raise NotImplementedError(f"{type(self).__name__} does not support concurrent sessions")
 
     @abstractmethod
     def report_api_usage(self) -> APIUsage:
         ...
 
+    def report_metrics(self) -> dict[str, float]:
+        """Report model-specific metrics (e.g., cache statistics) to be logged with the run."""
+        return {}
+
     @property
     def dry_run(self) -> bool:
         return self._dry_run
 
+    @property
+    def answer_probabilities(self) -> list[Optional[dict[str, float]]]:
+        """Probabilities of the possible answers to the last prompt of each session (a single one unless batched), or
+        None if the model does not provide them."""
+        return self._answer_probabilities
+
+    @property
+    def language(self) -> str:
+        return self._language
+
     @property
     def system_prompt(self) -> str:
         return self._system_prompt
+
+
+def load_system_prompt(language: str) -> str:
+    with open(path_util.data_dir / "system_prompts.json") as f:
+        system_prompts = json.load(f)
+    system_prompt = system_prompts.get(language)
+    assert system_prompt, f"no system prompt for language '{language}'"
+    return system_prompt
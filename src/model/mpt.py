@@ -1,32 +1,16 @@
-from dataclasses import dataclass
-from enum import StrEnum
 from logging import Logger
+from typing import Final, Optional
 
 import torch
 import transformers
-from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, PreTrainedTokenizerBase
 
-from api_usage import APIUsage
+import context_plan
 from experiment import ex
-from .model import Model
+from .local import LocalModel, LocalSession
 
 
-class ChatRole(StrEnum):
-    SYSTEM = "system"
-    USER = "user"
-    ASSISTANT = "assistant"
-
-
-@dataclass
-class ChatMessage:
-    role: ChatRole
-    content: str
-
-    def to_dict(self) -> dict:
-        return {"role": self.role, "content": self.content}
-
-
-class MptModel(Model):
+class MptModel(LocalModel):
     _model_config = {
         "mpt-7b-chat": "mosaicml/mpt-7b-chat",
         "mpt-30b-chat": "mosaicml/mpt-30b-chat",
@@ -34,27 +18,12 @@ class MptModel(Model):
 
     SUPPORTED_MODELS = set(_model_config.keys())
 
-    _model_name: str
-
-    _pipe: transformers.Pipeline
-    _history: list[ChatMessage]
+    # MPT uses ALiBi and can thus handle sequences longer than it was trained on, up to the configured max_seq_len
+    _MAX_SEQ_LEN: Final[int] = 16384
 
-    def __init__(self, model_name: str):
-        super().__init__()
-        self._model_name = model_name
-        self._init_model()
-
-    def _init_model(self) -> None:
-        model_name = self._model_config[self._model_name]
-        config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
-        config.max_seq_len = 16384
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            config=config,
-            torch_dtype=torch.bfloat16,
-            trust_remote_code=True,
-        )
-        tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
+    @classmethod
+    def load_tokenizer(cls, model_name: str) -> PreTrainedTokenizerBase:
+        tokenizer = AutoTokenizer.from_pretrained(cls._model_config[model_name], padding_side="left")
         tokenizer.chat_template = (
             "{% for message in messages %}"
             "{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}"
@@ -63,31 +32,40 @@ class MptModel(Model):
             "{{ '<|im_start|>assistant\n' }}"
             "{% endif %}"
         )
-        self._pipe = transformers.pipeline("text-generation", model=model, tokenizer=tokenizer)
+        return tokenizer
 
-    def prompt(self, prompt: str) -> str:
-        self._history.append(ChatMessage(ChatRole.USER, prompt))
-        message = self._complete()
-        self._history.append(ChatMessage(ChatRole.ASSISTANT, message))
-        return message
+    @classmethod
+    def context_window(cls, model_name: str) -> int:
+        return cls._MAX_SEQ_LEN
 
     @ex.capture
-    def reset(self, _log: Logger) -> None:
-        self._history = [ChatMessage(ChatRole.SYSTEM, self.system_prompt)]
-
-    def _complete(self) -> str:
-        prompt = self._pipe.tokenizer.apply_chat_template(
-            [msg.to_dict() for msg in self._history],
-            tokenize=False,
-            add_generation_prompt=True,
+    def _init_model(self, any_session_language: bool, _log: Logger) -> None:
+        model_name = self._model_config[self._model_name]
+        config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
+        # the attention buffers are sized by max_seq_len, so use the longest session in the language(s) if they have been
+        # planned
+        languages = None if any_session_language else [self.language]
+        max_seq_len = context_plan.get_max_seq_len(self._model_name, languages)
+        if max_seq_len is None:
+            _log.info(f"no context plan for '{self._model_name}' in "
+                      f"{'all languages' if any_session_language else f'language {self.language!r}'}, "
+                      f"using max_seq_len={self._MAX_SEQ_LEN}")
+            max_seq_len = self._MAX_SEQ_LEN
+        config.max_seq_len = self._max_seq_len = max_seq_len
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            config=config,
+            torch_dtype=torch.bfloat16,
+            trust_remote_code=True,
         )
-        eos_token_id = [self._pipe.tokenizer.eos_token_id]
-        return self._pipe(
-            prompt,
-            max_new_tokens=1,
-            eos_token_id=eos_token_id,
-            do_sample=False,
-        )[0]["generated_text"][len(prompt):]
-
-    def report_api_usage(self) -> APIUsage:
-        return APIUsage(self._model_name, -1, -1, 0.)
+        self._pipe = transformers.pipeline("text-generation", model=model, tokenizer=self.load_tokenizer(self._model_name))
+
+    def new_session(self, language: Optional[str] = None) -> LocalSession:
+        # the attention buffers cannot be resized once the model is loaded, so sessions that might not fit are rejected
+        language = language or self.language
+        if language != self.language:
+            max_seq_len = context_plan.get_max_seq_len(self._model_name, [language]) or self._MAX_SEQ_LEN
+            assert max_seq_len <= self._max_seq_len, \
+                f"sessions in language '{language}' need up to {max_seq_len} tokens, but the model was loaded with " \
+                f"max_seq_len={self._max_seq_len} (set any_session_language to size it for all languages)"
+        return super().new_session(language)
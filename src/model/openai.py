@@ -1,28 +1,94 @@
+import asyncio
+import hashlib
+import json
 import logging
+import math
 import os
+import re
+import time
+from dataclasses import dataclass, field
+from functools import cache
 from enum import Enum
 from logging import Logger
-from typing import Final
+from typing import Any, Final, Optional
+from urllib.parse import urlsplit
 
+import httpx
+import numpy as np
 import openai
 import tiktoken
-from openai import OpenAI
-from openai.types.chat import ChatCompletionMessageParam
-from tenacity import retry, retry_if_exception_type, wait_random_exponential
+from openai import AsyncOpenAI, OpenAI
+from openai.types import Batch
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 
+import path_util
 from api_usage import APIUsage
 from experiment import ex
+from hedging import Hedger
 from noop import NoOp
 from rate_limit import RateLimit
+from retry_policy import RetryBudget, RetryPolicy
+from util import SAMPLE_POLICIES, UnexpectedAnswerException, VALID_ANSWERS, choose_sample
 from .model import Model
 
 
+# requests are retried until they are within the rate limit; errors of the API itself are only retried a few times. The
+# rate limit adapts to the quota reported with a rejected request, so those do not need to pause all requests as well
+_RETRY_POLICY: Final[RetryPolicy] = RetryPolicy(
+    "openai",
+    RetryBudget(openai.RateLimitError, max_attempts=None, min_wait=1, max_wait=60),
+    RetryBudget((openai.APIConnectionError, openai.InternalServerError), max_attempts=5, min_wait=1, max_wait=60,
+                trips_circuit=True),
+)
+
+# units of the durations in the rate limit headers, in seconds
+_DURATION_UNITS: Final[dict[str, float]] = dict(h=3600., m=60., s=1., ms=.001)
+
+
 class OpenAIRole(Enum):
     SYSTEM = "system"
     USER = "user"
     ASSISTANT = "assistant"
 
 
+@dataclass(frozen=True)
+class TokenPrices:
+    """Prices in $ / 1M tokens."""
+    input: float
+    # input tokens that are read from the prompt cache (see https://platform.openai.com/docs/guides/prompt-caching)
+    cached_input: float
+    output: float
+
+
+@dataclass
+class OpenAISession:
+    """State of a single session. Apart from the main session of OpenAIModel, sessions are played in lockstep (see
+    OpenAIModel.prompt_batch) or concurrently (see OpenAIModel.prompt_session_async)."""
+    # model whose tokenizer is used to estimate the number of tokens; None if it is unknown, then nothing is estimated
+    tokenizer_model_name: Optional[str]
+    history: list[ChatCompletionMessageParam] = field(default_factory=list)
+    # estimated number of tokens of the messages in history
+    num_history_tokens: int = 0
+    num_input_tokens: int = 0
+    num_cached_input_tokens: int = 0
+    num_output_tokens: int = 0
+    # probabilities of the possible answers to the last prompt (see Model.answer_probabilities)
+    answer_probabilities: Optional[dict[str, float]] = None
+
+    def add(self, role: OpenAIRole, content: str) -> None:
+        message = dict(role=role.value, content=content)
+        # messages are only ever appended, such that each request starts with the previous one and the API can read
+        # that prefix from its prompt cache
+        self.history.append(message)
+        # count the tokens of each message once instead of re-encoding the whole history for every request
+        if self.tokenizer_model_name is not None:
+            self.num_history_tokens += _estimate_num_message_tokens(self.tokenizer_model_name, message)
+
+    def estimate_tokens(self, num_samples: int = 1) -> tuple[int, int]:
+        """Estimate the number of input and output tokens of the next request."""
+        return self.num_history_tokens + 3, num_samples
+
+
 class OpenAIModel(Model):
     SUPPORTED_MODELS: Final[set[str]] = {
         # # https://platform.openai.com/docs/models/gpt-4-and-gpt-4-turbo
@@ -32,92 +98,577 @@ class OpenAIModel(Model):
         "gpt-3.5-turbo-0125",  # latest gpt-3.5-turbo with pinned version
     }
 
+    # number of tokens (input and output) per request
+    CONTEXT_WINDOWS: Final[dict[str, int]] = {
+        "gpt-4-0125-preview": 128_000,
+        "gpt-4-0613": 8_192,
+        "gpt-3.5-turbo-0125": 16_385,
+    }
+
+    # models without prompt caching charge the full price for cached input tokens
+    PRICES: Final[dict[str, TokenPrices]] = {
+        "gpt-4-0125-preview": TokenPrices(input=30., cached_input=30., output=60.),
+        "gpt-4-0613": TokenPrices(input=30., cached_input=30., output=60.),
+        "gpt-3.5-turbo-0125": TokenPrices(input=.5, cached_input=.5, output=1.5),
+    }
+
+    # the Batch API costs half of the regular price
+    BATCH_DISCOUNT: Final[float] = .5
+
+    # seconds between polls of the state of a batch
+    _BATCH_POLL_INTERVAL: Final[float] = 10.
+
     _model_name: str
+    _answer_mode: str
+    _num_samples: int
+    _sample_policy: str
+    _sampling_temperature: float
+    _hedger: Optional[Hedger]
+    _rate_limit: Optional[RateLimit]
 
     _openai: OpenAI
-    _history: list[ChatCompletionMessageParam]
+    _async_openai: Optional[AsyncOpenAI] = None
+    _session: OpenAISession
+    _batch_sessions: list[OpenAISession]
 
-    def __init__(self, model_name: str):
+    @ex.capture
+    def __init__(
+            self,
+            model_name: str,
+            answer_mode: str,
+            num_samples: int,
+            sample_policy: str,
+            sampling_temperature: float,
+            hedge_percentile: Optional[float],
+    ):
         super().__init__()
+        assert answer_mode in {"generate", "score"}, f"unsupported answer mode '{answer_mode}'"
+        assert sample_policy in SAMPLE_POLICIES, f"unsupported sample policy '{sample_policy}'"
+        assert num_samples == 1 or answer_mode == "generate", "answers can only be sampled in answer mode 'generate'"
         self._model_name = model_name
+        self._answer_mode = answer_mode
+        self._num_samples = num_samples
+        self._sample_policy = sample_policy
+        self._sampling_temperature = sampling_temperature
+        self._hedger = None if hedge_percentile is None else Hedger(hedge_percentile)
+        self._rate_limit = self._make_rate_limit()
+        self._num_cached_input_tokens = 0
+        self._num_batch_input_tokens = 0
+        self._num_batch_cached_input_tokens = 0
+        self._num_batch_output_tokens = 0
+        self._request_latencies: list[float] = []
         logging.getLogger("httpx").setLevel(logging.WARNING)  # reduce logging verbosity
 
-    def prompt(self, prompt: str) -> str:
-        self._add(OpenAIRole.USER, prompt)
+    def _prompt(self, prompt: str) -> str:
+        self._session.add(OpenAIRole.USER, prompt)
         message = self._fetch()
-        self._add(OpenAIRole.ASSISTANT, message)
+        self._session.add(OpenAIRole.ASSISTANT, message)
+        return message
+
+    def _reset(self) -> None:
+        self._init_client()
+        self._session = self._start_session()
+
+    def _cache_scope(self) -> Optional[dict[str, Any]]:
+        if self._num_samples > 1:
+            return None
+        # replies of another endpoint (e.g., of the fake server) must not be served for those of this one
+        return self._completion_args() | dict(base_url=self._client_args()["base_url"])
+
+    def _replay(self, prompt: str, reply: str) -> None:
+        self._session.add(OpenAIRole.USER, prompt)
+        self._session.add(OpenAIRole.ASSISTANT, reply)
+
+    def prompt_batch(self, prompts: list[str]) -> list[str]:
+        for session, prompt in zip(self._batch_sessions, prompts):
+            session.add(OpenAIRole.USER, prompt)
+        messages = self._fetch_batch()
+        for session, message in zip(self._batch_sessions, messages):
+            session.add(OpenAIRole.ASSISTANT, message)
+        return messages
+
+    def reset_batch(self, batch_size: int) -> None:
+        self._init_client()
+        self._batch_sessions = [self._start_session() for _ in range(batch_size)]
+        self._answer_probabilities = [None for _ in range(batch_size)]
+
+    def new_session(self) -> OpenAISession:
+        if not self.dry_run:
+            # the connections of an async client are bound to the event loop they were opened on, so each loop (i.e.,
+            # each asyncio.run) gets its own client
+            self._async_openai = _get_async_client(asyncio.get_running_loop(), **self._client_args())
+        return self._start_session()
+
+    async def prompt_session_async(self, session: OpenAISession, prompt: str) -> str:
+        session.add(OpenAIRole.USER, prompt)
+        message = await self._fetch_async(session)
+        session.add(OpenAIRole.ASSISTANT, message)
+        return message
+
+    def session_answer_probabilities(self, session: OpenAISession) -> Optional[dict[str, float]]:
+        return session.answer_probabilities
+
+    def report_session_api_usage(self, session: OpenAISession) -> APIUsage:
+        return self._api_usage(session.num_input_tokens, session.num_cached_input_tokens, session.num_output_tokens)
+
+    def report_metrics(self) -> dict[str, float]:
+        if len(self._request_latencies) == 0:
+            return {}
+        # the first request has to establish a connection, later ones should reuse a pooled connection
+        metrics = dict(
+            openai_num_requests=len(self._request_latencies),
+            openai_first_request_latency=self._request_latencies[0],
+            openai_request_latency_p50=float(np.percentile(self._request_latencies, 50)),
+            openai_request_latency_p90=float(np.percentile(self._request_latencies, 90)),
+            openai_request_latency_p99=float(np.percentile(self._request_latencies, 99)),
+        )
+        if self._hedger is not None:
+            metrics.update({f"openai_{name}": value for name, value in self._hedger.report_metrics().items()})
+        if self._rate_limit is not None:
+            metrics.update({f"openai_{name}": value for name, value in self._rate_limit.report_metrics().items()})
+        return metrics
+
+    def report_api_usage(self) -> APIUsage:
+        api_usage = self._api_usage(self._num_input_tokens, self._num_cached_input_tokens, self._num_output_tokens)
+        batch_api_usage = self._api_usage(
+            self._num_batch_input_tokens, self._num_batch_cached_input_tokens, self._num_batch_output_tokens
+        )
+        cost = api_usage.cost - self.BATCH_DISCOUNT * batch_api_usage.cost
+        return APIUsage(
+            api_usage.name,
+            api_usage.num_input_tokens,
+            api_usage.num_output_tokens,
+            cost,
+            api_usage.num_cached_input_tokens,
+            api_usage.list_cost,
+        )
+
+    def _api_usage(self, num_input_tokens: int, num_cached_input_tokens: int, num_output_tokens: int) -> APIUsage:
+        assert self._model_name in self.PRICES, f"unsupported model: {self._model_name}"
+        prices = self.PRICES[self._model_name]
+        output_cost = num_output_tokens * prices.output
+        cost = ((num_input_tokens - num_cached_input_tokens) * prices.input + num_cached_input_tokens * prices.cached_input
+                + output_cost) / 1_000_000
+        list_cost = (num_input_tokens * prices.input + output_cost) / 1_000_000
+        return APIUsage(self._model_name, num_input_tokens, num_output_tokens, cost, num_cached_input_tokens, list_cost)
+
+    @_RETRY_POLICY
+    def _fetch(self) -> str:
+        estimated_num_input_tokens, estimated_num_output_tokens = self._session.estimate_tokens(self._num_samples)
+        estimated_num_tokens = estimated_num_input_tokens + estimated_num_output_tokens
+        if not self.dry_run:
+            self._wait_for_rate_limit(estimated_num_tokens)
+
+        self._answer_probabilities = [None]
+        if self.dry_run:
+            self._num_input_tokens += estimated_num_input_tokens
+            self._num_output_tokens += estimated_num_output_tokens
+            return "?"  # dry run, return a placeholder
+        start_time = time.perf_counter()
+        response, num_requests = self._create_completion(self._session.history, estimated_num_tokens)
+        self._request_latencies.append(time.perf_counter() - start_time)
+
+        num_input_tokens, num_cached_input_tokens, num_output_tokens = self._count_tokens(
+            response, estimated_num_input_tokens, estimated_num_output_tokens
+        )
+        # a hedged request is billed for each duplicate, which has the same messages and thus the same number of tokens
+        self._num_input_tokens += num_requests * num_input_tokens
+        self._num_cached_input_tokens += num_requests * num_cached_input_tokens
+        self._num_output_tokens += num_requests * num_output_tokens
+        message, answer_probabilities = self._parse_response(response)
+        self._answer_probabilities = [answer_probabilities]
+
+        return message
+
+    @_RETRY_POLICY
+    async def _fetch_async(self, session: OpenAISession) -> str:
+        estimated_num_input_tokens, estimated_num_output_tokens = session.estimate_tokens(self._num_samples)
+        estimated_num_tokens = estimated_num_input_tokens + estimated_num_output_tokens
+        if not self.dry_run:
+            await self._wait_for_rate_limit_async(estimated_num_tokens)
+
+        if self.dry_run:
+            num_input_tokens, num_output_tokens = estimated_num_input_tokens, estimated_num_output_tokens
+            num_cached_input_tokens = 0
+            message = "?"  # dry run, return a placeholder
+        else:
+            start_time = time.perf_counter()
+            response, num_requests = await self._create_completion_async(session.history, estimated_num_tokens)
+            self._request_latencies.append(time.perf_counter() - start_time)
+            num_input_tokens, num_cached_input_tokens, num_output_tokens = (
+                num_requests * num_tokens
+                for num_tokens in self._count_tokens(response, estimated_num_input_tokens, estimated_num_output_tokens)
+            )
+
+        # the totals of the model are kept as well such that report_api_usage() covers all sessions
+        session.num_input_tokens += num_input_tokens
+        session.num_cached_input_tokens += num_cached_input_tokens
+        session.num_output_tokens += num_output_tokens
+        self._num_input_tokens += num_input_tokens
+        self._num_cached_input_tokens += num_cached_input_tokens
+        self._num_output_tokens += num_output_tokens
+
+        if not self.dry_run:
+            # parsed only after the tokens are counted, which are billed even if the answer is unexpected
+            message, session.answer_probabilities = self._parse_response(response)
         return message
 
+    def _create_completion(
+            self,
+            messages: list[ChatCompletionMessageParam],
+            estimated_num_tokens: int,
+    ) -> tuple[ChatCompletion, int]:
+        """Returns the completion and the number of requests sent for it (two if the request was hedged, which is rate
+        limited like the original request)."""
+        messages = list(messages)  # a request that lost the race may still be sent after the session continued
+
+        def create() -> ChatCompletion:
+            try:
+                raw_response = self._openai.chat.completions.with_raw_response.create(
+                    messages=messages, **self._completion_args()
+                )
+            except openai.RateLimitError as exc:
+                self._update_rate_limit(exc.response.headers)
+                raise
+            self._update_rate_limit(raw_response.headers)
+            return raw_response.parse()
+
+        if self._hedger is None:
+            return create(), 1
+        return self._hedger.call(create, lambda: self._wait_for_rate_limit(estimated_num_tokens))
+
+    async def _create_completion_async(
+            self,
+            messages: list[ChatCompletionMessageParam],
+            estimated_num_tokens: int,
+    ) -> tuple[ChatCompletion, int]:
+        async def create() -> ChatCompletion:
+            try:
+                raw_response = await self._async_openai.chat.completions.with_raw_response.create(
+                    messages=messages, **self._completion_args()
+                )
+            except openai.RateLimitError as exc:
+                self._update_rate_limit(exc.response.headers)
+                raise
+            self._update_rate_limit(raw_response.headers)
+            return raw_response.parse()
+
+        if self._hedger is None:
+            return await create(), 1
+        return await self._hedger.call_async(create, lambda: self._wait_for_rate_limit_async(estimated_num_tokens))
+
     @ex.capture
-    def reset(self, language: str) -> None:
+    def _make_rate_limit(
+            self,
+            openai_max_requests_per_minute: int,
+            openai_max_tokens_per_minute: Optional[int],
+            rate_limit_scope: str,
+            openai_base_url: Optional[str],
+    ) -> Optional[RateLimit]:
+        # the quota is one of the endpoint, so runs against another one (e.g., the fake server) do not share its limits
+        provider = "openai" if openai_base_url is None else f"openai_{urlsplit(openai_base_url).netloc}"
+        return RateLimit.get(
+            provider, self._model_name, openai_max_requests_per_minute, openai_max_tokens_per_minute, rate_limit_scope
+        )
+
+    def _wait_for_rate_limit(self, estimated_num_tokens: int) -> None:
+        if self._rate_limit is not None:
+            self._rate_limit.wait(estimated_num_tokens)
+
+    async def _wait_for_rate_limit_async(self, estimated_num_tokens: int) -> None:
+        if self._rate_limit is not None:
+            await self._rate_limit.wait_async(estimated_num_tokens)
+
+    def _update_rate_limit(self, headers: httpx.Headers) -> None:
+        # the configured limits are only a guess, the quota of the account is reported with every response (and error)
+        if self._rate_limit is not None:
+            self._rate_limit.update(**_read_rate_limit_headers(headers))
+
+    @ex.capture
+    def _fetch_batch(self, _log: Logger) -> list[str]:
+        """Fetch the answers of all sessions of the batch with a single batch of the Batch API. The output of each batch
+        is stored such that an interrupted run can be resumed without submitting the same batch again."""
+
+        estimated_num_tokens = [session.estimate_tokens(self._num_samples) for session in self._batch_sessions]
+        if self.dry_run:
+            for estimated_num_input_tokens, estimated_num_output_tokens in estimated_num_tokens:
+                self._num_input_tokens += estimated_num_input_tokens
+                self._num_output_tokens += estimated_num_output_tokens
+                self._num_batch_input_tokens += estimated_num_input_tokens
+                self._num_batch_output_tokens += estimated_num_output_tokens
+            return ["?" for _ in self._batch_sessions]  # dry run, return placeholders
+
+        requests = [
+            dict(
+                custom_id=f"session-{session_idx}",
+                method="POST",
+                url="/v1/chat/completions",
+                body=dict(messages=session.history, **self._completion_args()),
+            )
+            for session_idx, session in enumerate(self._batch_sessions)
+        ]
+        content = "\n".join(json.dumps(request) for request in requests).encode()
+        # the batch is identified by its content, such that a resumed run finds it again
+        digest = hashlib.sha256(str(self._openai.base_url).encode() + content).hexdigest()
+        batch_path = path_util.openai_batches_dir / f"{digest}.json"
+        output_path = path_util.openai_batches_dir / f"{digest}.output.jsonl"
+
+        if output_path.exists():
+            _log.info(f"reusing the output of batch {digest}")
+        else:
+            if batch_path.exists():
+                with open(batch_path) as f:
+                    batch_id = json.load(f)["batch_id"]
+                _log.info(f"resuming batch {batch_id}")
+            else:
+                batch_id = self._create_batch(self._upload_batch_input(f"{digest}.jsonl", content))
+                path_util.openai_batches_dir.mkdir(parents=True, exist_ok=True)
+                with open(batch_path, "w") as f:
+                    json.dump(dict(batch_id=batch_id), f)
+                _log.info(f"submitted batch {batch_id} with {len(requests)} requests")
+
+            batch = self._retrieve_batch(batch_id)
+            while batch.status in ("validating", "in_progress", "finalizing"):
+                time.sleep(self._BATCH_POLL_INTERVAL)
+                batch = self._retrieve_batch(batch_id)
+            if batch.status != "completed" or batch.output_file_id is None:
+                batch_path.unlink()  # submit the batch again in the next run
+                raise Exception(f"batch {batch_id} ended with status '{batch.status}'")
+
+            # write to a temporary file first, so that an interrupted download is not mistaken for the output
+            output_tmp_path = output_path.with_suffix(".tmp")
+            output_tmp_path.write_bytes(self._download_file(batch.output_file_id))
+            output_tmp_path.rename(output_path)
+
+        outputs = {}
+        for line in output_path.read_text().splitlines():
+            output = json.loads(line)
+            outputs[output["custom_id"]] = output
+
+        messages = []
+        self._answer_probabilities = [None for _ in requests]
+        for session_idx, (request, (estimated_num_input_tokens, estimated_num_output_tokens)) in enumerate(
+                zip(requests, estimated_num_tokens)
+        ):
+            output = outputs.get(request["custom_id"])
+            if output is None or output["error"] is not None or output["response"]["status_code"] != 200:
+                # an empty answer is not a valid one, so the session is replayed without the Batch API
+                _log.warning(f"request {request['custom_id']} of batch {digest} failed: {output}")
+                messages.append("")
+                continue
+            response = ChatCompletion.model_validate(output["response"]["body"])
+            num_input_tokens, num_cached_input_tokens, num_output_tokens = self._count_tokens(
+                response, estimated_num_input_tokens, estimated_num_output_tokens
+            )
+            self._num_input_tokens += num_input_tokens
+            self._num_cached_input_tokens += num_cached_input_tokens
+            self._num_output_tokens += num_output_tokens
+            self._num_batch_input_tokens += num_input_tokens
+            self._num_batch_cached_input_tokens += num_cached_input_tokens
+            self._num_batch_output_tokens += num_output_tokens
+            message, self._answer_probabilities[session_idx] = self._parse_response(response)
+            messages.append(message)
+        return messages
+
+    # each call of the Batch API is retried on its own, such that a failed poll neither submits the batch again nor
+    # restarts the wait for it
+    @_RETRY_POLICY
+    def _upload_batch_input(self, file_name: str, content: bytes) -> str:
+        return self._openai.files.create(file=(file_name, content), purpose="batch").id
+
+    @_RETRY_POLICY
+    def _create_batch(self, input_file_id: str) -> str:
+        return self._openai.batches.create(
+            input_file_id=input_file_id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        ).id
+
+    @_RETRY_POLICY
+    def _retrieve_batch(self, batch_id: str) -> Batch:
+        return self._openai.batches.retrieve(batch_id)
+
+    @_RETRY_POLICY
+    def _download_file(self, file_id: str) -> bytes:
+        return self._openai.files.content(file_id).content
+
+    def _init_client(self) -> None:
         if self.dry_run:
             # make sure no real API calls are made in dry run
             # noinspection PyTypeChecker
             self._openai = NoOp()
         else:
-            api_key = os.getenv("OPENAI_API_KEY")
-            assert api_key, "OPENAI_API_KEY environment variable not set or empty"
-            self._openai = OpenAI(api_key=api_key)
-        self._history = []
-        self._add(OpenAIRole.SYSTEM, self.system_prompt)
+            self._openai = _get_client(**self._client_args())
 
-    def report_api_usage(self) -> APIUsage:
-        # input_token_cost and output_token_cost are $ / 1M tokens
-        match self._model_name:
-            case "gpt-4-0125-preview":
-                input_token_cost = 30.
-                output_token_cost = 60.
-            case "gpt-4-0613":
-                input_token_cost = 30.
-                output_token_cost = 60.
-            case "gpt-3.5-turbo-0125":
-                input_token_cost = .5
-                output_token_cost = 1.5
-            case _:
-                assert False, f"unsupported model: {self._model_name}"
-        cost = (self._num_input_tokens * input_token_cost + self._num_output_tokens * output_token_cost) / 1_000_000
-        return APIUsage(self._model_name, self._num_input_tokens, self._num_output_tokens, cost)
-
-    @retry(wait=wait_random_exponential(min=1, max=60), retry=retry_if_exception_type(openai.RateLimitError))
     @ex.capture
-    def _fetch(self, _log: Logger) -> str:
-        if not self.dry_run:
-            RateLimit.wait(500, 60)
-
-        estimated_num_input_tokens, estimated_num_output_tokens = self._estimate_tokens()
+    def _client_args(
+            self,
+            openai_base_url: Optional[str],
+            openai_max_connections: int,
+            openai_max_keepalive_connections: int,
+            openai_keepalive_expiry: float,
+            openai_timeout: float,
+    ) -> dict:
+        api_key = os.getenv("OPENAI_API_KEY")
+        assert api_key, "OPENAI_API_KEY environment variable not set or empty"
+        return dict(
+            api_key=api_key,
+            base_url=openai_base_url,
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry,
+            timeout=openai_timeout,
+        )
 
-        if self.dry_run:
-            self._num_input_tokens += estimated_num_input_tokens
-            self._num_output_tokens += estimated_num_output_tokens
-            return "?"  # dry run, return a placeholder
-        response = self._openai.chat.completions.create(
-            messages=self._history,
+    def _completion_args(self) -> dict:
+        completion_args = dict(
             model=self._model_name,
             max_tokens=1,  # generate at most one token (we just want a single number, 1 or 2)
-            n=1,  # generate a single completion
-            temperature=0,
+            n=self._num_samples,  # generate a single completion unless sampling
+            temperature=0 if self._num_samples == 1 else self._sampling_temperature,
         )
+        if self._answer_mode == "score":
+            # the probabilities of the answer tokens are returned, and only they can be generated (if they are known)
+            completion_args.update(logprobs=True, top_logprobs=len(VALID_ANSWERS))
+            if self._tokenizer_model_name is not None:
+                completion_args.update(
+                    logit_bias={token_id: 100 for token_id in _get_answer_token_ids(self._tokenizer_model_name)}
+                )
+        return completion_args
+
+    def _parse_response(self, response: ChatCompletion) -> tuple[str, Optional[dict[str, float]]]:
+        """Returns the answer and the probabilities of the possible answers, if available."""
+        if self._num_samples > 1:
+            return choose_sample([choice.message.content for choice in response.choices], self._sample_policy)
+        message = response.choices[0].message.content
+        if self._answer_mode != "score":
+            return message, None
+        top_logprobs = response.choices[0].logprobs.content[0].top_logprobs
+        logprobs = {top_logprob.token: top_logprob.logprob for top_logprob in top_logprobs}
+        probabilities = {answer: math.exp(logprobs[answer]) if answer in logprobs else 0. for answer in VALID_ANSWERS}
+        if not any(probabilities.values()):
+            # without a tokenizer (OpenAI-compatible models), no logit_bias is sent, so the answers may not be likely at all
+            raise UnexpectedAnswerException(f"none of the answers among the most likely tokens {list(logprobs)}")
+        # like for local models, the probabilities are normalized over the answers, such that they sum to 1 and are
+        # comparable across backends
+        total_probability = sum(probabilities.values())
+        return message, {answer: probability / total_probability for answer, probability in probabilities.items()}
 
-        num_input_tokens = response.usage.prompt_tokens
-        num_output_tokens = response.usage.completion_tokens
+    @ex.capture
+    def _count_tokens(
+            self,
+            response: ChatCompletion,
+            estimated_num_input_tokens: int,
+            estimated_num_output_tokens: int,
+            _log: Logger,
+    ) -> tuple[int, int, int]:
+        """Like _read_usage(), but warns if the numbers of tokens differ from the estimates."""
+        num_input_tokens, num_cached_input_tokens, num_output_tokens = _read_usage(response)
+        if self._tokenizer_model_name is None:
+            return num_input_tokens, num_cached_input_tokens, num_output_tokens  # nothing was estimated
         if num_input_tokens != estimated_num_input_tokens:
             _log.warning(f"expected {estimated_num_input_tokens} input tokens, got {num_input_tokens}")
         if num_output_tokens != estimated_num_output_tokens:
             _log.warning(f"expected {estimated_num_output_tokens} output tokens, got {num_output_tokens}")
+        return num_input_tokens, num_cached_input_tokens, num_output_tokens
+
+    def _start_session(self) -> OpenAISession:
+        session = OpenAISession(self._tokenizer_model_name)
+        session.add(OpenAIRole.SYSTEM, self.system_prompt)
+        return session
+
+    @property
+    def _tokenizer_model_name(self) -> Optional[str]:
+        return self._model_name
+
+    @staticmethod
+    def estimate_num_input_tokens(model_name: str, messages: list[ChatCompletionMessageParam]) -> int:
+        return sum(_estimate_num_message_tokens(model_name, message) for message in messages) + 3
+
+
+# the clients are shared by all sessions (and models) of the process, such that they share the connection pool; both are
+# safe to use concurrently, from threads and from tasks of a single event loop (the one passed), respectively
+# they do not retry on their own, such that every rejected request is seen by the retry policy and the rate limit
+@cache
+def _get_client(
+        api_key: str,
+        base_url: Optional[str],
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        timeout: float,
+) -> OpenAI:
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    http_client = httpx.Client(limits=limits, timeout=timeout, follow_redirects=True)
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+@cache
+def _get_async_client(
+        loop: asyncio.AbstractEventLoop,
+        api_key: str,
+        base_url: Optional[str],
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        timeout: float,
+) -> AsyncOpenAI:
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    http_client = httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True)
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+@cache
+def _get_encoding(model_name: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model_name)
+
+
+@cache
+def _get_answer_token_ids(model_name: str) -> list[int]:
+    encoding = _get_encoding(model_name)
+    answer_token_ids = [encoding.encode(answer) for answer in VALID_ANSWERS]
+    assert all(len(token_ids) == 1 for token_ids in answer_token_ids), f"answers are not single tokens for '{model_name}'"
+    return [token_ids[0] for token_ids in answer_token_ids]
+
+
+def _read_usage(response: ChatCompletion) -> tuple[int, int, int]:
+    """Returns the number of input tokens, of those that were cached, and of output tokens of the response."""
+    if response.usage is None:
+        return 0, 0, 0
+    prompt_tokens_details = response.usage.prompt_tokens_details
+    num_cached_input_tokens = (prompt_tokens_details.cached_tokens or 0) if prompt_tokens_details is not None else 0
+    return response.usage.prompt_tokens, num_cached_input_tokens, response.usage.completion_tokens
+
+
+def _read_rate_limit_headers(headers: httpx.Headers) -> dict[str, Optional[float]]:
+    """Returns the quota reported by the rate limit headers, as arguments of RateLimit.update()."""
+    # https://platform.openai.com/docs/guides/rate-limits/rate-limits-in-headers
+    quota = {}
+    for unit in ("requests", "tokens"):
+        limit = headers.get(f"x-ratelimit-limit-{unit}")
+        remaining = headers.get(f"x-ratelimit-remaining-{unit}")
+        reset = headers.get(f"x-ratelimit-reset-{unit}")
+        quota[f"max_{unit}_per_minute"] = None if limit is None else int(limit)
+        quota[f"remaining_{unit}"] = None if remaining is None else int(remaining)
+        quota[f"{unit}_reset"] = None if reset is None else _parse_duration(reset)
+    return quota
 
-        self._num_input_tokens += num_input_tokens
-        self._num_output_tokens += num_output_tokens
 
-        return response.choices[0].message.content
+def _parse_duration(duration: str) -> float:
+    """Returns the seconds of a duration like "6m0s", "1.5s" or "20ms"."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    assert parts and "".join(value + unit for value, unit in parts) == duration, f"invalid duration: {duration}"
+    return sum(float(value) * _DURATION_UNITS[unit] for value, unit in parts)
 
-    def _add(self, role: OpenAIRole, content: str) -> None:
-        self._history.append(dict(role=role.value, content=content))
 
-    def _estimate_tokens(self) -> tuple[int, int]:
-        encoding = tiktoken.encoding_for_model(self._model_name)
-        num_tokens = 0
-        for message in self._history:
-            num_tokens += 3
-            for value in message.values():
-                num_tokens += len(encoding.encode(value))
-        return num_tokens + 3, 1
+def _estimate_num_message_tokens(model_name: str, message: ChatCompletionMessageParam) -> int:
+    encoding = _get_encoding(model_name)
+    return 3 + sum(len(encoding.encode(value)) for value in message.values())
@@ -0,0 +1,76 @@
+import os
+from typing import Any, Final, Optional
+
+import openai
+
+from api_usage import APIUsage
+from experiment import ex
+from rate_limit import RateLimit
+from .openai import OpenAIModel
+
+
+class OpenAICompatibleModel(OpenAIModel):
+    """Model served by a local inference server with an OpenAI-compatible API (e.g., vLLM, llama.cpp server or TGI).
+    Sessions are handled like those of OpenAIModel, but any served model can be used. As its tokenizer is unknown, the
+    numbers of tokens are not estimated (so a dry run reports none), and answer mode "score" cannot restrict generation to
+    the answer tokens. The server is neither rate limited nor billed."""
+
+    NAME: Final[str] = "openai-compatible"
+
+    @ex.capture
+    def __init__(self, openai_compatible_model_id: Optional[str]):
+        assert openai_compatible_model_id is not None, "openai_compatible_model_id must be set to the id of the served model"
+        super().__init__(openai_compatible_model_id)
+        self._served_model: Optional[str] = None
+
+    def _cache_scope(self) -> Optional[dict[str, Any]]:
+        scope = super()._cache_scope()
+        if scope is None:
+            return None
+        if self._served_model is None:
+            self._served_model = self._fetch_served_model()
+        return scope | dict(served_model=self._served_model)
+
+    def reset_batch(self, batch_size: int) -> None:
+        # inference servers do not implement the Batch API, but batch concurrent requests on their own
+        raise NotImplementedError(f"{type(self).__name__} does not support batched sessions, play sessions concurrently")
+
+    def _make_rate_limit(self) -> Optional[RateLimit]:
+        return None
+
+    def _api_usage(self, num_input_tokens: int, num_cached_input_tokens: int, num_output_tokens: int) -> APIUsage:
+        return APIUsage(self.NAME, num_input_tokens, num_output_tokens, 0., num_cached_input_tokens)
+
+    @ex.capture
+    def _client_args(
+            self,
+            openai_compatible_base_url: str,
+            openai_max_connections: int,
+            openai_max_keepalive_connections: int,
+            openai_keepalive_expiry: float,
+            openai_timeout: float,
+    ) -> dict:
+        return dict(
+            # the client requires an API key, even if the server does not
+            api_key=os.getenv("OPENAI_COMPATIBLE_API_KEY") or "none",
+            base_url=openai_compatible_base_url,
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry,
+            timeout=openai_timeout,
+        )
+
+    @property
+    def _tokenizer_model_name(self) -> Optional[str]:
+        return None
+
+    def _fetch_served_model(self) -> str:
+        """What the server serves under the model id: the weights it loaded (e.g., the "root" that vLLM reports) if the
+        server tells, as the same id may be given to other weights after a restart, and the id otherwise."""
+        model_id = self._model_name
+        try:
+            served_models = {model.id: model for model in self._openai.models.list()}
+        except openai.APIError:
+            return model_id
+        root = getattr(served_models.get(model_id), "root", None)
+        return model_id if root is None else f"{model_id}@{root}"
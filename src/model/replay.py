@@ -0,0 +1,144 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Final, Optional, Union
+
+import numpy as np
+
+import path_util
+from api_usage import APIUsage
+from experiment import ex
+from moral_machine import Scenario, load_sessions, make_prompt
+from .model import Model
+
+# answers of a session as recorded: the (unswapped) answer to each scenario, or the reason why the session failed
+RecordedSession = Optional[Union[list[int], str]]
+
+
+@dataclass
+class ReplaySession:
+    prompts: list[str] = field(default_factory=list)
+
+
+class ReplayModel(Model):
+    """Replays the answers that were recorded for another model, without any API calls or forward passes, to measure the
+    throughput of the harness itself (e.g., of concurrent or batched sessions) and to reproduce recorded runs. Each prompt
+    is answered with the recorded answer to its scenario, which is recognized by the prompts of the session so far, in
+    the orientation the scenario was shown in (i.e., swapped like the recorded model saw it). Sessions that failed when
+    they were recorded are answered with an unexpected reply."""
+
+    NAME: Final[str] = "replay"
+
+    # reply to the scenarios of sessions without recorded answers
+    UNRECORDED_REPLY: Final[str] = "no recorded answer"
+
+    @ex.capture
+    def __init__(self, replay_model_name: str, replay_source: str, replay_latency: float, replay_latency_jitter: float):
+        super().__init__()
+        assert replay_latency >= 0 and replay_latency_jitter >= 0, \
+            f"replay latency must not be negative, got {replay_latency} (jitter {replay_latency_jitter})"
+        self._latency = replay_latency
+        self._latency_jitter = replay_latency_jitter
+        self._generator = np.random.default_rng(seed=0)
+
+        recorded_sessions = load_recorded_sessions(replay_model_name, self.language, replay_source)
+        # the replies are keyed by the prompts of the session up to the scenario, as the same scenario can occur in
+        # different sessions
+        self._replies: dict[tuple[str, ...], str] = {}
+        for session, recorded_session in zip(load_sessions(self.language, 0, None), recorded_sessions):
+            prompts = ()
+            for scenario_idx, scenario in enumerate(session.scenarios):
+                prompts += (make_prompt(scenario),)
+                self._replies.setdefault(prompts, _recorded_reply(scenario, scenario_idx, recorded_session))
+
+        self._session = ReplaySession()
+        self._batch_sessions: list[ReplaySession] = []
+        self._num_replies = 0
+        self._num_unrecorded_replies = 0
+
+    def _prompt(self, prompt: str) -> str:
+        time.sleep(self._draw_latency())
+        return self._reply(self._session, prompt)
+
+    def _reset(self) -> None:
+        self._session = ReplaySession()
+
+    def prompt_batch(self, prompts: list[str]) -> list[str]:
+        # like a batched forward pass, the whole batch is delayed once
+        time.sleep(self._draw_latency())
+        return [self._reply(session, prompt) for session, prompt in zip(self._batch_sessions, prompts)]
+
+    def reset_batch(self, batch_size: int) -> None:
+        self._batch_sessions = [ReplaySession() for _ in range(batch_size)]
+        self._answer_probabilities = [None for _ in range(batch_size)]
+
+    def new_session(self) -> ReplaySession:
+        return ReplaySession()
+
+    async def prompt_session_async(self, session: ReplaySession, prompt: str) -> str:
+        await asyncio.sleep(self._draw_latency())
+        return self._reply(session, prompt)
+
+    def report_session_api_usage(self, session: ReplaySession) -> APIUsage:
+        return APIUsage(self.NAME, 0, 0, 0.)
+
+    def report_api_usage(self) -> APIUsage:
+        return APIUsage(self.NAME, 0, 0, 0.)
+
+    def report_metrics(self) -> dict[str, float]:
+        return dict(replay_replies=self._num_replies, replay_unrecorded_replies=self._num_unrecorded_replies)
+
+    def _reply(self, session: ReplaySession, prompt: str) -> str:
+        session.prompts.append(prompt)
+        reply = self._replies.get(tuple(session.prompts))
+        assert reply is not None, \
+            f"no session of language '{self.language}' starts with the prompts {session.prompts}"
+        self._num_replies += 1
+        if reply == self.UNRECORDED_REPLY:
+            self._num_unrecorded_replies += 1
+        return reply
+
+    def _draw_latency(self) -> float:
+        if self._latency_jitter == 0:
+            return self._latency
+        return self._latency + self._generator.uniform(0, self._latency_jitter)
+
+
+def _recorded_reply(scenario: Scenario, scenario_idx: int, recorded_session: RecordedSession) -> str:
+    if not isinstance(recorded_session, list) or scenario_idx >= len(recorded_session):
+        return ReplayModel.UNRECORDED_REPLY
+    # the answers are recorded unswapped, the model saw the profiles swapped
+    answer = recorded_session[scenario_idx]
+    if scenario.left_right_swapped:
+        answer = 1 if answer == 2 else 2
+    return str(answer)
+
+
+def load_recorded_sessions(model_name: str, language: str, source: str) -> list[RecordedSession]:
+    """The recorded answers of all sessions of the model in the language, read from its "cleansed" or "raw" results."""
+    if source == "cleansed":
+        return _load_cleansed_sessions(model_name, language)
+    if source == "raw":
+        return _load_raw_sessions(model_name, language)
+    raise ValueError(f"unknown source '{source}' of recorded answers, expected 'cleansed' or 'raw'")
+
+
+def _load_cleansed_sessions(model_name: str, language: str) -> list[RecordedSession]:
+    path = path_util.cleansed_experiment_results_dir / model_name / f"{language}.json"
+    assert path.exists(), f"no cleansed results of model '{model_name}' for language '{language}'"
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_raw_sessions(model_name: str, language: str) -> list[RecordedSession]:
+    """Like scripts/results/cleanse.py, but keeps the reasons why sessions failed as they are."""
+    model_language_dir = path_util.raw_experiment_results_dir / model_name / language
+    assert model_language_dir.exists(), f"no raw results of model '{model_name}' for language '{language}'"
+    sessions: dict[int, RecordedSession] = {}
+    for results_dir in model_language_dir.iterdir():
+        with open(results_dir / "config.json") as f_config, open(results_dir / "run.json") as f_run:
+            from_session_id = json.load(f_config).get("from_session_id", 0)
+            for session_idx_offset, session in enumerate(json.load(f_run)["result"]["answers"]):
+                sessions[from_session_id + session_idx_offset] = session
+    return [sessions.get(session_idx) for session_idx in range(max(sessions, default=-1) + 1)]
@@ -0,0 +1,53 @@
+import json
+from http.client import HTTPConnection
+from typing import Final, Optional
+from urllib.parse import urlsplit
+
+from api_usage import APIUsage
+from experiment import ex
+from .model import Model
+
+
+class ServedModel(Model):
+    """Client of a local model that is served by scripts/experiments/serve.py (see model_server.ModelServer)."""
+
+    SUFFIX: Final[str] = "@server"
+
+    _model_name: str
+    _connection: HTTPConnection
+    _session_id: Optional[str]
+
+    @ex.capture
+    def __init__(self, model_name: str, model_server_url: str):
+        super().__init__()
+        self._model_name = model_name
+        url = urlsplit(model_server_url)
+        self._connection = HTTPConnection(url.hostname, url.port)
+        self._session_id = None
+
+        served_model_name = self._request("GET", "/info")["model_name"]
+        expected_model_name = model_name.removesuffix(self.SUFFIX)
+        assert served_model_name == expected_model_name, \
+            f"server at {model_server_url} serves model '{served_model_name}', expected '{expected_model_name}'"
+
+    def _prompt(self, prompt: str) -> str:
+        response = self._request("POST", f"/sessions/{self._session_id}/prompt", dict(prompt=prompt))
+        self._answer_probabilities = [response["answer_probabilities"]]
+        return response["answer"]
+
+    def _reset(self) -> None:
+        if self._session_id is not None:
+            self._request("DELETE", f"/sessions/{self._session_id}")
+        self._session_id = self._request("POST", "/sessions", dict(language=self.language))["session_id"]
+
+    def report_api_usage(self) -> APIUsage:
+        return APIUsage(self._model_name, -1, -1, 0.)
+
+    def _request(self, method: str, path: str, body: Optional[dict] = None) -> dict:
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        self._connection.request(method, path, body=data, headers=headers)
+        response = self._connection.getresponse()
+        response_body = json.loads(response.read())
+        assert response.status == 200, f"request {method} {path} failed with status {response.status}: {response_body}"
+        return response_body
@@ -1,31 +1,16 @@
-from dataclasses import dataclass
-from enum import StrEnum
 from logging import Logger
+from typing import Final
 
 import torch
 import transformers
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, PreTrainedTokenizerBase
 
-from api_usage import APIUsage
+import path_util
 from experiment import ex
-from .model import Model
+from .local import LocalModel
 
 
-class ChatRole(StrEnum):
-    SYSTEM = "system"
-    USER = "user"
-    ASSISTANT = "assistant"
-
-
-@dataclass
-class ChatMessage:
-    role: ChatRole
-    content: str
-
-    def to_dict(self) -> dict:
-        return {"role": self.role, "content": self.content}
-
-
-class TransformersModel(Model):
+class TransformersModel(LocalModel):
     _model_config = {
         "falcon-7b-instruct": "tiiuae/falcon-7b-instruct",
         "falcon-40b-instruct": "tiiuae/falcon-40b-instruct",
@@ -37,51 +22,55 @@ class TransformersModel(Model):
         "Meta-Llama-3-70B-Instruct": "meta-llama/Meta-Llama-3-70B-Instruct",
     }
 
+    # models with this suffix run on CPU with int8 dynamic quantization of the linear layers
+    QUANTIZED_SUFFIX: Final[str] = "-int8"
+
     SUPPORTED_MODELS = set(_model_config.keys())
+    # not a comprehension, which would not see QUANTIZED_SUFFIX in the class scope
+    SUPPORTED_QUANTIZED_MODELS = set(map(f"{{}}{QUANTIZED_SUFFIX}".format, SUPPORTED_MODELS))
 
-    _model_name: str
+    @classmethod
+    def load_tokenizer(cls, model_name: str) -> PreTrainedTokenizerBase:
+        return AutoTokenizer.from_pretrained(cls._hf_model_name(model_name), trust_remote_code=True)
 
-    _pipe: transformers.Pipeline
-    _history: list[ChatMessage]
+    @classmethod
+    def context_window(cls, model_name: str) -> int:
+        config = AutoConfig.from_pretrained(cls._hf_model_name(model_name), trust_remote_code=True)
+        return config.max_position_embeddings
 
-    def __init__(self, model_name: str):
-        super().__init__()
-        self._model_name = model_name
-        self._init_model()
+    @classmethod
+    def _hf_model_name(cls, model_name: str) -> str:
+        return cls._model_config[model_name.removesuffix(cls.QUANTIZED_SUFFIX)]
 
     def _init_model(self) -> None:
+        if self._model_name.endswith(self.QUANTIZED_SUFFIX):
+            model = self._load_quantized_model()
+        else:
+            model = self._hf_model_name(self._model_name)
         self._pipe = transformers.pipeline(
             "text-generation",
-            model=self._model_config[self._model_name],
+            model=model,
+            tokenizer=self.load_tokenizer(self._model_name),
             model_kwargs={"torch_dtype": torch.bfloat16},
             trust_remote_code=True,
         )
 
-    def prompt(self, prompt: str) -> str:
-        self._history.append(ChatMessage(ChatRole.USER, prompt))
-        message = self._complete()
-        self._history.append(ChatMessage(ChatRole.ASSISTANT, message))
-        return message
-
     @ex.capture
-    def reset(self, _log: Logger) -> None:
-        self._history = [ChatMessage(ChatRole.SYSTEM, self.system_prompt)]
-
-    def _complete(self) -> str:
-        prompt = self._pipe.tokenizer.apply_chat_template(
-            [msg.to_dict() for msg in self._history],
-            tokenize=False,
-            add_generation_prompt=True,
+    def _load_quantized_model(self, _log: Logger) -> torch.nn.Module:
+        checkpoint_path = path_util.quantized_models_dir / f"{self._model_name}.pt"
+        if checkpoint_path.exists():
+            _log.info(f"loading quantized checkpoint {checkpoint_path}")
+            return torch.load(checkpoint_path, weights_only=False)
+
+        _log.info(f"quantizing {self._model_name}, the quantized model will be saved to {checkpoint_path}")
+        # dynamic quantization is only implemented for float32 layers
+        model = AutoModelForCausalLM.from_pretrained(
+            self._hf_model_name(self._model_name),
+            torch_dtype=torch.float32,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
         )
-        eos_token_id = [self._pipe.tokenizer.eos_token_id]
-        if eot_id := self._pipe.tokenizer.convert_tokens_to_ids("<|eot_id|>"):
-            eos_token_id.append(eot_id)
-        return self._pipe(
-            prompt,
-            max_new_tokens=1,
-            eos_token_id=eos_token_id,
-            do_sample=False,
-        )[0]["generated_text"][len(prompt):]
-
-    def report_api_usage(self) -> APIUsage:
-        return APIUsage(self._model_name, -1, -1, 0.)
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(model, checkpoint_path)
+        return model
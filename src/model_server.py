@@ -0,0 +1,156 @@
+import json
+import queue
+import threading
+import uuid
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Any, Optional
+
+from model.local import LocalModel, LocalSession
+
+
+class ModelServer:
+    """Serves a local model over HTTP such that it has to be loaded only once for many experiment runs.
+
+    Endpoints (all bodies are JSON):
+     - GET /info: returns the name of the served model.
+     - POST /sessions: starts a session in the given "language"; returns its "session_id".
+     - POST /sessions/<session_id>/prompt: prompts the session with the given "prompt"; returns the "answer" and its
+       "answer_probabilities" (if available).
+     - DELETE /sessions/<session_id>: ends the session.
+
+    Prompts of concurrent sessions are collected and processed together in a single call to the model.
+    """
+
+    def __init__(self, model: LocalModel, model_name: str, host: str, port: int, max_batch_size: int, log: Logger):
+        self._model = model
+        self._model_name = model_name
+        self._max_batch_size = max_batch_size
+        self._log = log
+
+        self._model_lock = threading.Lock()
+        self._sessions: dict[str, LocalSession] = {}
+        self._sessions_lock = threading.Lock()
+        self._pending_prompts: queue.Queue[tuple[LocalSession, str, Future]] = queue.Queue()
+
+        self._http_server = ThreadingHTTPServer((host, port), _make_request_handler(self))
+        self._http_server.daemon_threads = True
+        self._worker = threading.Thread(target=self._process_prompts, daemon=True)
+
+    def serve_forever(self) -> None:
+        self._worker.start()
+        host, port = self._http_server.server_address[:2]
+        self._log.info(f"serving '{self._model_name}' on http://{host}:{port}")
+        try:
+            self._http_server.serve_forever()
+        finally:
+            self._http_server.server_close()
+
+    def shutdown(self) -> None:
+        self._http_server.shutdown()
+
+    def info(self) -> dict[str, Any]:
+        with self._sessions_lock:
+            num_sessions = len(self._sessions)
+        return dict(model_name=self._model_name, num_sessions=num_sessions)
+
+    def start_session(self, language: str) -> str:
+        session_id = uuid.uuid4().hex
+        with self._model_lock:
+            session = self._model.new_session(language)
+        with self._sessions_lock:
+            self._sessions[session_id] = session
+        return session_id
+
+    def prompt(self, session_id: str, prompt: str) -> tuple[str, Optional[dict[str, float]]]:
+        session = self._get_session(session_id)
+        future = Future()
+        self._pending_prompts.put((session, prompt, future))
+        return future.result()
+
+    def end_session(self, session_id: str) -> None:
+        with self._sessions_lock:
+            self._sessions.pop(session_id, None)
+
+    def _get_session(self, session_id: str) -> LocalSession:
+        with self._sessions_lock:
+            if session_id not in self._sessions:
+                raise KeyError(f"unknown session '{session_id}'")
+            return self._sessions[session_id]
+
+    def _process_prompts(self) -> None:
+        while True:
+            batch = [self._pending_prompts.get()]
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(self._pending_prompts.get_nowait())
+                except queue.Empty:
+                    break
+
+            sessions, prompts, futures = zip(*batch)
+            try:
+                with self._model_lock:
+                    answers = self._model.prompt_sessions(list(sessions), list(prompts))
+                    answer_probabilities = self._model.answer_probabilities
+            except Exception as exc:
+                self._log.exception("failed to prompt the model")
+                for future in futures:
+                    future.set_exception(exc)
+                continue
+            for future, answer, probabilities in zip(futures, answers, answer_probabilities):
+                future.set_result((answer, probabilities))
+
+
+def _make_request_handler(server: ModelServer) -> type[BaseHTTPRequestHandler]:
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep connections alive
+
+        def do_GET(self) -> None:
+            if self.path == "/info":
+                self._respond(HTTPStatus.OK, server.info())
+            else:
+                self._respond(HTTPStatus.NOT_FOUND, dict(error=f"unknown path {self.path}"))
+
+        def do_POST(self) -> None:
+            body = self._read_body()
+            path = self.path.strip("/").split("/")
+            try:
+                if path == ["sessions"]:
+                    self._respond(HTTPStatus.OK, dict(session_id=server.start_session(body["language"])))
+                elif len(path) == 3 and path[0] == "sessions" and path[2] == "prompt":
+                    answer, answer_probabilities = server.prompt(path[1], body["prompt"])
+                    self._respond(HTTPStatus.OK, dict(answer=answer, answer_probabilities=answer_probabilities))
+                else:
+                    self._respond(HTTPStatus.NOT_FOUND, dict(error=f"unknown path {self.path}"))
+            except KeyError as exc:
+                self._respond(HTTPStatus.NOT_FOUND, dict(error=str(exc)))
+            except Exception as exc:
+                self._respond(HTTPStatus.INTERNAL_SERVER_ERROR, dict(error=repr(exc)))
+
+        def do_DELETE(self) -> None:
+            path = self.path.strip("/").split("/")
+            if len(path) == 2 and path[0] == "sessions":
+                server.end_session(path[1])
+                self._respond(HTTPStatus.OK, {})
+            else:
+                self._respond(HTTPStatus.NOT_FOUND, dict(error=f"unknown path {self.path}"))
+
+        # noinspection PyShadowingBuiltins
+        def log_message(self, format: str, *args: Any) -> None:
+            pass  # requests are far too frequent to be logged
+
+        def _read_body(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length)) if length > 0 else {}
+
+        def _respond(self, status: HTTPStatus, body: dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return RequestHandler
@@ -35,6 +35,10 @@ class Session:
     scenarios: list[Scenario]
 
 
+def make_prompt(scenario: Scenario) -> str:
+    return f"1:\n{scenario.profile_left}\n\n\n\n\n2:\n{scenario.profile_right}"
+
+
 @ex.capture
 def load_sessions(language: str, from_session_id: int, to_session_id: int) -> list[Session]:
     assert language in get_available_languages(), f"language '{language}' not available"
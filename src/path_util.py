@@ -1,9 +1,18 @@
+import tempfile
 from pathlib import Path
 from typing import Final
 
 project_root_dir: Final[Path] = Path(__file__).parent.parent
 data_dir: Final[Path] = project_root_dir / "data"
 results_local_dir: Final[Path] = project_root_dir / "results_local"
+openai_batches_dir: Final[Path] = project_root_dir / "batches_local"
+cache_local_dir: Final[Path] = project_root_dir / "cache_local"
+context_plan_path: Final[Path] = cache_local_dir / "context_plan.json"
+response_cache_path: Final[Path] = cache_local_dir / "responses.sqlite"
+gemini_priming_replies_path: Final[Path] = cache_local_dir / "gemini_priming_replies.json"
+quantized_models_dir: Final[Path] = project_root_dir / "models_local" / "quantized"
+# shared by all processes of the host (and all checkouts of the project)
+rate_limits_dir: Final[Path] = Path(tempfile.gettempdir()) / "moral_machine_rate_limits"
 results_dir: Final[Path] = project_root_dir / "results"
 raw_experiment_results_dir: Final[Path] = results_dir / "raw"
 cleansed_experiment_results_dir: Final[Path] = results_dir / "cleansed"
@@ -1,24 +1,288 @@
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+import threading
 import time
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import path_util
+
+
+class TokenBucket:
+    """Holds up to capacity units, which are refilled at rate units per second.
+
+    Units are reserved right away, even if the bucket does not hold enough of them yet; the level then drops below zero,
+    and the caller has to wait until the reserved units are refilled. Thus, callers are served in the order of their
+    reservations, and each one sleeps exactly as long as needed instead of polling."""
+
+    def __init__(self, capacity: float, rate: float):
+        assert capacity > 0 and rate > 0, f"capacity and rate must be positive, got {capacity} and {rate}"
+        self._capacity = capacity
+        self._rate = rate
+        self._level = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def reserve(self, amount: float) -> float:
+        """Reserve the given amount of units. Returns the time to wait (in seconds) until they are available."""
+        with self._lock:
+            self._refill()
+            # a reservation larger than the bucket could never be served, so it takes the whole bucket instead
+            self._level -= min(amount, self._capacity)
+            return max(0., -self._level / self._rate)
+
+    def update(self, capacity: float, rate: float, level: Optional[float] = None) -> None:
+        """Change the capacity and rate of the bucket. The level is lowered to the given one, if any, but not raised,
+        since units that are reserved already would be handed out twice otherwise."""
+        assert capacity > 0 and rate > 0, f"capacity and rate must be positive, got {capacity} and {rate}"
+        with self._lock:
+            self._refill()
+            self._capacity = capacity
+            self._rate = rate
+            self._level = min(self._level, capacity if level is None else level)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self._capacity, self._level + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+
+class SharedTokenBucket:
+    """Token bucket whose capacity and rate are shared by all processes of the host that open the same ledger file.
+    Each active process (one that reserved units within the last ACTIVE_WINDOW seconds) gets an equal share of both,
+    such that a process with many concurrent sessions cannot starve the others; the share of a process that stops is
+    handed to the others once it becomes inactive.
+
+    The ledger is a small memory-mapped file with the limits and a slot per process, which is locked (flock) for each
+    reservation, so reservations take microseconds and need no daemon. Times are taken from the monotonic clock, which
+    is the same for all processes of the host."""
+
+    ACTIVE_WINDOW: float = 10.
+    MAX_PROCESSES: int = 64
+
+    # capacity and rate of the whole bucket
+    _HEADER: struct.Struct = struct.Struct("=dd")
+    # pid, time of the last reservation, level and time of the last refill of the share of a process (pid 0 if unused)
+    _SLOT: struct.Struct = struct.Struct("=qddd")
+
+    def __init__(self, path: Path, capacity: float, rate: float):
+        """The capacity and rate are only used if no other process is active, otherwise those of the ledger are kept."""
+        assert capacity > 0 and rate > 0, f"capacity and rate must be positive, got {capacity} and {rate}"
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._HEADER.size + self.MAX_PROCESSES * self._SLOT.size
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)  # filled with zeros, i.e., unused slots
+            self._ledger = mmap.mmap(self._fd, size)
+            now = time.monotonic()
+            if not any(self._is_active(slot, now) for slot in self._SLOT.iter_unpack(self._ledger[self._HEADER.size:])):
+                self._HEADER.pack_into(self._ledger, 0, capacity, rate)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._slot_idx: Optional[int] = None
+
+    @property
+    def rate(self) -> float:
+        """Rate of the whole bucket, of which this process gets a share."""
+        with self._locked():
+            return self._HEADER.unpack_from(self._ledger, 0)[1]
+
+    def reserve(self, amount: float) -> float:
+        """Reserve the given amount of units from the share of this process. Returns the time to wait (in seconds)
+        until they are available."""
+        with self._locked():
+            now = time.monotonic()
+            _, share_rate, level = self._refill(now)
+            # like TokenBucket, but a reservation may take more than the share, which is just refilled for longer
+            level -= min(amount, self._HEADER.unpack_from(self._ledger, 0)[0])
+            self._write_slot(now, level)
+            return max(0., -level / share_rate)
+
+    def update(self, capacity: float, rate: float, level: Optional[float] = None) -> None:
+        """Change the capacity and rate of the whole bucket. The level of the share of this process is lowered to its
+        share of the given level, if any, but not raised (see TokenBucket.update)."""
+        assert capacity > 0 and rate > 0, f"capacity and rate must be positive, got {capacity} and {rate}"
+        with self._locked():
+            now = time.monotonic()
+            self._HEADER.pack_into(self._ledger, 0, capacity, rate)
+            share_capacity, _, share_level = self._refill(now)
+            if level is not None:
+                share_level = min(share_level, level * share_capacity / capacity)
+            self._write_slot(now, share_level)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # flock does not exclude the threads of a process, which share the file descriptor
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _refill(self, now: float) -> tuple[float, float, float]:
+        """Claims a slot for this process if it has none, and refills its share. Returns the capacity and rate of the
+        share, and its level. The ledger has to be locked."""
+        capacity, rate = self._HEADER.unpack_from(self._ledger, 0)
+        slots = list(self._SLOT.iter_unpack(self._ledger[self._HEADER.size:]))
+        active = [self._is_active(slot, now) for slot in slots]
+        if self._slot_idx is None or slots[self._slot_idx][0] != os.getpid():
+            # the slot of this process was taken over by another one while this one was inactive (or it is new)
+            free_idx = next((idx for idx, is_active in enumerate(active) if not is_active), None)
+            assert free_idx is not None, f"more than {self.MAX_PROCESSES} processes share the rate limit"
+            self._slot_idx = free_idx
+            # only the first active process may use a full bucket, others start empty to not exceed the capacity
+            level = 0. if any(active) else capacity
+            slots[free_idx] = (os.getpid(), now, level, now)
+            active[free_idx] = True
+        num_active = sum(active) + (not active[self._slot_idx])
+        share_capacity, share_rate = capacity / num_active, rate / num_active
+        _, _, level, last_refill = slots[self._slot_idx]
+        return share_capacity, share_rate, min(share_capacity, level + (now - last_refill) * share_rate)
+
+    def _write_slot(self, now: float, level: float) -> None:
+        self._SLOT.pack_into(self._ledger, self._HEADER.size + self._slot_idx * self._SLOT.size, os.getpid(), now, level, now)
+
+    def _is_active(self, slot: tuple[int, float, float, float], now: float) -> bool:
+        pid, last_active, _, _ = slot
+        return pid != 0 and last_active >= now - self.ACTIVE_WINDOW
 
 
 class RateLimit:
-    _calls = []
+    """Limits the requests (and tokens) per minute that are sent to the API of a provider for a model. The limits are
+    shared by all sessions, threads and event loops of the process that use the same provider and model, and optionally
+    by all processes of the host (see :meth:`get`).
+
+    The configured limits are only a starting point: they adapt to the quota that the provider reports with each
+    response (see :meth:`update`), or, if it does not, to the requests it rejects (see :meth:`throttle`)."""
+
+    # use 10% margin to be sure we do not exceed the configured rate limit; reported quotas are exact
+    _MARGIN: float = .9
+
+    # after a rejected request, the request rate is cut by this factor, and it recovers by a request per minute (up to
+    # the configured limit) with each successful request
+    _THROTTLE_FACTOR: float = .5
+
+    _rate_limits: dict[tuple[str, str], "RateLimit"] = {}
+    _rate_limits_lock = threading.Lock()
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: Optional[int], ledger_name: Optional[str] = None):
+        """With a ledger name, the limits are shared by all processes of the host that use it (see SharedTokenBucket)."""
+        self._ledger_name = ledger_name
+        self._max_requests_per_minute = max_requests_per_minute
+        self._requests = self._make_bucket("requests", self._MARGIN * max_requests_per_minute)
+        self._tokens = None
+        if max_tokens_per_minute is not None:
+            self._tokens = self._make_bucket("tokens", self._MARGIN * max_tokens_per_minute)
+        self._num_updates = 0
+        self._num_throttles = 0
+
+    @staticmethod
+    def get(
+            provider: str,
+            model_name: str,
+            max_requests_per_minute: int,
+            max_tokens_per_minute: Optional[int] = None,
+            scope: str = "process",
+    ) -> "RateLimit":
+        """The rate limit of the given provider and model; it is created with the given limits on first use. Its scope
+        is either the "process" or the "host", whose processes share the limits."""
+        assert scope in ("process", "host"), f"unknown rate limit scope: {scope}"
+        with RateLimit._rate_limits_lock:
+            key = (provider, model_name)
+            if key not in RateLimit._rate_limits:
+                ledger_name = f"{provider}_{model_name.replace('/', '_')}" if scope == "host" else None
+                RateLimit._rate_limits[key] = RateLimit(max_requests_per_minute, max_tokens_per_minute, ledger_name)
+            return RateLimit._rate_limits[key]
+
+    def wait(self, num_tokens: int = 0) -> None:
+        """Wait until a request with the given (estimated) number of tokens can be sent."""
+        delay = self._reserve(num_tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, num_tokens: int = 0) -> None:
+        """Like :meth:`wait`, but yields to the event loop while waiting."""
+        delay = self._reserve(num_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def update(
+            self,
+            max_requests_per_minute: Optional[int] = None,
+            remaining_requests: Optional[int] = None,
+            requests_reset: Optional[float] = None,
+            max_tokens_per_minute: Optional[int] = None,
+            remaining_tokens: Optional[int] = None,
+            tokens_reset: Optional[float] = None,
+    ) -> None:
+        """Adapt the limits to the quota reported by the provider: the maximum per minute, what remains of it, and the
+        seconds until it is fully replenished. Limits without a reported maximum are kept."""
+        self._num_updates += 1
+        if max_requests_per_minute is not None:
+            self._max_requests_per_minute = max_requests_per_minute
+            self._requests.update(
+                max_requests_per_minute,
+                self._refill_rate(max_requests_per_minute, remaining_requests, requests_reset),
+                remaining_requests,
+            )
+        if max_tokens_per_minute is not None:
+            if self._tokens is None:
+                self._tokens = self._make_bucket("tokens", max_tokens_per_minute)
+            self._tokens.update(
+                max_tokens_per_minute,
+                self._refill_rate(max_tokens_per_minute, remaining_tokens, tokens_reset),
+                remaining_tokens,
+            )
+
+    def throttle(self) -> None:
+        """Slow down after the provider rejected a request for exceeding a quota it does not report."""
+        self._num_throttles += 1
+        requests_per_minute = max(1., self._requests.rate * 60 * self._THROTTLE_FACTOR)
+        self._requests.update(requests_per_minute, requests_per_minute / 60, 0)
+
+    def recover(self) -> None:
+        """Speed up again after a successful request, up to the configured limit."""
+        requests_per_minute = self._requests.rate * 60
+        if requests_per_minute < self._MARGIN * self._max_requests_per_minute:
+            requests_per_minute = min(requests_per_minute + 1, self._MARGIN * self._max_requests_per_minute)
+            self._requests.update(requests_per_minute, requests_per_minute / 60)
+
+    def report_metrics(self) -> dict[str, float]:
+        return dict(
+            rate_limit_requests_per_minute=self._requests.rate * 60,
+            rate_limit_tokens_per_minute=-1 if self._tokens is None else self._tokens.rate * 60,
+            rate_limit_updates=self._num_updates,
+            rate_limit_throttles=self._num_throttles,
+        )
+
+    def _reserve(self, num_tokens: int) -> float:
+        # both budgets are reserved at once, so the request waits for the one that frees up last
+        delay = self._requests.reserve(1)
+        if self._tokens is not None:
+            delay = max(delay, self._tokens.reserve(num_tokens))
+        return delay
 
     @staticmethod
-    def wait(max_calls: int, period: int) -> None:
-        """Rate limit API requests. At most :param:`max_calls` are allowed in
-        :param:`period` seconds."""
-
-        # use 10% margin to be sure we do not exceed the rate limit
-        delta = timedelta(seconds=1.1 * period)
-
-        rate_limit_exceeded = True
-        while rate_limit_exceeded:
-            expired_calls = datetime.now() - delta
-            RateLimit._calls = [call for call in RateLimit._calls if call >= expired_calls]
-            rate_limit_exceeded = len(RateLimit._calls) >= max_calls
-            if rate_limit_exceeded:
-                # on average, we need to wait period/max_calls seconds per call
-                time.sleep(period / max_calls)
-        RateLimit._calls.append(datetime.now())
+    def _refill_rate(max_per_minute: int, remaining: Optional[int], reset: Optional[float]) -> float:
+        # resets are reported with a precision of milliseconds, so only those of a second or longer tell the actual rate
+        if remaining is not None and reset is not None and reset >= 1 and remaining < max_per_minute:
+            return (max_per_minute - remaining) / reset
+        return max_per_minute / 60
+
+    def _make_bucket(self, unit: str, max_per_minute: float) -> Union[TokenBucket, SharedTokenBucket]:
+        # a full bucket allows a burst of a minute's worth, like the limits of the providers
+        if self._ledger_name is None:
+            return TokenBucket(max_per_minute, max_per_minute / 60)
+        return SharedTokenBucket(path_util.rate_limits_dir / f"{self._ledger_name}_{unit}", max_per_minute, max_per_minute / 60)
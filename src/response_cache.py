@@ -0,0 +1,101 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+
+class ResponseCache:
+    """Replies of models that are stored on disk (in SQLite), keyed by a hash of everything that determines the reply:
+    the backend, the model and its generation parameters, the system prompt and the exact history of the session. The
+    cache can be shared by concurrent processes. When it holds more than max_entries replies, the least recently used
+    ones are evicted."""
+
+    # share of max_entries that is evicted at once, such that not every insertion evicts
+    _EVICTION_SHARE: float = .1
+
+    _caches: dict[Path, "ResponseCache"] = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, path: Path, max_entries: int):
+        assert max_entries > 0, f"max_entries must be positive, got {max_entries}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_entries = max_entries
+        # the connection is used by all threads of the process, one at a time
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")  # readers do not block the writer (of another process)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, reply TEXT NOT NULL, answer_probabilities TEXT, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._num_entries = self._count_entries()
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_evictions = 0
+
+    @staticmethod
+    def get(path: Path, max_entries: int) -> "ResponseCache":
+        """The cache stored at the given path; it is opened on first use and shared by all models of the process."""
+        with ResponseCache._caches_lock:
+            if path not in ResponseCache._caches:
+                ResponseCache._caches[path] = ResponseCache(path, max_entries)
+            return ResponseCache._caches[path]
+
+    @staticmethod
+    def key(scope: dict[str, Any], history: list[str]) -> str:
+        return hashlib.sha256(json.dumps([scope, history], sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, key: str) -> Optional[tuple[str, Optional[dict[str, float]]]]:
+        """Returns the reply and the answer probabilities stored under the given key, or None if there are none."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT reply, answer_probabilities FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._num_misses += 1
+                return None
+            self._num_hits += 1
+            self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        reply, answer_probabilities = row
+        return reply, None if answer_probabilities is None else json.loads(answer_probabilities)
+
+    def store(self, key: str, reply: str, answer_probabilities: Optional[dict[str, float]]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, reply, None if answer_probabilities is None else json.dumps(answer_probabilities), time.time()),
+            )
+            self._num_entries += 1
+            if self._num_entries > self._max_entries:
+                # other processes may have added (or evicted) entries as well
+                num_evicted = self._count_entries() - int((1 - self._EVICTION_SHARE) * self._max_entries)
+                if num_evicted > 0:
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                        (num_evicted,),
+                    )
+                    self._num_evictions += num_evicted
+                self._num_entries = self._count_entries()
+
+    @staticmethod
+    def report_metrics() -> dict[str, float]:
+        """Statistics of all caches that were used."""
+        caches = [cache for cache in ResponseCache._caches.values() if cache._num_hits + cache._num_misses > 0]
+        if not caches:
+            return {}
+        num_hits = sum(cache._num_hits for cache in caches)
+        num_misses = sum(cache._num_misses for cache in caches)
+        return dict(
+            response_cache_hits=num_hits,
+            response_cache_misses=num_misses,
+            response_cache_hit_rate=num_hits / (num_hits + num_misses),
+            response_cache_evictions=sum(cache._num_evictions for cache in caches),
+            response_cache_entries=sum(cache._num_entries for cache in caches),
+        )
+
+    def _count_entries(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
@@ -0,0 +1,179 @@
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+
+@dataclass(frozen=True)
+class RetryBudget:
+    """How often and how quickly errors of the given type are retried."""
+    exception_type: Union[type[BaseException], tuple[type[BaseException], ...]]
+    # attempts that may fail with such errors per call; None retries until the call succeeds
+    max_attempts: Optional[int]
+    # the wait before the n-th retry is drawn uniformly between min_wait and min(min_wait * 2^n, max_wait) seconds
+    min_wait: float = 0.
+    max_wait: float = 0.
+    # whether the errors indicate that the API is degraded, such that they count towards the circuit breaker
+    trips_circuit: bool = False
+
+    def wait(self, num_failures: int) -> float:
+        return random.uniform(self.min_wait, max(self.min_wait, min(self.min_wait * 2 ** num_failures, self.max_wait)))
+
+
+class CircuitBreaker:
+    """Pauses the requests of all sessions of the process when many of the recent requests failed with errors that
+    indicate a degraded API, instead of having every session retry on its own and waste quota. After the pause, requests
+    are sent again, and the circuit opens again if they keep failing."""
+
+    # the circuit opens when at least ERROR_RATE of the last WINDOW requests failed, and stays open for COOLDOWN seconds
+    WINDOW: int = 20
+    ERROR_RATE: float = .5
+    COOLDOWN: float = 30.
+
+    _outcomes: deque[bool] = deque(maxlen=WINDOW)
+    _open_until: float = 0.
+    _lock = threading.Lock()
+    _num_opens: int = 0
+    # seconds that sessions were paused, summed over all sessions
+    _wait_time: float = 0.
+
+    @staticmethod
+    def wait() -> None:
+        """Wait until the circuit is closed."""
+        while (remaining := CircuitBreaker._remaining()) > 0:
+            time.sleep(remaining)
+
+    @staticmethod
+    async def wait_async() -> None:
+        """Like :meth:`wait`, but yields to the event loop while waiting."""
+        while (remaining := CircuitBreaker._remaining()) > 0:
+            await asyncio.sleep(remaining)
+
+    @staticmethod
+    def record(success: bool) -> None:
+        with CircuitBreaker._lock:
+            outcomes = CircuitBreaker._outcomes
+            outcomes.append(success)
+            if len(outcomes) == outcomes.maxlen and outcomes.count(False) >= CircuitBreaker.ERROR_RATE * len(outcomes):
+                logging.root.warning(
+                    f"{outcomes.count(False)} of the last {len(outcomes)} requests failed, pausing all requests for "
+                    f"{CircuitBreaker.COOLDOWN} seconds"
+                )
+                CircuitBreaker._open_until = time.monotonic() + CircuitBreaker.COOLDOWN
+                CircuitBreaker._num_opens += 1
+                # the requests after the pause have to fail again to open the circuit again
+                outcomes.clear()
+
+    @staticmethod
+    def report_metrics() -> dict[str, float]:
+        return dict(circuit_breaker_opens=CircuitBreaker._num_opens, circuit_breaker_wait_time=CircuitBreaker._wait_time)
+
+    @staticmethod
+    def _remaining() -> float:
+        with CircuitBreaker._lock:
+            remaining = CircuitBreaker._open_until - time.monotonic()
+            if remaining > 0:
+                CircuitBreaker._wait_time += remaining
+            return remaining
+
+
+class RetryPolicy:
+    """Retries calls of the decorated function (or coroutine function) on the errors of its budgets, with jittered
+    exponential backoff. Errors without a budget are raised right away. All policies share the circuit breaker, which
+    is consulted before each call by policies with a budget that trips it."""
+
+    _policies: list["RetryPolicy"] = []
+
+    def __init__(self, name: str, *budgets: RetryBudget):
+        self._name = name
+        self._budgets = budgets
+        self._uses_circuit = any(budget.trips_circuit for budget in budgets)
+        self._num_calls = 0
+        self._num_retries: Counter[str] = Counter()
+        self._num_exhausted: Counter[str] = Counter()
+        RetryPolicy._policies.append(self)
+
+    def __call__(self, fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper_async(*args, **kwargs):
+                self._num_calls += 1
+                num_failures = Counter()
+                while True:
+                    if self._uses_circuit:
+                        await CircuitBreaker.wait_async()
+                    try:
+                        result = await fn(*args, **kwargs)
+                    except Exception as exc:
+                        wait = self._handle_failure(exc, num_failures)
+                        if wait is None:
+                            raise
+                        await asyncio.sleep(wait)
+                    else:
+                        self._handle_success()
+                        return result
+
+            return wrapper_async
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self._num_calls += 1
+            num_failures = Counter()
+            while True:
+                if self._uses_circuit:
+                    CircuitBreaker.wait()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as exc:
+                    wait = self._handle_failure(exc, num_failures)
+                    if wait is None:
+                        raise
+                    time.sleep(wait)
+                else:
+                    self._handle_success()
+                    return result
+
+        return wrapper
+
+    @staticmethod
+    def report_metrics() -> dict[str, float]:
+        """Statistics of all policies that were used, and of the circuit breaker."""
+        metrics = {}
+        for policy in RetryPolicy._policies:
+            if policy._num_calls == 0:
+                continue
+            metrics[f"retry_{policy._name}_calls"] = policy._num_calls
+            for error_name, num_retries in policy._num_retries.items():
+                metrics[f"retry_{policy._name}_{error_name}_retries"] = num_retries
+            for error_name, num_exhausted in policy._num_exhausted.items():
+                metrics[f"retry_{policy._name}_{error_name}_exhausted"] = num_exhausted
+        return metrics | CircuitBreaker.report_metrics()
+
+    def _handle_failure(self, exc: Exception, num_failures: Counter[int]) -> Optional[float]:
+        """Returns the time to wait before retrying, or None if the error is not retried."""
+        budget_idx = next((idx for idx, budget in enumerate(self._budgets) if isinstance(exc, budget.exception_type)), None)
+        if budget_idx is None:
+            return None
+        budget = self._budgets[budget_idx]
+        if budget.trips_circuit:
+            CircuitBreaker.record(False)
+        num_failures[budget_idx] += 1
+        error_name = type(exc).__name__
+        if budget.max_attempts is not None and num_failures[budget_idx] >= budget.max_attempts:
+            self._num_exhausted[error_name] += 1
+            logging.root.warning(f"{self._name}: giving up after {num_failures[budget_idx]} attempts failed with {exc!r}")
+            return None
+        self._num_retries[error_name] += 1
+        wait = budget.wait(num_failures[budget_idx])
+        logging.root.info(f"{self._name}: attempt failed with {exc!r}, retrying in {wait:.1f} seconds")
+        return wait
+
+    def _handle_success(self) -> None:
+        if self._uses_circuit:
+            CircuitBreaker.record(True)
@@ -1,6 +1,26 @@
+from typing import Final
+
+# answers the models are asked to give, one per scenario
+VALID_ANSWERS: Final[tuple[str, ...]] = ("1", "2")
+
+# how the answer a session continues with is chosen from several sampled answers (see choose_sample)
+SAMPLE_POLICIES: Final[tuple[str, ...]] = ("majority", "first")
+
+
 class UnexpectedAnswerException(Exception):
     pass
 
 
 class LogSessionStateDetailsException(Exception):
     pass
+
+
+def choose_sample(samples: list[str], sample_policy: str) -> tuple[str, dict[str, float]]:
+    """Choose the answer to continue the session with from the sampled answers. Returns it along with the frequencies
+    of the valid answers among the samples."""
+    frequencies = {answer: samples.count(answer) / len(samples) for answer in VALID_ANSWERS}
+    valid_samples = [sample for sample in samples if sample in VALID_ANSWERS]
+    if sample_policy == "first" or len(valid_samples) == 0:
+        return samples[0], frequencies
+    # the most frequent valid answer; ties are broken by the order of the samples
+    return max(valid_samples, key=valid_samples.count), frequencies